@@ -0,0 +1,391 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from OA_dsm import DSMGrid
+from OA_engine import INNER_RADIUS, MAX_SEARCH_RADIUS, SEARCH_METHODS, SEARCH_TOLERANCE, OAcalc_numpy
+from OA_interpolate import INTERPOLATIONS, curvature_correction
+from OA_log import add_message
+from OA_profile import peak_rss_mb
+
+
+# Benchmark scales: number of windows, DSM size (cells per side) and tile size. The DSMs of tiled scales are written
+# to an ESRI float grid and memory-mapped like a real large DSM, the others are kept in memory.
+SCALES = {"small": (100, 1000, None), "medium": (10000, 5000, None), "large": (100000, 20000, 512)}
+
+# The synthetic city: rows of building blocks running east-west, separated by streets, with towers standing on the
+# blocks. All sizes are (min, max) ranges in metres. The cell size is 1 m, which keeps the DSM cell centres off the
+# edge of the inner radius ring (see CityScene.windows).
+CELL_SIZE = 1.0
+STREET_WIDTH = (18.0, 30.0)
+BLOCK_DEPTH = (10.0, 30.0)
+BLOCK_HEIGHT = (6.0, 30.0)
+TOWER_WIDTH = (15.0, 40.0)
+TOWER_GAP = (60.0, 400.0)
+TOWER_HEIGHT = (40.0, 120.0)
+WINDOW_WIDTH = (0.8, 2.0)
+WINDOW_HEIGHT = (1.0, 1.8)
+
+# Largest OA difference (degrees) from the analytic value that still counts as correct
+MAX_OA_ERROR = 1e-6
+
+# A single block (rows, columns, height) in an empty BEHIND_SIZE x BEHIND_SIZE cell DSM, with a window low on each of
+# its two long facades, whose OA has to be 0: the only cells higher than the windows are behind their own facade
+BEHIND_SIZE = 200
+BEHIND_BLOCK = (100, 130, 50, 150, 20.0)
+BEHIND_WINDOW = (4.5, 5.5)
+
+# Number of windows at random angles per case, which are compared with search="cells" instead of an analytic OA.
+# "raymarch" only finds the steepest cell when one of its rays hits it, so its differences from "cells" are reported
+# but do not fail the benchmark.
+ANGLED_WINDOWS = 100
+APPROXIMATE_SEARCHES = ("raymarch",)
+
+
+# A parametric street canyon scene with windows on the north and south facades of the blocks, whose obstruction angles
+# are known analytically. Every window faces straight across a street (search directions -90 and 90), so the steepest
+# cell of a block of constant height in its search wedge is the one straight across, in the first row of the block
+# that is outside the inner radius. Windows for which a tower could be steeper somewhere else in the wedge are not
+# used, so the analytic OA is exact for the tool's own selection rules.
+# The blocks behind the window, its own block first, are no obstructions: every line of sight into the wedge behind
+# the window crosses the own block at 1.5 cells, which hides them. Windows for which a block behind could be steeper
+# than that are not used either.
+# The interpolating searches see a continuous surface instead, where a block reaches its full height at the centres
+# of its first row, and leave out the points that depend on a cell inside the inner radius. Their steepest point is at
+# the same row centre as the steepest cell, and their analytic OA is the one of that surface with the curvature
+# correction. Windows for which a block's sloping edge crosses the outer radius, or with the side of a tower in their
+# search wedge, are not used for them.
+class CityScene:
+
+    def __init__(self, size, seed=0):
+        self.size = int(size)
+        self.cell_size = CELL_SIZE
+        self.x_min, self.y_max = 0.0, self.size * CELL_SIZE
+        self.rng = np.random.default_rng(seed)
+
+        # Block k covers the DSM rows block_start[k]:block_stop[k]
+        starts, stops, row = [], [], 0
+        while True:
+            row += self._cells(STREET_WIDTH)
+            depth = self._cells(BLOCK_DEPTH)
+            if row + depth > self.size:
+                break
+            starts.append(row)
+            stops.append(row + depth)
+            row += depth
+        self.block_start = np.array(starts, dtype=np.int64)
+        self.block_stop = np.array(stops, dtype=np.int64)
+        self.block_height = self.rng.uniform(*BLOCK_HEIGHT, size=len(starts))
+
+        # Tower t stands on block tower_block[t] and covers the columns tower_start[t]:tower_stop[t]. The towers are
+        # sorted by block and column and do not overlap.
+        towers = []
+        for block in range(len(starts)):
+            col = self._cells(TOWER_GAP)
+            while col < self.size:
+                width = self._cells(TOWER_WIDTH)
+                towers.append((block, col, min(col + width, self.size), self.rng.uniform(*TOWER_HEIGHT)))
+                col += width + self._cells(TOWER_GAP)
+        towers = np.array(towers, dtype=np.float64).reshape(-1, 4)
+        self.tower_block = towers[:, 0].astype(np.int64)
+        self.tower_start = towers[:, 1].astype(np.int64)
+        self.tower_stop = towers[:, 2].astype(np.int64)
+        self.tower_height = towers[:, 3]
+        self.block_max_height = self.block_height.copy()
+        np.maximum.at(self.block_max_height, self.tower_block, self.tower_height)
+
+    def _cells(self, size_range):
+        return max(1, int(round(self.rng.uniform(*size_range) / self.cell_size)))
+
+    # The DSM heights of rows row0:row1
+    def band(self, row0, row1, dtype=np.float64):
+        values = np.zeros((row1 - row0, self.size), dtype=dtype)
+        for block in np.flatnonzero((self.block_start < row1) & (self.block_stop > row0)):
+            heights = np.full(self.size, self.block_height[block], dtype=dtype)
+            first, last = np.searchsorted(self.tower_block, [block, block + 1])
+            for t in range(first, last):
+                heights[self.tower_start[t]:self.tower_stop[t]] = self.tower_height[t]
+            values[max(self.block_start[block], row0) - row0:min(self.block_stop[block], row1) - row0] = heights
+        return values
+
+    def dsm(self):
+        return DSMGrid(self.band(0, self.size), self.x_min, self.y_max, self.cell_size)
+
+    # Write the DSM as an ESRI float grid (.flt + .hdr), one band of rows at a time. Returns the path of the .flt file.
+    def write_float_grid(self, path, band_rows=512):
+        with open(os.path.splitext(path)[0] + ".hdr", "w") as f:
+            f.write("ncols {0}\nnrows {0}\nxllcorner {1}\nyllcorner {2}\ncellsize {3}\nNODATA_value -9999\n"
+                    "byteorder LSBFIRST\n".format(self.size, self.x_min, self.y_max - self.size * self.cell_size,
+                                                  self.cell_size))
+        with open(path, "wb") as f:
+            for row0 in range(0, self.size, band_rows):
+                f.write(self.band(row0, min(row0 + band_rows, self.size), "<f4").tobytes())
+        return path
+
+    # n_windows random windows with their analytic OA. Returns the window vertices as an (n_windows, 4, 3) array
+    # (top left, top right, bottom right, bottom left) and the OA of every window in degrees, for the interpolating
+    # searches if interpolated is True.
+    def windows(self, n_windows, inner_radius=INNER_RADIUS, outer_radius=None, tolerance=SEARCH_TOLERANCE,
+                batch=1024, interpolated=False):
+        vertices, oas = [], []
+        count = 0
+        while count < n_windows:
+            v, oa = self._window_batch(batch, inner_radius, outer_radius, tolerance, interpolated)
+            if not len(oa):
+                raise ValueError("None of {0} windows on a {1} x {1} cell scene has an exact analytic OA".format(
+                    batch, self.size))
+            vertices.append(v)
+            oas.append(oa)
+            count += len(oa)
+        return np.concatenate(vertices)[:n_windows], np.concatenate(oas)[:n_windows]
+
+    # The perpendicular height and the highest possible height of every block (columns) within the search wedge
+    # of a window in column col (rows), as seen at a horizontal distance of up to far, and whether the wedge sees a
+    # constant height.
+    def _wedge_heights(self, col, far, tolerance):
+        n_blocks = len(self.block_start)
+        blocks = np.arange(n_blocks)[None, :]
+        stride = self.size + 1
+        keys_start = self.tower_block * stride + self.tower_start
+        keys_stop = self.tower_block * stride + self.tower_stop
+
+        # The tower straight across from the window, if any
+        straight = np.searchsorted(keys_start, blocks * stride + col[:, None], side="right") - 1
+        straight_ok = straight >= 0
+        straight = np.maximum(straight, 0)
+        straight_ok &= (self.tower_block[straight] == blocks) & (self.tower_stop[straight] > col[:, None])
+        perpendicular = np.where(straight_ok, self.tower_height[straight], self.block_height[None, :])
+
+        # The towers overlapping the columns the wedge can reach in the block (and the next ones, which an
+        # interpolated height can depend on). The wedge is constant when there are none, or when one tower covers all
+        # of them.
+        half = np.floor(far * math.tan(math.radians(tolerance)) / self.cell_size).astype(np.int64) + 2
+        low = np.maximum(col[:, None] - half, 0)
+        high = np.minimum(col[:, None] + half, self.size - 1)
+        first = np.searchsorted(keys_stop, blocks * stride + low, side="right")
+        last = np.searchsorted(keys_start, blocks * stride + high, side="right")
+        covered = straight_ok & (self.tower_start[straight] <= low) & (self.tower_stop[straight] > high)
+        constant = (last <= first) | ((last - first == 1) & covered)
+        return perpendicular, np.where(constant, perpendicular, self.block_max_height[None, :]), constant
+
+    def _window_batch(self, n, inner_radius, outer_radius, tolerance, interpolated=False):
+        cs = self.cell_size
+        block = self.rng.integers(0, len(self.block_start), n)
+        north = self.rng.random(n) < 0.5
+        col = self.rng.integers(0, self.size, n)
+        facade = np.where(north, self.block_start[block], self.block_stop[block])
+
+        # Distance from the facade to the nearest row outside the inner radius of every block, and to its farthest row.
+        # Cell centres are at half cells from the facade, so no row is closer than the inner radius but still has a
+        # cell outside it within the wedge (the angle would have to be above ~14 degrees at 1 m cells).
+        f = facade[:, None]
+        starts, stops = self.block_start[None, :], self.block_stop[None, :]
+        south = starts >= f
+        front = np.where(north[:, None], ~south, south)
+        near_row = np.where(south, np.maximum(starts, np.ceil(f - 0.5 + inner_radius / cs)),
+                            np.minimum(stops - 1, np.floor(f - 0.5 - inner_radius / cs)))
+        far_row = np.where(south, stops - 1, starts)
+        valid = (south & (near_row < stops)) | (~south & (stops <= f) & (near_row >= starts))
+        back = valid & ~front
+        valid &= front
+        near = np.abs(near_row + 0.5 - f) * cs
+        far = np.abs(far_row + 0.5 - f) * cs
+
+        # On the interpolated surface a block has its full height from the centres of its first row to the centres of
+        # its last row, and slopes down to the street over one cell on either side. The points next to a row inside the
+        # inner radius are left out, so like the cells no point of a block is steeper than the one at near.
+        first_row = np.abs(np.where(south, starts, stops - 1) + 0.5 - f) * cs
+        edge = np.zeros_like(valid)
+        if outer_radius:
+            valid &= near <= outer_radius
+            far = np.minimum(far, outer_radius)
+            if interpolated:
+                edge |= (first_row - cs < outer_radius) & (first_row > outer_radius)
+
+        perpendicular, highest, constant = self._wedge_heights(col, far, tolerance)
+
+        # Windows on the facade of their own block (tower or not), at least 1 m from the ground and the roof
+        own = perpendicular[np.arange(n), block]
+        width = self.rng.uniform(*WINDOW_WIDTH, n)
+        height = self.rng.uniform(*WINDOW_HEIGHT, n)
+        bottom = 1.0 + self.rng.random(n) * np.maximum(own - 2.0 - height, 0)
+        top = bottom + height
+        z_mean = ((top + bottom) / 2)[:, None]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(valid & (perpendicular > z_mean), (perpendicular - z_mean) / near, -np.inf)
+            best = slope.max(axis=1)
+            surface = np.where(valid & (perpendicular - curvature_correction(near) > z_mean),
+                               (perpendicular - curvature_correction(near) - z_mean) / near, -np.inf)
+            surface_best = surface.max(axis=1)
+            bound = np.where(valid & (highest > z_mean) & (highest > perpendicular),
+                             (highest - z_mean) / near, -np.inf).max(axis=1)
+            behind = np.where(back & (highest > z_mean), (highest - z_mean) / near, -np.inf).max(axis=1)
+        if interpolated:
+            best = surface_best
+            # Near the side of a tower a bicubic surface can reach the tower height before its first row, which matters
+            # for the blocks whose towers could be as steep as the analytic OA from there
+            with np.errstate(divide="ignore", invalid="ignore"):
+                reach = (highest - z_mean) / np.maximum(near - cs, inner_radius)
+            edge |= valid & ~constant & (highest > z_mean) & (reach >= best[:, None] - 1e-9)
+        exact = (own >= height + 3.0) & ((bound == -np.inf) | (bound < best - 1e-9)) & ~edge.any(axis=1) & \
+            (behind < (own - z_mean[:, 0]) / (1.5 * cs) - 1e-9)
+
+        x = self.x_min + (col + 0.5) * cs
+        y = self.y_max - facade * cs
+        left, right = x - width / 2, x + width / 2
+        vertices = np.stack([np.stack([left, y, top], axis=1), np.stack([right, y, top], axis=1),
+                             np.stack([right, y, bottom], axis=1), np.stack([left, y, bottom], axis=1)], axis=1)
+        oa = np.where(best > -np.inf, np.degrees(np.arctan(np.maximum(best, 0))), 0.0)
+        return vertices[exact], oa[exact]
+
+    # n_windows windows on the block facades at random positions and horizontal angles, as an (n_windows, 4, 3) array
+    # like windows. Their OA is not known analytically, they test the search directions between the axes, rays that
+    # pass between cell centres and, for a third of the windows, search directions at or near +-180 degrees, where
+    # the search wedges are not wrapped around.
+    def angled_windows(self, n_windows):
+        n = n_windows
+        block = self.rng.integers(0, len(self.block_start), n)
+        north = self.rng.random(n) < 0.5
+        x = self.x_min + self.rng.uniform(0, self.size, n) * self.cell_size
+        y = self.y_max - np.where(north, self.block_start[block], self.block_stop[block]) * self.cell_size
+        angle = np.where(self.rng.random(n) < 1 / 3, self.rng.choice([90.0, -90.0, 87.0, 93.0, -87.0, -93.0], n),
+                         self.rng.uniform(-180, 180, n))
+        width = self.rng.uniform(*WINDOW_WIDTH, n)
+        height = self.rng.uniform(*WINDOW_HEIGHT, n)
+        bottom = 1.0 + self.rng.random(n) * np.maximum(self.block_height[block] - 2.0 - height, 0)
+        top = bottom + height
+
+        dx, dy = width / 2 * np.cos(np.radians(angle)), width / 2 * np.sin(np.radians(angle))
+        return np.stack([np.stack([x - dx, y - dy, top], axis=1), np.stack([x + dx, y + dy, top], axis=1),
+                         np.stack([x + dx, y + dy, bottom], axis=1), np.stack([x - dx, y - dy, bottom], axis=1)],
+                        axis=1)
+
+
+# The DSM and the windows of the BEHIND_BLOCK scene, as a (2, 4, 3) array like CityScene.windows
+def behind_scene():
+    row0, row1, col0, col1, height = BEHIND_BLOCK
+    values = np.zeros((BEHIND_SIZE, BEHIND_SIZE))
+    values[row0:row1, col0:col1] = height
+    dsm = DSMGrid(values, 0.0, BEHIND_SIZE * CELL_SIZE, CELL_SIZE)
+    bottom, top = BEHIND_WINDOW
+    x = (col0 + col1) / 2 * CELL_SIZE
+    vertices = []
+    for row in (row0, row1):
+        y = (BEHIND_SIZE - row) * CELL_SIZE
+        vertices.append([[x - 0.5, y, top], [x + 0.5, y, top], [x + 0.5, y, bottom], [x - 0.5, y, bottom]])
+    return dsm, np.array(vertices)
+
+
+# Run one benchmark case in this process: build the scene, calculate the windows with the NumPy backend (which stands
+# in for the arcpy tools, so the benchmark runs without ArcGIS) and compare the OAs with the analytic ones. The
+# angled windows are compared with search="cells" within the outer radius (MAX_SEARCH_RADIUS if there is none), which
+# keeps the reference quick. The interpolating searches see another surface than "cells", so they are left out there.
+# The windows of behind_scene are run with every search.
+def run_case(scale, search, n_windows, size, tile_size, workers, outer_radius, seed, folder):
+    scene = CityScene(size, seed)
+    # A tiled DSM is searched within MAX_SEARCH_RADIUS when there is no outer radius, so the analytic OAs are too
+    radius = outer_radius or (MAX_SEARCH_RADIUS if tile_size else None)
+    vertices, expected = scene.windows(n_windows, outer_radius=radius, interpolated=search in INTERPOLATIONS)
+    name = "{0}_{1}".format(scale, search)
+    dsm = scene.write_float_grid(os.path.join(folder, name + ".flt")) if tile_size else scene.dsm()
+    trace = os.path.join(folder, name + ".jsonl")
+
+    start = time.perf_counter()
+    results = OAcalc_numpy(list(vertices), dsm, os.path.join(folder, name + ".csv"), outer_radius=radius,
+                           search=search, workers=workers, tile_size=tile_size, profile=trace)
+    wall = time.perf_counter() - start
+    peak_rss = peak_rss_mb()
+
+    stages = {}
+    with open(trace) as f:
+        for line in f:
+            event = json.loads(line)
+            stages[event["stage"]] = stages.get(event["stage"], 0.0) + event["wall_s"]
+    error = np.abs(results.array["OA"] - expected)
+
+    angled_error = np.zeros(0)
+    if search not in INTERPOLATIONS:
+        angled = list(scene.angled_windows(ANGLED_WINDOWS))
+        angled_radius = radius or MAX_SEARCH_RADIUS
+        reference = OAcalc_numpy(angled, dsm, os.path.join(folder, name + "_angled_cells.csv"),
+                                 outer_radius=angled_radius, search="cells", tile_size=tile_size)
+        tested = OAcalc_numpy(angled, dsm, os.path.join(folder, name + "_angled.csv"), outer_radius=angled_radius,
+                              search=search, workers=workers, tile_size=tile_size)
+        angled_error = np.abs(tested.array["OA"] - reference.array["OA"])
+
+    behind_dsm, behind_vertices = behind_scene()
+    behind = OAcalc_numpy(list(behind_vertices), behind_dsm, os.path.join(folder, name + "_behind.csv"),
+                          search=search)
+
+    return {"scale": scale, "search": search, "windows": len(results), "dsm_cells": size, "workers": workers,
+            "wall_s": wall, "windows_per_s": len(results) / wall if wall else None, "stages_s": stages,
+            "peak_rss_mb": peak_rss, "max_oa_error": float(error.max()) if len(error) else 0.0,
+            "wrong_windows": int(np.count_nonzero(error > MAX_OA_ERROR)), "angled_windows": len(angled_error),
+            "angled_max_error": float(angled_error.max()) if len(angled_error) else 0.0,
+            "angled_wrong": int(np.count_nonzero(angled_error > MAX_OA_ERROR)),
+            "behind_oa": float(np.abs(behind.array["OA"]).max())}
+
+
+# Run every case in a fresh process, so the peak memory of one case does not carry over to the next
+def run_benchmark(scales, searches, workers=1, outer_radius=None, seed=0):
+    reports = []
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="oa_benchmark_") as folder:
+        for scale in scales:
+            n_windows, size, tile_size = SCALES[scale]
+            for search in searches:
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    report = pool.submit(run_case, scale, search, n_windows, size, tile_size, workers, outer_radius,
+                                         seed, folder).result()
+                add_message("{0:<8}{1:<10}{2:>8}{3:>8}{4:>10.2f}{5:>12.1f}{6:>10.1f}{7:>12.2e}{8:>7}{9:>9}{10:>12.2e}"
+                            "{11:>8.2f}  {12}".format(scale, search, report["windows"], size, report["wall_s"],
+                                            report["windows_per_s"] or 0, report["peak_rss_mb"] or 0,
+                                            report["max_oa_error"], report["wrong_windows"],
+                                            "{0}/{1}".format(report["angled_wrong"], report["angled_windows"]),
+                                            report["angled_max_error"], report["behind_oa"],
+                                            ", ".join("{0} {1:.2f}s".format(k, v)
+                                                      for k, v in report["stages_s"].items())))
+                reports.append(report)
+    return reports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NumPy backend on synthetic street canyon scenes "
+                                                 "with analytic obstruction angles")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small", "medium"])
+    parser.add_argument("--search", nargs="+", choices=SEARCH_METHODS, default=["index", "raymarch"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--outer-radius", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write the reports to this JSON file")
+    parser.add_argument("--min-rate", type=float, default=None,
+                        help="Fail if any case calculates fewer windows per second")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    add_message("{0:<8}{1:<10}{2:>8}{3:>8}{4:>10}{5:>12}{6:>10}{7:>12}{8:>7}{9:>9}{10:>12}{11:>8}  {12}".format(
+        "Scale", "Search", "Windows", "DSM", "Wall s", "Windows/s", "RSS MB", "Max error", "Wrong", "Angled",
+        "Angled err", "Behind", "Stages"))
+    reports = run_benchmark(args.scales, args.search, args.workers, args.outer_radius, args.seed)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+    failed = [r for r in reports if r["wrong_windows"] or r["behind_oa"] > MAX_OA_ERROR or
+              (args.min_rate and r["windows_per_s"] < args.min_rate) or
+              (r["angled_wrong"] and r["search"] not in APPROXIMATE_SEARCHES)]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
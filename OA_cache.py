@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from OA_dsm import TILE_SIZE, TiledDSM
+
+
+# The path of a file that belongs to an output (<output name><extension>): next to the output file, or next to the
+# geodatabase if the output is a feature class in one
+def sidecar_path(outputPath, extension):
+    folder, name = os.path.split(os.path.abspath(str(outputPath)))
+    if folder.lower().endswith(".gdb"):
+        folder, gdb = os.path.split(folder)
+        name = "{0}_{1}".format(os.path.splitext(gdb)[0], name)
+    return os.path.join(folder, os.path.splitext(name)[0] + extension)
+
+
+# The cache file of an output: a SQLite database next to it
+def cache_path(outputPath):
+    return sidecar_path(outputPath, ".oacache.sqlite")
+
+
+# Content hashes of the tiles of a DSM, computed the first time a tile is needed. A window's cache key includes the
+# hashes of all tiles its search area touches, so an update of one DSM tile only invalidates the windows around it.
+# The hash of a tile also covers its position in the DSM and the location, cell size and NoData value of the DSM, so a
+# DSM that is moved or resampled does not match the results of the old one.
+class DSMFingerprints:
+
+    def __init__(self, dsm):
+        self.dsm = dsm
+        self.tile_size = dsm.tile_size if isinstance(dsm, TiledDSM) else TILE_SIZE
+        self.tiles = {}
+        self._all = None
+
+    def tile(self, tile_row, tile_col):
+        key = (tile_row, tile_col)
+        if key not in self.tiles:
+            r0, c0 = tile_row * self.tile_size, tile_col * self.tile_size
+            block = self.dsm.read(slice(r0, min(r0 + self.tile_size, self.dsm.n_rows)),
+                                  slice(c0, min(c0 + self.tile_size, self.dsm.n_cols)))
+            h = hashlib.blake2b(digest_size=16)
+            h.update(json.dumps([self.dsm.x_min, self.dsm.y_max, self.dsm.cell_size, _to_json(self.dsm.nodata),
+                                 tile_row, tile_col]).encode())
+            h.update(np.ascontiguousarray(block).tobytes())
+            self.tiles[key] = h.hexdigest()
+        return self.tiles[key]
+
+    # The hashes of the tiles within radius of (x, y), or of all tiles if there is no radius
+    def around(self, x, y, radius):
+        if not radius:
+            if self._all is None:
+                self._all = self.box(0, self.dsm.n_rows, 0, self.dsm.n_cols)
+            return self._all
+        rows, cols = self.dsm.window_slices(x - radius, y - radius, x + radius, y + radius)
+        return self.box(rows.start, rows.stop, cols.start, cols.stop)
+
+    def box(self, r0, r1, c0, c1):
+        ts = self.tile_size
+        return [self.tile(tile_row, tile_col) for tile_row in range(r0 // ts, -(-r1 // ts))
+                for tile_col in range(c0 // ts, -(-c1 // ts))]
+
+
+# The cache key of every window: a hash of its vertex coordinates, the search settings and the hashes of the DSM tiles
+# its search area touches
+def window_keys(offsets, coords, geometry, fingerprints, settings):
+    outer_radius = settings.get("outer_radius")
+    settings = json.dumps(settings, sort_keys=True).encode()
+    keys = []
+    for i in range(len(offsets) - 1):
+        h = hashlib.sha256(settings)
+        h.update(np.ascontiguousarray(coords[offsets[i]:offsets[i + 1]], dtype=np.float64).tobytes())
+        for tile_hash in fingerprints.around(geometry.cent_x[i], geometry.cent_y[i], outer_radius):
+            h.update(tile_hash.encode())
+        keys.append(h.hexdigest())
+    return keys
+
+
+# Results of earlier runs, stored in a SQLite database. The rows are stored without their w_id, which is given by the
+# position of the window in the input of the current run. Every run gets a number (the user_version of the database)
+# and every result the number of the last run that used it, so results no run needs any more can be removed.
+class ResultCache:
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, "
+                                    "last_run INTEGER NOT NULL DEFAULT 0)")
+            if "last_run" not in [row[1] for row in self.connection.execute("PRAGMA table_info(results)")]:
+                self.connection.execute("ALTER TABLE results ADD COLUMN last_run INTEGER NOT NULL DEFAULT 0")
+            self.run = self.connection.execute("PRAGMA user_version").fetchone()[0] + 1
+            self.connection.execute("PRAGMA user_version = {0}".format(self.run))
+
+    def get(self, keys):
+        found = {}
+        unique_keys = list(set(keys))
+        with self.connection:
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                query = "SELECT key, result FROM results WHERE key IN ({0})".format(placeholders)
+                for key, result in self.connection.execute(query, batch):
+                    found[key] = tuple(json.loads(result))
+                self.connection.execute("UPDATE results SET last_run = ? WHERE key IN ({0})".format(placeholders),
+                                        [self.run] + batch)
+        return found
+
+    def put(self, items):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO results (key, result, last_run) VALUES (?, ?, ?)",
+                                        [(key, json.dumps(list(result), default=_to_json), self.run)
+                                         for key, result in items])
+
+    # Delete the results this run has not used: those of windows that were edited or removed, or whose DSM tiles were
+    # updated. Only call it after a run that looked up every window. Returns the number of removed results.
+    def prune(self):
+        with self.connection:
+            return self.connection.execute("DELETE FROM results WHERE last_run < ?", (self.run,)).rowcount
+
+    def close(self):
+        self.connection.close()
+
+
+# Results can hold NumPy arrays (the horizon of a window) and NumPy numbers, which are stored as JSON lists and numbers
+def _to_json(value):
+    return value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
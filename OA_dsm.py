@@ -0,0 +1,383 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Default tile size (cells) and number of cached tiles of a TiledDSM
+TILE_SIZE = 512
+TILE_CACHE_SIZE = 64
+
+
+# A digital surface model held in memory as a NumPy array. The grid is north-up: row 0 is the northern edge and column
+# 0 the western edge, and (x_min, y_max) is the upper left corner of the upper left cell.
+class DSMGrid:
+
+    def __init__(self, values, x_min, y_max, cell_size, nodata=None):
+        self.values = np.asarray(values, dtype=np.float64)
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.cell_size = float(cell_size)
+        self.nodata = nodata
+        self.shape = self.values.shape
+        self._max_value = None
+
+        # NoData cells are stored as NaN so they never pass the "higher than the window" comparison
+        if nodata is not None:
+            self.values = np.where(self.values == nodata, np.nan, self.values)
+
+    @property
+    def n_rows(self):
+        return self.shape[0]
+
+    @property
+    def n_cols(self):
+        return self.shape[1]
+
+    @property
+    def x_max(self):
+        return self.x_min + self.n_cols * self.cell_size
+
+    @property
+    def y_min(self):
+        return self.y_max - self.n_rows * self.cell_size
+
+    # X coordinates of the cell centres of the given columns (same location RasterToPoint puts its points)
+    def col_x(self, cols):
+        return self.x_min + (np.asarray(cols) + 0.5) * self.cell_size
+
+    # Y coordinates of the cell centres of the given rows
+    def row_y(self, rows):
+        return self.y_max - (np.asarray(rows) + 0.5) * self.cell_size
+
+    # Row/column slices of the cells whose centres can lie within the box [x0, x1] x [y0, y1]
+    def window_slices(self, x0, y0, x1, y1):
+        c0 = max(int(np.floor((x0 - self.x_min) / self.cell_size)), 0)
+        c1 = min(int(np.ceil((x1 - self.x_min) / self.cell_size)), self.n_cols)
+        r0 = max(int(np.floor((self.y_max - y1) / self.cell_size)), 0)
+        r1 = min(int(np.ceil((self.y_max - y0) / self.cell_size)), self.n_rows)
+        return slice(r0, max(r0, r1)), slice(c0, max(c0, c1))
+
+    # The cell values of a block of the DSM (row and column slices)
+    def read(self, rows, cols):
+        return self.values[rows, cols]
+
+    # The cells whose centres can lie within radius of (x, y), or all cells without a radius. Returns their values and
+    # the x (one row) and y (one column) offsets from the cell centres to (x, y), which broadcast to the block.
+    def around(self, x, y, radius=None):
+        if radius:
+            rows, cols = self.window_slices(x - radius, y - radius, x + radius, y + radius)
+        else:
+            rows, cols = slice(0, self.n_rows), slice(0, self.n_cols)
+        dx = x - self.col_x(np.arange(cols.start, cols.stop))[None, :]
+        dy = y - self.row_y(np.arange(rows.start, rows.stop))[:, None]
+        return self.read(rows, cols), dx, dy
+
+    # The cell values at the given row and column indices
+    def sample(self, rows, cols):
+        return self.values[rows, cols]
+
+    # The highest cell value of the DSM
+    def max_value(self):
+        if self._max_value is None:
+            self._max_value = float(np.nanmax(self.values))
+        return self._max_value
+
+    # The highest cell value within radius of the points (x, y), for an in-memory DSM that of the whole DSM
+    def max_value_around(self, x, y, radius=None):
+        return self.max_value()
+
+
+# A DSM that is read in square tiles from a (memory-mapped) source array instead of being loaded into memory as a
+# whole. source can be anything that can be sliced like a 2D NumPy array, e.g. an np.memmap of a float grid. The last
+# cache_tiles tiles that were used are kept in an LRU cache, and the cache hits and misses are counted so they can be
+# reported at the end of a run.
+class TiledDSM(DSMGrid):
+
+    def __init__(self, source, x_min, y_max, cell_size, nodata=None, tile_size=TILE_SIZE, cache_tiles=TILE_CACHE_SIZE):
+        self.source = source
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.cell_size = float(cell_size)
+        self.nodata = nodata
+        self.shape = tuple(source.shape[:2])
+        self.tile_size = int(tile_size)
+        self.cache_tiles = int(cache_tiles)
+        self.tiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._max_value = None
+        self._tile_max = {}
+
+    @property
+    def n_tile_cols(self):
+        return -(-self.n_cols // self.tile_size)
+
+    # Tile (tile_row, tile_col) as a float64 array with NoData as NaN, from the cache if it is there
+    def tile(self, tile_row, tile_col):
+        key = (tile_row, tile_col)
+        block = self.tiles.get(key)
+        if block is not None:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return block
+
+        self.misses += 1
+        block = self._read_tile(tile_row, tile_col)
+        self.tiles[key] = block
+        if len(self.tiles) > self.cache_tiles:
+            self.tiles.popitem(last=False)
+        return block
+
+    def _read_tile(self, tile_row, tile_col):
+        r0, c0 = tile_row * self.tile_size, tile_col * self.tile_size
+        block = np.array(self.source[r0:r0 + self.tile_size, c0:c0 + self.tile_size], dtype=np.float64)
+        if self.nodata is not None:
+            block[block == self.nodata] = np.nan
+        return block
+
+    def read(self, rows, cols):
+        out = np.empty((rows.stop - rows.start, cols.stop - cols.start), dtype=np.float64)
+        ts = self.tile_size
+        for tile_row in range(rows.start // ts, -(-rows.stop // ts)):
+            r0, r1 = max(rows.start, tile_row * ts), min(rows.stop, (tile_row + 1) * ts)
+            for tile_col in range(cols.start // ts, -(-cols.stop // ts)):
+                c0, c1 = max(cols.start, tile_col * ts), min(cols.stop, (tile_col + 1) * ts)
+                block = self.tile(tile_row, tile_col)
+                out[r0 - rows.start:r1 - rows.start, c0 - cols.start:c1 - cols.start] = \
+                    block[r0 - tile_row * ts:r1 - tile_row * ts, c0 - tile_col * ts:c1 - tile_col * ts]
+        return out
+
+    def sample(self, rows, cols):
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        out = np.empty(rows.shape, dtype=np.float64)
+        ts = self.tile_size
+        tile_ids = (rows // ts) * self.n_tile_cols + cols // ts
+        for tile_id in np.unique(tile_ids):
+            in_tile = tile_ids == tile_id
+            tile_row, tile_col = divmod(int(tile_id), self.n_tile_cols)
+            out[in_tile] = self.tile(tile_row, tile_col)[rows[in_tile] - tile_row * ts, cols[in_tile] - tile_col * ts]
+        return out
+
+    # The highest cell value, found in one pass over the tiles that does not go through the cache
+    def max_value(self):
+        if self._max_value is None:
+            max_value = -np.inf
+            for tile_row in range(-(-self.n_rows // self.tile_size)):
+                for tile_col in range(self.n_tile_cols):
+                    max_value = max(max_value, np.nanmax(self._read_tile(tile_row, tile_col), initial=-np.inf))
+            self._max_value = float(max_value)
+        return self._max_value
+
+    # The highest cell value of the tiles within radius of the points (x, y) (numbers or arrays). Only those tiles are
+    # read, and the maximum of every tile is kept, so the DSM is never scanned as a whole for it.
+    def max_value_around(self, x, y, radius=None):
+        if not radius:
+            return self.max_value()
+        x, y = np.asarray(x), np.asarray(y)
+        rows, cols = self.window_slices(x.min() - radius, y.min() - radius, x.max() + radius, y.max() + radius)
+        ts = self.tile_size
+        max_value = -np.inf
+        for tile_row in range(rows.start // ts, -(-rows.stop // ts)):
+            for tile_col in range(cols.start // ts, -(-cols.stop // ts)):
+                key = (tile_row, tile_col)
+                if key not in self._tile_max:
+                    self._tile_max[key] = float(np.nanmax(self.tile(tile_row, tile_col), initial=-np.inf))
+                max_value = max(max_value, self._tile_max[key])
+        return max_value
+
+
+# Parse the "key value" header lines of an ESRI ASCII grid or float grid (.hdr) file. Returns the header as a dict
+# (lower case keys) and the number of header lines.
+def read_grid_header(lines):
+    header = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) != 2 or not parts[0][0].isalpha():
+            break
+        header[parts[0].lower()] = parts[1]
+    return header, len(header)
+
+
+# The upper left corner of an ESRI grid from its header. Both the xllcorner/yllcorner and the xllcenter/yllcenter
+# variants are handled.
+def grid_origin(header):
+    n_rows = int(header["nrows"])
+    cell_size = float(header["cellsize"])
+    if "xllcenter" in header:
+        x_min = float(header["xllcenter"]) - cell_size / 2
+        y_min = float(header["yllcenter"]) - cell_size / 2
+    else:
+        x_min = float(header["xllcorner"])
+        y_min = float(header["yllcorner"])
+    return x_min, y_min + n_rows * cell_size, cell_size
+
+
+def grid_nodata(header):
+    return float(header["nodata_value"]) if "nodata_value" in header else None
+
+
+# Read an ESRI ASCII grid (.asc)
+def read_ascii_grid(path):
+    with open(path) as f:
+        lines = f.readlines()
+    header, n_header = read_grid_header(lines)
+    values = np.loadtxt(lines[n_header:], dtype=np.float64, ndmin=2)
+    values = values.reshape(int(header["nrows"]), int(header["ncols"]))
+    x_min, y_max, cell_size = grid_origin(header)
+    return DSMGrid(values, x_min, y_max, cell_size, grid_nodata(header))
+
+
+# Open an ESRI float grid (.flt with a .hdr header file) as a memory-mapped TiledDSM. Only the tiles that are used are
+# read from disk, so the DSM can be much larger than the available memory.
+def open_float_grid(path, tile_size=TILE_SIZE, cache_tiles=TILE_CACHE_SIZE):
+    with open(os.path.splitext(path)[0] + ".hdr") as f:
+        header, n_header = read_grid_header(f.readlines())
+    byteorder = ">" if header.get("byteorder", "LSBFIRST").upper() == "MSBFIRST" else "<"
+    source = np.memmap(path, dtype=byteorder + "f4", mode="r", shape=(int(header["nrows"]), int(header["ncols"])))
+    x_min, y_max, cell_size = grid_origin(header)
+    return TiledDSM(source, x_min, y_max, cell_size, grid_nodata(header), tile_size, cache_tiles)
+
+
+# Read a GeoTIFF. rasterio is only needed for this format, so it is imported here and not at the top of the module.
+def read_geotiff(path):
+    try:
+        import rasterio
+    except ImportError:
+        raise ImportError("Reading GeoTIFF DSMs without arcpy requires the rasterio package")
+
+    with rasterio.open(path) as src:
+        transform = src.transform
+        if transform.b != 0 or transform.d != 0 or transform.a != -transform.e:
+            raise ValueError("Only north-up DSMs with square cells are supported: {0}".format(path))
+        return DSMGrid(src.read(1), transform.c, transform.f, transform.a, src.nodata)
+
+
+# Read any raster arcpy can open (file geodatabase rasters, .tif, .img, ...)
+def read_arcpy_raster(path):
+    try:
+        import arcpy
+    except ImportError:
+        raise ImportError("Reading {0} requires arcpy (or rasterio for a GeoTIFF DSM)".format(path))
+
+    raster = arcpy.Raster(path)
+    values = arcpy.RasterToNumPyArray(raster, nodata_to_value=np.nan).astype(np.float64)
+    return DSMGrid(values, raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth)
+
+
+# Slices a GeoTIFF like a 2D array by reading only the requested window, so it can be the source of a TiledDSM
+class GeoTIFFSource:
+
+    def __init__(self, src):
+        self.src = src
+        self.shape = (src.height, src.width)
+
+    def __getitem__(self, index):
+        import rasterio.windows
+
+        rows, cols = index
+        r0, r1, _ = rows.indices(self.shape[0])
+        c0, c1, _ = cols.indices(self.shape[1])
+        return self.src.read(1, window=rasterio.windows.Window(c0, r0, c1 - c0, r1 - r0))
+
+
+def open_tiled_geotiff(path, tile_size=TILE_SIZE, cache_tiles=TILE_CACHE_SIZE):
+    try:
+        import rasterio
+    except ImportError:
+        raise ImportError("Reading GeoTIFF DSMs without arcpy requires the rasterio package")
+
+    src = rasterio.open(path)
+    transform = src.transform
+    if transform.b != 0 or transform.d != 0 or transform.a != -transform.e:
+        raise ValueError("Only north-up DSMs with square cells are supported: {0}".format(path))
+    return TiledDSM(GeoTIFFSource(src), transform.c, transform.f, transform.a, src.nodata, tile_size, cache_tiles)
+
+
+# Slices any raster arcpy can open like a 2D array, reading only the requested block with RasterToNumPyArray
+class ArcpyRasterSource:
+
+    def __init__(self, raster):
+        self.raster = raster
+        self.shape = (raster.height, raster.width)
+
+    def __getitem__(self, index):
+        import arcpy
+
+        rows, cols = index
+        r0, r1, _ = rows.indices(self.shape[0])
+        c0, c1, _ = cols.indices(self.shape[1])
+        cell_size = self.raster.meanCellWidth
+        lower_left = arcpy.Point(self.raster.extent.XMin + c0 * cell_size, self.raster.extent.YMax - r1 * cell_size)
+        return arcpy.RasterToNumPyArray(self.raster, lower_left, c1 - c0, r1 - r0, nodata_to_value=np.nan)
+
+
+def open_tiled_arcpy_raster(path, tile_size=TILE_SIZE, cache_tiles=TILE_CACHE_SIZE):
+    try:
+        import arcpy
+    except ImportError:
+        raise ImportError("Reading {0} requires arcpy (or rasterio for a GeoTIFF DSM)".format(path))
+
+    raster = arcpy.Raster(path)
+    return TiledDSM(ArcpyRasterSource(raster), raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth,
+                    tile_size=tile_size, cache_tiles=cache_tiles)
+
+
+# Load a DSM from a path, choosing the reader from the file extension. Rasters in formats without a NumPy reader are
+# read through arcpy. With a tile_size the DSM is opened as a TiledDSM: float grids (.flt) are memory-mapped,
+# GeoTIFFs and arcpy rasters are read tile by tile and ASCII grids are loaded into memory and then tiled.
+def load_dsm(path, tile_size=None, cache_tiles=TILE_CACHE_SIZE):
+    if isinstance(path, TiledDSM) or (isinstance(path, DSMGrid) and not tile_size):
+        return path
+    if isinstance(path, DSMGrid):
+        return TiledDSM(path.values, path.x_min, path.y_max, path.cell_size, None, tile_size, cache_tiles)
+
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext == ".flt":
+        return open_float_grid(path, tile_size or TILE_SIZE, cache_tiles)
+    if tile_size and ext in (".tif", ".tiff"):
+        try:
+            return open_tiled_geotiff(path, tile_size, cache_tiles)
+        except ImportError:
+            return open_tiled_arcpy_raster(path, tile_size, cache_tiles)
+    if tile_size and ext not in (".asc", ".txt"):
+        return open_tiled_arcpy_raster(path, tile_size, cache_tiles)
+
+    if ext in (".asc", ".txt"):
+        return load_dsm(read_ascii_grid(path), tile_size, cache_tiles)
+    if ext in (".tif", ".tiff"):
+        try:
+            return read_geotiff(path)
+        except ImportError:
+            pass
+    return read_arcpy_raster(path)
+
+
+# The extent (x_min, y_min, x_max, y_max) and cell size of a DSM, read from its header without reading the cell values
+def read_dsm_extent(path):
+    if isinstance(path, DSMGrid):
+        return path.x_min, path.y_min, path.x_max, path.y_max, path.cell_size
+
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext in (".asc", ".txt", ".flt"):
+        with open(os.path.splitext(path)[0] + ".hdr" if ext == ".flt" else path) as f:
+            header, _ = read_grid_header(f)
+        x_min, y_max, cell_size = grid_origin(header)
+        return (x_min, y_max - int(header["nrows"]) * cell_size, x_min + int(header["ncols"]) * cell_size, y_max,
+                cell_size)
+    if ext in (".tif", ".tiff"):
+        try:
+            import rasterio
+        except ImportError:
+            pass
+        else:
+            with rasterio.open(path) as src:
+                return src.bounds.left, src.bounds.bottom, src.bounds.right, src.bounds.top, src.res[0]
+
+    try:
+        import arcpy
+    except ImportError:
+        raise ImportError("Reading {0} requires arcpy (or rasterio for a GeoTIFF DSM)".format(path))
+    description = arcpy.Describe(path)
+    extent = description.extent
+    return extent.XMin, extent.YMin, extent.XMax, extent.YMax, description.meanCellWidth
@@ -0,0 +1,407 @@
+import csv
+import json
+import os
+import numpy as np
+
+from OA_cache import DSMFingerprints, ResultCache, cache_path, window_keys
+from OA_dsm import TILE_SIZE, TiledDSM, load_dsm
+from OA_geometry import batch_window_geometry, in_search_wedge, pack_windows, z_order
+from OA_horizon import HorizonStore, facing_direction, horizon_path, sweep_sectors, window_horizon
+from OA_index import ObstructionIndex
+from OA_interpolate import INTERPOLATIONS, batch_oa_interpolated
+from OA_log import add_message
+from OA_parallel import chunk_ranges, process_pool, run_chunks
+from OA_profile import Profiler
+from OA_raymarch import RAY_COUNT, window_oa_raymarch
+from OA_results import RESULT_FIELDS, ResultTable
+from OA_visibility import WindowSight
+
+# Same defaults as the Viewshed2 / Select Layer By Attribute settings used by the arcpy backend
+INNER_RADIUS = 16.0
+SEARCH_TOLERANCE = 5.0
+
+# Outer radius used with a tiled DSM when none is given, so every window only reads the tiles around it
+MAX_SEARCH_RADIUS = 500.0
+
+# How the DSM is searched for obstructions: "cells" looks at every DSM cell within the outer radius, "raymarch" only
+# samples the DSM along a fan of rays inside the search wedges and "index" queries an ObstructionIndex of the DSM that
+# is built once for all windows. "bilinear" and "bicubic" are the high accuracy searches: they interpolate the DSM
+# along the rays of all windows of a batch at once, with the earth curvature and refraction correction.
+SEARCH_METHODS = ("cells", "raymarch", "index") + INTERPOLATIONS
+
+# Windows of a tiled DSM that are searched together by the interpolating searches, so that the tiles they read stay
+# in the tile cache
+TILED_WINDOW_BLOCK = 64
+
+
+# Find the highest obstruction angle for one window. Only DSM cells higher than the window, at least inner_radius
+# metres away (2D) and within the +- tolerance wedge around one of the two search directions are considered, as in
+# the arcpy backend. Instead of the whole viewshed only the lines of sight of the steepest of these cells are checked,
+# down to the first one that is not hidden by a steeper cell on the way to it. The cells inside the inner radius can
+# hide the ones behind them, so the window's own building hides everything behind its facade.
+# cells are the values and offsets of DSMGrid.around, if they have been read already.
+# Returns (OA, Distance, grid_code). If there are no obstruction cells, OA is 0 and Distance/grid_code are None.
+def window_oa(dsm, cent_x, cent_y, z_mean, dir_low, dir_high, inner_radius=INNER_RADIUS, outer_radius=None,
+              tolerance=SEARCH_TOLERANCE, cells=None):
+
+    # Only the part of the DSM that can lie within the outer radius has to be read
+    values, dx, dy = cells if cells is not None else dsm.around(cent_x, cent_y, outer_radius)
+    distance = np.hypot(dx, dy)
+
+    # Near: angle from the obstruction cell to the window centre
+    near_angle = np.degrees(np.arctan2(dy, dx))
+
+    with np.errstate(invalid="ignore"):
+        mask = (values > z_mean) & (distance >= inner_radius)
+        if outer_radius:
+            mask &= distance <= outer_radius
+        mask &= in_search_wedge(near_angle, dir_low, dir_high, tolerance)
+
+    if not mask.any():
+        return 0.0, None, None
+
+    heights = values[mask]
+    distances = distance[mask]
+    best = WindowSight(dsm, cent_x, cent_y, z_mean, inner_radius).steepest_visible(
+        (heights - z_mean) / distances, cent_x - np.broadcast_to(dx, mask.shape)[mask],
+        cent_y - np.broadcast_to(dy, mask.shape)[mask])
+    if best is None:
+        return 0.0, None, None
+    oa = np.degrees(np.arctan((heights[best] - z_mean) / distances[best]))
+    return float(oa), float(distances[best]), float(heights[best])
+
+
+# The outer radius actually used for a DSM: a tiled DSM is never searched as a whole
+def search_radius(dsm, outer_radius):
+    if isinstance(dsm, TiledDSM) and not outer_radius:
+        return MAX_SEARCH_RADIUS
+    return outer_radius
+
+
+# The ObstructionIndex for search="index" of windows (each an (n, 3) vertex array, or anything that reshapes to one).
+# Only cells higher than the lowest window can be obstructions, so the index leaves all others out. index (e.g. from
+# an earlier batch) is returned if it holds all cells above the lowest window, otherwise a new one is built.
+def obstruction_index(dsm, window_vertices, index=None, profiler=None):
+    if not len(window_vertices):
+        return index
+    z_min = min(float(np.asarray(vertices, dtype=np.float64).reshape(-1, 3)[:, 2].mean())
+                for vertices in window_vertices)
+    if index is None or index.min_height > z_min:
+        with (profiler or Profiler()).stage("index build") as stage:
+            index = ObstructionIndex(dsm, min_height=z_min)
+            stage["rows"] = len(index)
+    return index
+
+
+# Calculate the OA of a sequence of windows (each an (n, 3) vertex array) against a DSM. Returns a ResultTable with one
+# row per window, in the order of the windows. window_ids are the w_id of the windows (1, 2, ... by default).
+# With a tile_size the DSM is read as a TiledDSM and every window only reads the tiles within its outer radius
+# (MAX_SEARCH_RADIUS if there is none). The stages are recorded by profiler, if there is one.
+# With a horizon_step the table also holds the horizon of every window (see window_horizon): its facing direction and
+# the angles and distances of the sectors of horizon_step degrees.
+def calculate_windows(window_vertices, dsm, inner_radius=INNER_RADIUS, outer_radius=None,
+                      tolerance=SEARCH_TOLERANCE, search="cells", ray_count=RAY_COUNT, window_ids=None,
+                      tile_size=None, profiler=None, index=None, horizon_step=None):
+    profiler = profiler or Profiler()
+    if search not in SEARCH_METHODS:
+        raise ValueError("Unknown search method {0}, use one of {1}".format(search, ", ".join(SEARCH_METHODS)))
+    dsm = load_dsm(dsm, tile_size)
+    tiled = isinstance(dsm, TiledDSM)
+    outer_radius = search_radius(dsm, outer_radius)
+
+    # The geometry of all windows is found in one pass before the DSM is searched
+    window_vertices = list(window_vertices)
+    with profiler.stage("geometry") as stage:
+        geometry = batch_window_geometry(*pack_windows(window_vertices))
+        stage["rows"] = len(geometry)
+    if window_ids is None:
+        window_ids = range(1, len(geometry) + 1)
+
+    # The geometry columns are filled for all windows at once, the search fills in the obstruction of every window
+    results = ResultTable(len(geometry), sweep_sectors(horizon_step) if horizon_step else None)
+    table = results.array
+    table["w_id"] = window_ids
+    table["cent_long_x"], table["cent_lat_y"], table["Z_Mean"] = geometry.cent_x, geometry.cent_y, geometry.z_mean
+    table["Search_dir_low"], table["Search_dir_high"] = geometry.dir_low, geometry.dir_high
+
+    # The windows are visited in Z-order, so windows close to each other read the same DSM tiles one after another.
+    # The results are still returned in w_id order.
+    order = z_order(geometry.cent_x, geometry.cent_y, dsm.cell_size * (dsm.tile_size if tiled else TILE_SIZE))
+
+    if search == "index":
+        index = obstruction_index(dsm, window_vertices, index, profiler)
+
+    # The interpolating searches find the obstructions of all windows (or blocks of windows in Z-order) at once. They
+    # and the raymarch search stop at the highest DSM cell around the windows, which for a tiled DSM is only looked
+    # for in the tiles within the outer radius.
+    if search in INTERPOLATIONS:
+        block = TILED_WINDOW_BLOCK if tiled else max(len(order), 1)
+        for start in range(0, len(order), block):
+            with profiler.stage("obstruction search") as stage:
+                windows = order[start:start + block]
+                table["OA"][windows], table["Distance"][windows], table["grid_code"][windows] = batch_oa_interpolated(
+                    dsm, geometry.cent_x[windows], geometry.cent_y[windows], geometry.z_mean[windows],
+                    geometry.dir_low[windows], geometry.dir_high[windows], inner_radius, outer_radius, tolerance,
+                    ray_count, search,
+                    dsm_max=dsm.max_value_around(geometry.cent_x[windows], geometry.cent_y[windows], outer_radius))
+                stage["rows"] = int(np.count_nonzero(~np.isnan(table["Distance"][windows])))
+
+    # The other searches and the horizon sweep go through the windows one at a time
+    for i in order if search not in INTERPOLATIONS or horizon_step else ():
+        cent_x, cent_y, z_mean = float(geometry.cent_x[i]), float(geometry.cent_y[i]), float(geometry.z_mean[i])
+        dir_low, dir_high = float(geometry.dir_low[i]), float(geometry.dir_high[i])
+        # The horizon sweep reads all cells within the outer radius, the "cells" search uses the same ones
+        cells = dsm.around(cent_x, cent_y, outer_radius) if horizon_step else None
+        if search not in INTERPOLATIONS:
+            profiler.begin("obstruction search", int(window_ids[i]))
+            if search == "raymarch":
+                oa, distance, grid_code = window_oa_raymarch(dsm, cent_x, cent_y, z_mean, dir_low, dir_high,
+                                                             inner_radius, outer_radius, tolerance, ray_count,
+                                                             dsm_max=dsm.max_value_around(cent_x, cent_y,
+                                                                                          outer_radius))
+            elif search == "index":
+                oa, distance, grid_code = index.max_obstruction(dsm, cent_x, cent_y, z_mean, dir_low, dir_high,
+                                                                inner_radius, outer_radius, tolerance)
+            else:
+                oa, distance, grid_code = window_oa(dsm, cent_x, cent_y, z_mean, dir_low, dir_high, inner_radius,
+                                                    outer_radius, tolerance, cells)
+            table["OA"][i] = oa
+            if distance is not None:
+                table["Distance"][i], table["grid_code"][i] = distance, grid_code
+            profiler.end(rows=0 if distance is None else 1)
+
+        if horizon_step:
+            profiler.begin("horizon sweep", int(window_ids[i]))
+            facing = facing_direction(dsm, cent_x, cent_y, dir_low, dir_high)
+            table["facing"][i] = facing
+            table["angles"][i], table["distances"][i] = window_horizon(dsm, cent_x, cent_y, z_mean, facing,
+                                                                       inner_radius, outer_radius, horizon_step, cells)
+            profiler.end(rows=results.horizon_sectors)
+
+    if tiled:
+        add_message("DSM tiles: {0} hits, {1} misses".format(dsm.hits, dsm.misses))
+    return results
+
+
+# The DSM and ObstructionIndex of a worker process of a windows_pool, kept for all the chunks it calculates
+_worker = {}
+
+
+def _init_worker(dsm, tile_size):
+    _worker["dsm"] = load_dsm(dsm, tile_size)
+    _worker["index"] = None
+
+
+# calculate_windows in a worker process, with the DSM it loaded when it started. For search="index" the index of the
+# worker is built for the first chunk and only built again for a chunk with a lower window.
+def _calculate_worker_chunk(window_vertices, inner_radius, outer_radius, tolerance, search, ray_count, window_ids,
+                            profiler, horizon_step):
+    dsm, index = _worker["dsm"], _worker["index"]
+    if search == "index":
+        index = _worker["index"] = obstruction_index(dsm, window_vertices, index, profiler)
+    return calculate_windows(window_vertices, dsm, inner_radius, outer_radius, tolerance, search, ray_count,
+                             window_ids, profiler=profiler, index=index, horizon_step=horizon_step)
+
+
+# A pool of worker processes for calculate_windows_parallel that can be kept for a whole run. Every worker loads the DSM
+# (a path, or a DSMGrid that is sent to it once) when it starts, instead of for every batch.
+def windows_pool(dsm, workers, tile_size=None):
+    return process_pool(workers, _init_worker, (dsm, tile_size))
+
+
+# calculate_windows split over a pool of worker processes (a windows_pool, or one for this call only). Every worker
+# gets one contiguous chunk of windows. The results are merged in w_id order, so they are identical to a serial run.
+def calculate_windows_parallel(window_vertices, dsm, workers, inner_radius=INNER_RADIUS, outer_radius=None,
+                               tolerance=SEARCH_TOLERANCE, search="cells", ray_count=RAY_COUNT, window_ids=None,
+                               tile_size=None, profiler=None, horizon_step=None, pool=None):
+    if window_ids is None:
+        window_ids = range(1, len(window_vertices) + 1)
+    chunks = [(window_vertices[start:stop], inner_radius, outer_radius, tolerance, search, ray_count,
+               list(window_ids[start:stop]), profiler, horizon_step)
+              for start, stop in chunk_ranges(len(window_vertices), workers)]
+    if pool is not None:
+        return run_chunks(_calculate_worker_chunk, chunks, workers, ResultTable.concatenate, pool).sorted()
+    with windows_pool(dsm, workers, tile_size) as pool:
+        return run_chunks(_calculate_worker_chunk, chunks, workers, ResultTable.concatenate, pool).sorted()
+
+
+# Read the vertices of every multipatch in a feature class, in SearchCursor order
+def read_multipatch_vertices(windows):
+    import arcpy
+
+    with arcpy.da.SearchCursor(windows, ["SHAPE@"]) as cursor:
+        for row in cursor:
+            yield np.array([[p.X, p.Y, p.Z] for part in row[0] for p in part if p is not None], dtype=np.float64)
+
+
+# Read window vertices from a CSV file with the columns w_id, x, y, z. Rows with the same w_id make up one window and
+# have to follow each other, so every window is returned as soon as its last row has been read and the file is never
+# held in memory as a whole.
+def read_vertex_csv(path):
+    seen = set()
+    w_id, vertices = None, []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            if row["w_id"] != w_id:
+                if vertices:
+                    yield np.array(vertices, dtype=np.float64)
+                if row["w_id"] in seen:
+                    raise ValueError("The rows of window {0} in {1} are not consecutive".format(row["w_id"], path))
+                w_id, vertices = row["w_id"], []
+                seen.add(w_id)
+            vertices.append((float(row["x"]), float(row["y"]), float(row["z"])))
+    if vertices:
+        yield np.array(vertices, dtype=np.float64)
+
+
+# All (x, y, z) positions of a GeoJSON geometry, in the order they appear in its coordinates
+def geojson_vertices(geometry):
+    if geometry["type"] == "GeometryCollection":
+        return [p for part in geometry["geometries"] for p in geojson_vertices(part)]
+    positions = []
+    stack = [geometry["coordinates"]]
+    while stack:
+        item = stack.pop()
+        if item and isinstance(item[0], (int, float)):
+            if len(item) < 3:
+                raise ValueError("GeoJSON window vertices need a z coordinate")
+            positions.append(item[:3])
+        else:
+            stack.extend(reversed(item))
+    return positions
+
+
+# Read window vertices from a GeoJSON file, one window per feature with 3D coordinates. A FeatureCollection is read as
+# a whole, newline-delimited GeoJSON (one feature per line, .geojsonl/.geojsons) is read one feature at a time.
+def read_vertex_geojson(path):
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in (".geojson", ".json"):
+            data = json.load(f)
+            features = data["features"] if data.get("type") == "FeatureCollection" else [data]
+        else:
+            features = (json.loads(line.strip("\x1e \r\n")) for line in f if line.strip("\x1e \r\n"))
+        for feature in features:
+            yield np.array(geojson_vertices(feature["geometry"]), dtype=np.float64)
+
+
+# Read windows from any of the supported inputs: a CSV or GeoJSON vertex file, a list of vertex arrays or a
+# multipatch feature class. The windows are read one at a time.
+def read_windows(windows):
+    if not isinstance(windows, str):
+        return iter(windows)
+    ext = os.path.splitext(windows)[1].lower()
+    if ext == ".csv":
+        return read_vertex_csv(windows)
+    if ext in (".geojson", ".json", ".geojsonl", ".geojsons"):
+        return read_vertex_geojson(windows)
+    return read_multipatch_vertices(windows)
+
+
+# Create the (empty) output point feature class with the RESULT_FIELDS columns
+def create_results_featureclass(outputPath, spatial_ref):
+    import arcpy
+
+    arcpy.management.CreateFeatureclass(out_path=os.path.dirname(outputPath), out_name=os.path.basename(outputPath),
+                                        geometry_type="POINT", has_z="ENABLED", spatial_reference=spatial_ref)
+    arcpy.management.AddFields(in_table=outputPath,
+                               field_description=[["w_id", "LONG", "", "", "", ""]] +
+                                                 [[name, "DOUBLE", "", "", "", ""] for name in RESULT_FIELDS[1:]])
+
+
+# The spatial reference of the windows if they are a feature class, otherwise None
+def windows_spatial_reference(windows):
+    if not isinstance(windows, str) or os.path.splitext(windows)[1].lower() in (
+            ".csv", ".geojson", ".json", ".geojsonl", ".geojsons"):
+        return None
+    import arcpy
+
+    return arcpy.Describe(windows).spatialReference
+
+
+# The NumPy backend of OAcalc. windows can be a multipatch feature class, a CSV or GeoJSON vertex file or a list of
+# vertex arrays, DSM a raster path or a DSMGrid. Output is a CSV file when outputPath ends with .csv, a GeoParquet file
+# when it ends with .parquet, otherwise a point feature class (which needs arcpy). With cache=True the results are
+# also stored in a SQLite file next to the output, and windows whose vertices, settings and surrounding DSM tiles have
+# not changed since an earlier run are taken from it instead of being recalculated. profile is the path of a JSON
+# lines trace of the stages of the run. With a horizon_step the horizon of every window is also swept in sectors of
+# that many degrees and written to a HorizonStore next to the output. Returns the ResultTable of the windows.
+def OAcalc_numpy(windows, DSM, outputPath, inner_radius=INNER_RADIUS, outer_radius=None,
+                 tolerance=SEARCH_TOLERANCE, search="cells", ray_count=RAY_COUNT, workers=1, tile_size=None,
+                 cache=False, profile=None, horizon_step=None):
+    profiler = Profiler(profile)
+    window_vertices = list(read_windows(windows))
+    window_ids = list(range(1, len(window_vertices) + 1))
+    # Worker processes open the DSM themselves, so it is only opened here if it is needed in this process
+    dsm = DSM if workers > 1 and not cache else load_dsm(DSM, tile_size)
+
+    resultCache = ResultCache(cache_path(outputPath)) if cache else None
+    results = calculate_batch(window_vertices, window_ids, dsm if workers == 1 else DSM, inner_radius, outer_radius,
+                              tolerance, search, ray_count, workers, tile_size, resultCache,
+                              DSMFingerprints(dsm) if cache else None, profiler=profiler, horizon_step=horizon_step)
+    if cache:
+        add_message("Result cache: {0} results no longer used removed".format(resultCache.prune()))
+        resultCache.close()
+
+    with profiler.stage("write") as stage:
+        write_results(results, outputPath, windows)
+        if horizon_step:
+            horizons = HorizonStore(horizon_path(outputPath), horizon_step)
+            horizons.put(results)
+            horizons.close()
+        stage["rows"] = len(results)
+    profiler.summary()
+    return results
+
+
+# Calculate one batch of windows with the ids window_ids. With a ResultCache the windows found in it are taken from
+# it and only the others are calculated and added to it (fingerprints are the DSMFingerprints of the DSM). index is an
+# ObstructionIndex to reuse for search="index", pool a windows_pool to use with workers. Returns a ResultTable in w_id
+# order (with the horizon of every window if there is a horizon_step, see calculate_windows).
+def calculate_batch(window_vertices, window_ids, dsm, inner_radius=INNER_RADIUS, outer_radius=None,
+                    tolerance=SEARCH_TOLERANCE, search="cells", ray_count=RAY_COUNT, workers=1, tile_size=None,
+                    resultCache=None, fingerprints=None, index=None, profiler=None, horizon_step=None, pool=None):
+    profiler = profiler or Profiler()
+    horizon_sectors = sweep_sectors(horizon_step) if horizon_step else None
+    results = ResultTable(0, horizon_sectors)
+    if resultCache is not None:
+        profiler.begin("cache lookup")
+        offsets, coords = pack_windows(window_vertices)
+        settings = {"inner_radius": inner_radius, "outer_radius": search_radius(fingerprints.dsm, outer_radius),
+                    "tolerance": tolerance, "search": search,
+                    "ray_count": ray_count if search in ("raymarch",) + INTERPOLATIONS else None}
+        if horizon_step:
+            settings["horizon_step"] = horizon_step
+        keys = window_keys(offsets, coords, batch_window_geometry(offsets, coords), fingerprints, settings)
+        cached = resultCache.get(keys)
+
+        # Cached windows get the w_id of this run, only the other ones are calculated
+        results = ResultTable.from_rows([(window_ids[i],) + cached[key] for i, key in enumerate(keys) if key in cached],
+                                        horizon_sectors)
+        dirty = [i for i, key in enumerate(keys) if key not in cached]
+        window_keys_by_id = {window_ids[i]: keys[i] for i in dirty}
+        window_vertices = [window_vertices[i] for i in dirty]
+        window_ids = [window_ids[i] for i in dirty]
+        add_message("Result cache: {0} windows from cache, {1} recalculated".format(len(results), len(dirty)))
+        profiler.end(rows=len(results))
+
+    calculated = ResultTable(0, horizon_sectors)
+    if window_vertices:
+        if workers > 1:
+            # The workers open the DSM themselves if it is a path
+            calculated = calculate_windows_parallel(window_vertices, dsm, workers, inner_radius, outer_radius,
+                                                    tolerance, search, ray_count, window_ids, tile_size, profiler,
+                                                    horizon_step, pool)
+        else:
+            calculated = calculate_windows(window_vertices, dsm, inner_radius, outer_radius, tolerance, search,
+                                           ray_count, window_ids, profiler=profiler, index=index,
+                                           horizon_step=horizon_step)
+    if resultCache is not None:
+        resultCache.put((window_keys_by_id[row[0]], row[1:]) for row in calculated.rows())
+    return ResultTable.concatenate([results, calculated], horizon_sectors).sorted()
+
+
+# Write a ResultTable to a CSV file if outputPath ends with .csv, a GeoParquet file if it ends with .parquet, otherwise
+# to a point feature class with the coordinate system of the input windows
+def write_results(results, outputPath, windows=None):
+    ext = os.path.splitext(str(outputPath))[1].lower()
+    results.write(outputPath, windows_spatial_reference(windows) if ext not in (".csv", ".parquet") else None)
@@ -0,0 +1,131 @@
+import numpy as np
+
+
+# The Opposite() code block of the arcpy backend. Turns the horizontal angle between the two top vertices of a window
+# into the search direction, using the NEAR_ANGLE convention: north is -90 degrees, east is +- 180, south is 90,
+# west is 0.
+def opposite(near_ang_h):
+    near_ang_h = np.asarray(near_ang_h, dtype=np.float64)
+    return np.where(near_ang_h <= 0, near_ang_h + 90,
+                    np.where(near_ang_h >= 90, -180 + near_ang_h - 90, near_ang_h + 90))
+
+
+# Pack a sequence of (n, 3) window vertex arrays into one ragged array: window i has the vertices
+# coords[offsets[i]:offsets[i + 1]].
+def pack_windows(window_vertices):
+    window_vertices = [np.asarray(v, dtype=np.float64).reshape(-1, 3) for v in window_vertices]
+    offsets = np.zeros(len(window_vertices) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(v) for v in window_vertices])
+    coords = np.concatenate(window_vertices) if window_vertices else np.empty((0, 3), dtype=np.float64)
+    return offsets, coords
+
+
+# The geometry of every window in a ragged vertex array, computed in a few array passes instead of one chain of
+# geoprocessing tools per window. Each field is an array with one value (or row) per window.
+class WindowGeometry:
+
+    def __init__(self, cent_x, cent_y, z_mean, top_first, top_second, azimuth, dir_low, dir_high):
+        self.cent_x = cent_x
+        self.cent_y = cent_y
+        self.z_mean = z_mean
+        self.top_first = top_first
+        self.top_second = top_second
+        self.azimuth = azimuth
+        self.dir_low = dir_low
+        self.dir_high = dir_high
+
+    def __len__(self):
+        return len(self.cent_x)
+
+
+def batch_window_geometry(offsets, coords):
+    offsets = np.asarray(offsets, dtype=np.int64)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    n_windows = len(offsets) - 1
+    counts = np.diff(offsets)
+    if np.any(counts < 2):
+        raise ValueError("Window {0} has fewer than two vertices".format(int(np.argmax(counts < 2)) + 1))
+
+    # The window each vertex belongs to
+    win = np.repeat(np.arange(n_windows), counts)
+    x, y, z = coords[:, 0], coords[:, 1], coords[:, 2]
+
+    ### Centroid (Points To Line + Calculate Geometry Attributes + Add Z Information) ###
+    # The centroid of the (not closed) line through all vertices of a window is the length weighted mean of the
+    # segment midpoints. Segments only connect consecutive vertices of the same window.
+    seg = np.flatnonzero(win[:-1] == win[1:])
+    seg_win = win[seg]
+    seg_len = np.hypot(x[seg + 1] - x[seg], y[seg + 1] - y[seg])
+    length = np.bincount(seg_win, weights=seg_len, minlength=n_windows)
+    sum_x = np.bincount(seg_win, weights=seg_len * (x[seg] + x[seg + 1]) / 2, minlength=n_windows)
+    sum_y = np.bincount(seg_win, weights=seg_len * (y[seg] + y[seg + 1]) / 2, minlength=n_windows)
+
+    # Windows without any horizontal extent fall back to the mean vertex location
+    mean_x = np.bincount(win, weights=x, minlength=n_windows) / counts
+    mean_y = np.bincount(win, weights=y, minlength=n_windows) / counts
+    has_length = length > 0
+    safe_length = np.where(has_length, length, 1)
+    cent_x = np.where(has_length, sum_x / safe_length, mean_x)
+    cent_y = np.where(has_length, sum_y / safe_length, mean_y)
+    z_mean = np.bincount(win, weights=z, minlength=n_windows) / counts
+
+    ### Top edge vertex pair ###
+    # Vertices above the mean (integer) vertex height of their window, in vertex order (OBJECTID 1 and 2). Windows
+    # with fewer than two of them use all their vertices, highest first.
+    z_int_mean = np.bincount(win, weights=np.trunc(z), minlength=n_windows) / counts
+    top = z > z_int_mean[win]
+    fallback = np.bincount(win, weights=top, minlength=n_windows) < 2
+    candidates = np.flatnonzero(top | fallback[win])
+    cand_win = win[candidates]
+    order = np.lexsort((candidates, np.where(fallback[cand_win], -z[candidates], 0), cand_win))
+    candidates, cand_win = candidates[order], cand_win[order]
+
+    group_start = np.flatnonzero(np.r_[True, cand_win[1:] != cand_win[:-1]])
+    first = candidates[group_start]
+
+    # Duplicated corners are common in multipatch triangle strips, so the second vertex is the first candidate that is
+    # not at the same XY location as the first one
+    first_of_cand = np.repeat(first, np.diff(np.r_[group_start, len(candidates)]))
+    distinct = (x[candidates] != x[first_of_cand]) | (y[candidates] != y[first_of_cand])
+    distinct_win, distinct_pos = np.unique(cand_win[distinct], return_index=True)
+    if len(distinct_win) < n_windows:
+        missing = np.setdiff1d(np.arange(n_windows), distinct_win)[0]
+        raise ValueError("Window {0} has no two distinct vertices to find its search direction from".format(
+            int(missing) + 1))
+    second = candidates[distinct][distinct_pos]
+
+    ### Search direction (Near 3D + Opposite) ###
+    # Horizontal arithmetic angle from vertex 1 to vertex 2 (and from vertex 2 to vertex 1)
+    azimuth = np.degrees(np.arctan2(y[second] - y[first], x[second] - x[first]))
+    azimuth_back = np.degrees(np.arctan2(y[first] - y[second], x[first] - x[second]))
+
+    return WindowGeometry(cent_x, cent_y, z_mean, coords[first], coords[second], azimuth, opposite(azimuth),
+                          opposite(azimuth_back))
+
+
+# Select Layer By Attribute on NEAR_ANGLE: True where the angle from an obstruction to the window lies within
+# +- tolerance of one of the two search directions. As in the arcpy backend the wedge limits are not wrapped around
+# +- 180 degrees.
+def in_search_wedge(near_angle, dir_low, dir_high, tolerance):
+    return (((near_angle >= dir_low - tolerance) & (near_angle <= dir_low + tolerance)) |
+            ((near_angle >= dir_high - tolerance) & (near_angle <= dir_high + tolerance)))
+
+
+# Spread the lower 32 bits of each integer so there is a zero bit between every two bits
+def _spread_bits(v):
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+# The order in which to visit points so that points close to each other are visited one after another (Z-order /
+# Morton curve over a grid with the given cell size). Returns the indices of the points in that order.
+def z_order(x, y, cell_size):
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    if len(x) == 0:
+        return np.arange(0)
+    col = np.floor((x - x.min()) / cell_size).astype(np.int64)
+    row = np.floor((y - y.min()) / cell_size).astype(np.int64)
+    return np.argsort(_spread_bits(col) | (_spread_bits(row) << np.uint64(1)), kind="stable")
@@ -0,0 +1,135 @@
+import sqlite3
+
+import numpy as np
+
+from OA_cache import sidecar_path
+
+
+# Width (degrees) of the azimuth sectors of a horizon sweep, the 180 degree field of view of a window has
+# 180 / SWEEP_STEP sectors
+SWEEP_STEP = 2.0
+
+
+def sweep_sectors(step):
+    n_sectors = int(round(180.0 / step))
+    if n_sectors < 1 or abs(n_sectors * step - 180.0) > 1e-9:
+        raise ValueError("The horizon sweep step has to divide 180 degrees, got {0}".format(step))
+    return n_sectors
+
+
+# The search direction (Search_dir_low or Search_dir_high, NEAR_ANGLE convention) on the outside of a window. The DSM
+# is sampled 1.5 cells in front of the window in both directions, and the window faces the lower side, since the
+# other one looks into the building the window is in.
+def facing_direction(dsm, cent_x, cent_y, dir_low, dir_high):
+    heights = []
+    for direction in (dir_low, dir_high):
+        angle = np.radians(direction + 180)
+        col = int(np.floor((cent_x + 1.5 * dsm.cell_size * np.cos(angle) - dsm.x_min) / dsm.cell_size))
+        row = int(np.floor((dsm.y_max - cent_y - 1.5 * dsm.cell_size * np.sin(angle)) / dsm.cell_size))
+        height = np.nan
+        if 0 <= row < dsm.n_rows and 0 <= col < dsm.n_cols:
+            height = dsm.sample(np.array([row]), np.array([col]))[0]
+        heights.append(-np.inf if np.isnan(height) else height)
+    return dir_high if heights[1] < heights[0] else dir_low
+
+
+# The horizon of a window over the 180 degree field of view around its facing direction, from one pass over the DSM
+# cells around it (cells are the values and offsets of DSMGrid.around, if they have been read already). Sector i
+# holds the cells with a NEAR_ANGLE between facing - 90 + i * step and facing - 90 + (i + 1) * step. The cells are
+# selected like in window_oa (higher than the window, between inner_radius and outer_radius away), but any azimuth
+# counts instead of only the search wedges.
+# Returns float32 arrays with the highest obstruction angle of every sector (0 without obstruction cells) and its
+# distance (NaN without obstruction cells).
+def window_horizon(dsm, cent_x, cent_y, z_mean, facing, inner_radius, outer_radius, step=SWEEP_STEP, cells=None):
+    n_sectors = sweep_sectors(step)
+    values, dx, dy = cells if cells is not None else dsm.around(cent_x, cent_y, outer_radius)
+
+    # Distances and angles are only needed for the cells higher than the window
+    with np.errstate(invalid="ignore"):
+        rows, cols = np.nonzero(values > z_mean)
+    heights = values[rows, cols]
+    dx, dy = dx[0, cols], dy[rows, 0]
+    distance = np.hypot(dx, dy)
+    offset = np.degrees(np.arctan2(dy, dx)) - (facing - 90)
+    offset -= 360 * np.floor(offset / 360)
+    mask = (distance >= inner_radius) & (offset < 180)
+    if outer_radius:
+        mask &= distance <= outer_radius
+
+    angles = np.zeros(n_sectors, dtype=np.float32)
+    distances = np.full(n_sectors, np.nan, dtype=np.float32)
+    if mask.any():
+        sector = np.minimum((offset[mask] / step).astype(np.int64), n_sectors - 1)
+        cell_dist = distance[mask]
+        slopes = (heights[mask] - z_mean) / cell_dist
+
+        # The steepest slope of every sector, and the distance of the closest cell with that slope
+        best = np.full(n_sectors, -np.inf)
+        np.maximum.at(best, sector, slopes)
+        steepest = np.flatnonzero(slopes == best[sector])
+        best_dist = np.full(n_sectors, np.inf)
+        np.minimum.at(best_dist, sector[steepest], cell_dist[steepest])
+        found = best > -np.inf
+        angles[found] = np.degrees(np.arctan(best[found]))
+        distances[found] = best_dist[found]
+    return angles, distances
+
+
+# Sky view factor of a vertical window from its horizon angles (degrees, the sectors spread evenly over the 180 degree
+# field of view, the last axis for several windows): the part of the view of the window that is sky, weighted by the
+# cosine of the angle to the window normal. An unobstructed vertical window sees 0.5, the other half being ground.
+def sky_view_factor(angles):
+    angles = np.radians(np.asarray(angles, dtype=np.float64))
+    sector_edges = np.radians(np.linspace(-90.0, 90.0, angles.shape[-1] + 1))
+    weights = np.diff(np.sin(sector_edges))
+    return ((np.pi / 4 - angles / 2 - np.sin(2 * angles) / 4) * weights).sum(axis=-1) / np.pi
+
+
+# The horizon file of an output: a SQLite database next to it
+def horizon_path(outputPath):
+    return sidecar_path(outputPath, ".horizon.sqlite")
+
+
+# The horizons of the windows of an output, one row per w_id with the facing direction, the sky view factor and the
+# sector angles and distances as float32 BLOBs. The rows are replaced by w_id, so a resumed run can write the windows
+# of a batch again. Without keep the horizons of an earlier run are removed.
+class HorizonStore:
+
+    def __init__(self, path, step=SWEEP_STEP, keep=False):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS horizons (w_id INTEGER PRIMARY KEY, facing REAL, "
+                                    "svf REAL, angles BLOB, distances BLOB)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value REAL)")
+            if not keep:
+                self.connection.execute("DELETE FROM horizons")
+            self.connection.execute("INSERT OR REPLACE INTO settings VALUES ('step', ?)", (float(step),))
+
+    # Store the horizons of a ResultTable (with horizon columns)
+    def put(self, results):
+        table = results.array
+        svf = sky_view_factor(table["angles"])
+        items = [(int(table["w_id"][i]), float(table["facing"][i]), float(svf[i]), table["angles"][i].tobytes(),
+                  table["distances"][i].tobytes()) for i in range(len(table))]
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO horizons VALUES (?, ?, ?, ?, ?)", items)
+
+    def close(self):
+        self.connection.close()
+
+
+# Read the horizon file of an output. Returns the w_id, facing and svf of every window and their sector angles and
+# distances as (windows, sectors) float32 arrays, in w_id order.
+def read_horizons(path):
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute("SELECT w_id, facing, svf, angles, distances FROM horizons ORDER BY w_id").fetchall()
+        step = connection.execute("SELECT value FROM settings WHERE key = 'step'").fetchone()[0]
+    finally:
+        connection.close()
+    n_sectors = sweep_sectors(step)
+    angles = np.frombuffer(b"".join(row[3] for row in rows), dtype="<f4").reshape(-1, n_sectors)
+    distances = np.frombuffer(b"".join(row[4] for row in rows), dtype="<f4").reshape(-1, n_sectors)
+    return (np.array([row[0] for row in rows], dtype=np.int64), np.array([row[1] for row in rows]),
+            np.array([row[2] for row in rows]), angles, distances)
@@ -0,0 +1,184 @@
+import numpy as np
+
+from OA_geometry import in_search_wedge
+from OA_visibility import WindowSight
+
+
+# Size (cells) of the square buckets of an ObstructionIndex
+BUCKET_SIZE = 16
+
+# Half width (buckets) of the first box of buckets around a window that a query searches. Every time no cell outside
+# the box can be ruled out, the box is twice as large.
+FIRST_BOX = 4
+
+
+# A spatial index of the DSM cells that can be obstructions, built once per run and shared by all windows. The cells
+# higher than min_height are put in a dense grid of square buckets, and within a bucket they are sorted from high to
+# low. A query searches a box of buckets around the window that grows until no cell outside it can be steeper than the
+# obstruction found inside. In the box it only looks at the buckets that can hold a cell steeper than that, and in
+# those only at the cells higher than the window, instead of at every cell of the DSM. A cell is kept as its int32 row
+# and column and its height (16 bytes), its coordinates are only calculated for the cells a query looks at.
+class ObstructionIndex:
+
+    def __init__(self, dsm, min_height=-np.inf, bucket_size=BUCKET_SIZE):
+        self.x_min, self.y_max = dsm.x_min, dsm.y_max
+        self.cell_size = dsm.cell_size
+        self.min_height = float(min_height)
+        self.bucket_size = int(bucket_size)
+        self.n_bucket_rows = -(-dsm.n_rows // self.bucket_size)
+        self.n_bucket_cols = -(-dsm.n_cols // self.bucket_size)
+
+        # Collect the candidate cells one band of rows at a time, so a tiled DSM does not have to be read as a whole
+        band = self.bucket_size * max(1, 1024 // self.bucket_size)
+        rows, cols, heights = [], [], []
+        for r0 in range(0, dsm.n_rows, band):
+            values = dsm.read(slice(r0, min(r0 + band, dsm.n_rows)), slice(0, dsm.n_cols))
+            with np.errstate(invalid="ignore"):
+                band_rows, band_cols = np.nonzero(values > min_height)
+            rows.append((band_rows + r0).astype(np.int32))
+            cols.append(band_cols.astype(np.int32))
+            heights.append(values[band_rows, band_cols])
+        rows, cols, heights = np.concatenate(rows), np.concatenate(cols), np.concatenate(heights)
+
+        bucket = (rows // self.bucket_size).astype(np.int64) * self.n_bucket_cols + cols // self.bucket_size
+        order = np.lexsort((-heights, bucket))
+        bucket = bucket[order]
+        self.rows, self.cols = rows[order], cols[order]
+        self.heights = heights[order]
+        del rows, cols, heights, order
+
+        # The cells of bucket (row, col) are self.rows[offsets[row, col]:offsets[row, col + 1]] etc., the first one
+        # being the highest, and max_heights is -inf for the empty buckets
+        n_buckets = self.n_bucket_rows * self.n_bucket_cols
+        self.offsets = np.searchsorted(bucket, np.arange(n_buckets + 1))
+        starts = self.offsets[:-1]
+        self.max_heights = np.where(starts < self.offsets[1:], self.heights[np.minimum(starts, len(bucket) - 1)],
+                                    -np.inf).reshape(self.n_bucket_rows, self.n_bucket_cols)
+        self.max_height = float(self.heights.max()) if len(self.heights) else -np.inf
+
+    def __len__(self):
+        return len(self.heights)
+
+    # The non-empty buckets of the box rows[0]:rows[1], cols[0]:cols[1] (clipped to the grid) that are not in the box
+    # inner (None for no box). Returns their row and column.
+    def _box(self, rows, cols, inner):
+        r0, r1 = max(rows[0], 0), min(rows[1], self.n_bucket_rows)
+        c0, c1 = max(cols[0], 0), min(cols[1], self.n_bucket_cols)
+        if r0 >= r1 or c0 >= c1:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        new = self.max_heights[r0:r1, c0:c1] > -np.inf
+        if inner is not None:
+            (i0, i1), (j0, j1) = inner
+            new[max(i0 - r0, 0):max(i1 - r0, 0), max(j0 - c0, 0):max(j1 - c0, 0)] = False
+        bucket_rows, bucket_cols = np.nonzero(new)
+        return bucket_rows + r0, bucket_cols + c0
+
+    # The steepest obstruction cell for a window at (cent_x, cent_y, z_mean): higher than the window, between
+    # inner_radius and outer_radius away (2D), within the search wedges and not hidden by a steeper cell of the DSM on
+    # the way to it, the same selection as window_oa.
+    # Returns (OA, Distance, grid_code). If there are no obstruction cells, OA is 0 and Distance/grid_code are None.
+    def max_obstruction(self, dsm, cent_x, cent_y, z_mean, dir_low, dir_high, inner_radius, outer_radius, tolerance):
+        extent = self.bucket_size * self.cell_size
+        row = int(np.floor((self.y_max - cent_y) / extent))
+        col = int(np.floor((cent_x - self.x_min) / extent))
+        # Without an outer radius the box grows until it covers the whole grid
+        if outer_radius:
+            reach = int(np.ceil(outer_radius / extent))
+        else:
+            reach = max(row + 1, self.n_bucket_rows - row, col + 1, self.n_bucket_cols - col)
+
+        # The buckets that are left to visit and their steepest possible slope, the cells collected from the visited
+        # buckets (slope, Distance, grid_code and cell centre) and the ones not added to them yet
+        todo, todo_bound = np.zeros(0, dtype=np.int64), np.zeros(0)
+        cells, new_cells, steepest = np.zeros((5, 0)), [], -np.inf
+        sight = WindowSight(dsm, cent_x, cent_y, z_mean, inner_radius)
+        box, half = None, min(FIRST_BOX, reach)
+        while True:
+            # No cell outside the box of buckets within half of the window's bucket is closer than half buckets
+            rows, cols = (row - half, row + half + 1), (col - half, col + half + 1)
+            complete = half >= reach
+            beyond = -np.inf if complete else (self.max_height - z_mean) / (half * extent)
+            bucket_rows, bucket_cols = self._box(rows, cols, box)
+            box, half = (rows, cols), min(half * 2, reach)
+
+            # Closest and farthest distance from the window to each new bucket
+            x0 = self.x_min + bucket_cols * extent
+            y1 = self.y_max - bucket_rows * extent
+            x1, y0 = x0 + extent, y1 - extent
+            near_dx = np.maximum(np.maximum(x0 - cent_x, cent_x - x1), 0)
+            near_dy = np.maximum(np.maximum(y0 - cent_y, cent_y - y1), 0)
+            min_dist = np.hypot(near_dx, near_dy)
+            max_dist = np.hypot(np.maximum(np.abs(x0 - cent_x), np.abs(x1 - cent_x)),
+                                np.maximum(np.abs(y0 - cent_y), np.abs(y1 - cent_y)))
+            max_heights = self.max_heights[bucket_rows, bucket_cols]
+
+            candidate = (max_heights > z_mean) & (max_dist >= inner_radius)
+            if outer_radius:
+                candidate &= min_dist <= outer_radius
+
+            # Buckets outside both search wedges are skipped. The angular size of a bucket seen from the window is
+            centre_x, centre_y = (x0 + x1) / 2 - cent_x, (y0 + y1) / 2 - cent_y
+            centre_dist = np.hypot(centre_x, centre_y)
+            # over-estimated (all directions for a bucket around the window), so no bucket with a cell inside a wedge is
+            # skipped.
+            half_size = np.where(centre_dist > extent / np.sqrt(2), np.degrees(np.arcsin(np.minimum(
+                1, (extent / np.sqrt(2)) / np.maximum(centre_dist, 1e-9)))), 180.0)
+            centre_near_angle = np.degrees(np.arctan2(-centre_y, -centre_x))
+            in_wedge = np.zeros(len(candidate), dtype=bool)
+            for direction in (dir_low, dir_high):
+                difference = np.abs((centre_near_angle - direction + 180) % 360 - 180)
+                in_wedge |= difference <= tolerance + half_size
+            candidate &= in_wedge
+
+            # The buckets that the cells within the inner radius hide as a whole, such as the window's own building
+            bound = np.full(len(candidate), -np.inf)
+            bound[candidate] = (max_heights[candidate] - z_mean) / np.maximum(min_dist[candidate],
+                                                                               max(inner_radius, 1e-9))
+            candidate &= bound >= sight.near_horizon_between(centre_near_angle - half_size,
+                                                             centre_near_angle + half_size)
+
+            buckets = bucket_rows[candidate] * self.n_bucket_cols + bucket_cols[candidate]
+            todo, todo_bound = np.r_[todo, buckets], np.r_[todo_bound, bound[candidate]]
+            order = np.argsort(-todo_bound, kind="stable")
+            todo, todo_bound = todo[order], todo_bound[order]
+            visit = int(np.searchsorted(-todo_bound, -beyond, side="right"))
+
+            # Visit the buckets from the steepest possible slope down, down to the ones that a cell outside the box
+            # could beat. The cells of the buckets are collected, and their lines of sight are only checked once no
+            # bucket that is left can beat them: the steepest cell that can be seen among those is the obstruction.
+            for b, b_bound in zip(np.r_[todo[:visit], -1], np.r_[todo_bound[:visit], beyond]):
+                if steepest >= b_bound:
+                    cells = np.concatenate([cells] + new_cells, axis=1)
+                    new_cells = []
+                    check = cells[0] >= b_bound
+                    i = sight.steepest_visible(cells[0, check], cells[3, check], cells[4, check])
+                    if i is not None:
+                        slope, distance, height = cells[:3, check][:, i]
+                        return float(np.degrees(np.arctan(slope))), float(distance), float(height)
+                    cells = cells[:, ~check]
+                    steepest = cells[0].max() if cells.shape[1] else -np.inf
+                if b < 0:
+                    break
+
+                # Only the cells higher than the window: a prefix of the bucket, since it is sorted from high to low
+                start, stop = self.offsets[b], self.offsets[b + 1]
+                stop = start + int(np.searchsorted(-self.heights[start:stop], -z_mean, side="left"))
+                bucket_heights = self.heights[start:stop]
+                x = self.x_min + (self.cols[start:stop] + 0.5) * self.cell_size
+                y = self.y_max - (self.rows[start:stop] + 0.5) * self.cell_size
+                dx, dy = cent_x - x, cent_y - y
+                distance = np.hypot(dx, dy)
+
+                mask = distance >= inner_radius
+                if outer_radius:
+                    mask &= distance <= outer_radius
+                mask &= in_search_wedge(np.degrees(np.arctan2(dy, dx)), dir_low, dir_high, tolerance)
+                if not mask.any():
+                    continue
+                slopes = (bucket_heights[mask] - z_mean) / distance[mask]
+                new_cells.append(np.stack([slopes, distance[mask], bucket_heights[mask], x[mask], y[mask]]))
+                steepest = max(steepest, slopes.max())
+
+            if complete:
+                return 0.0, None, None
+            todo, todo_bound = todo[visit:], todo_bound[visit:]
@@ -0,0 +1,269 @@
+import numpy as np
+
+from OA_raymarch import RAY_COUNT, STEP_BLOCK
+
+
+# Refractivity coefficient of visible light in the atmosphere, the value the arcpy backend passes to Viewshed2, and the
+# diameter of the earth (m) that Viewshed2 uses for the curvature correction
+REFRACTIVITY_COEFFICIENT = 0.13
+EARTH_DIAMETER = 12740000.0
+
+# How the interpolating searches evaluate the DSM between cell centres
+INTERPOLATIONS = ("bilinear", "bicubic")
+
+# Largest number of samples (windows x rays x steps) that are interpolated together, which bounds the memory use of a
+# batch. The best sample of every window is refined with REFINE_SAMPLES samples around it on its ray.
+SAMPLE_BLOCK = 2 ** 20
+REFINE_SAMPLES = 17
+
+
+# How much lower a surface at a horizontal distance appears because of the curvature of the earth, less the part the
+# refraction of the line of sight makes up for (the same correction Viewshed2 applies)
+def curvature_correction(distance, refractivity=REFRACTIVITY_COEFFICIENT):
+    return np.square(distance) * (1 - refractivity) / EARTH_DIAMETER
+
+
+# The weights of the four cells at offsets -1, 0, 1 and 2 of a cubic convolution (Keys, a = -0.5) at fractions t
+def _cubic_weights(t):
+    return ((-0.5 * t + 1.0) * t - 0.5) * t, (1.5 * t - 2.5) * t * t + 1.0, ((-1.5 * t + 2.0) * t + 0.5) * t, \
+        (0.5 * t - 0.5) * t * t
+
+
+# The DSM height at the points (x, y) (arrays of any shape), interpolated between the cell centres. Beyond the outer
+# cell centres the edge cells are repeated, points outside the DSM or next to a NoData cell are NaN. Bicubic
+# heights are clamped to the range of the four closest cells, so the interpolation does not overshoot at the edge of
+# a roof and no point is higher than the DSM. With a minimum height (broadcasting to the points) the bicubic heights
+# are only calculated where one of the four closest cells is higher than it, the other points are NaN.
+def interpolate_heights(dsm, x, y, method="bilinear", minimum=None):
+    if method not in INTERPOLATIONS:
+        raise ValueError("Unknown interpolation {0}, use one of {1}".format(method, ", ".join(INTERPOLATIONS)))
+    fx = (np.asarray(x, dtype=np.float64) - dsm.x_min) / dsm.cell_size - 0.5
+    fy = (dsm.y_max - np.asarray(y, dtype=np.float64)) / dsm.cell_size - 0.5
+    shape = fx.shape
+    fx, fy = fx.reshape(-1), fy.reshape(-1)
+    inside = (fx >= -0.5) & (fx <= dsm.n_cols - 0.5) & (fy >= -0.5) & (fy <= dsm.n_rows - 0.5)
+    if not inside.all():
+        fx, fy = fx[inside], fy[inside]
+    col, row = np.floor(fx), np.floor(fy)
+    # Only points beyond the outer cell centres need clipping, which is rare enough to check first
+    if len(fx) and (col.min() < 0 or col.max() > dsm.n_cols - 2 or row.min() < 0 or row.max() > dsm.n_rows - 2):
+        col, row = np.clip(col, 0, dsm.n_cols - 2), np.clip(row, 0, dsm.n_rows - 2)
+        tx, ty = np.clip(fx - col, 0, 1), np.clip(fy - row, 0, 1)
+    else:
+        tx, ty = fx - col, fy - row
+    col, row = col.astype(np.int64), row.astype(np.int64)
+    values = getattr(dsm, "values", None)
+
+    # A DSM in memory is sampled through its flat array, a tiled one through its tiles. The cells at offsets -1 and 2
+    # of bicubic can be beyond the edge, they are clipped to it.
+    def sampler(row, col):
+        if values is None:
+            return lambda row_offset, col_offset: dsm.sample(np.clip(row + row_offset, 0, dsm.n_rows - 1),
+                                                             np.clip(col + col_offset, 0, dsm.n_cols - 1))
+        flat, n_cols = values.reshape(-1), dsm.n_cols
+        index = row * n_cols + col
+
+        def cells(row_offset, col_offset):
+            if row_offset in (0, 1) and col_offset in (0, 1):
+                return flat.take(index + (row_offset * n_cols + col_offset))
+            return flat.take(np.clip(row + row_offset, 0, dsm.n_rows - 1) * n_cols +
+                             np.clip(col + col_offset, 0, n_cols - 1))
+        return cells
+
+    cells = sampler(row, col)
+    top_left, top_right, bottom_left, bottom_right = cells(0, 0), cells(0, 1), cells(1, 0), cells(1, 1)
+    if method == "bilinear":
+        top = top_left + tx * (top_right - top_left)
+        heights = top + ty * (bottom_left + tx * (bottom_right - bottom_left) - top)
+    else:
+        low = np.fmin(np.fmin(top_left, top_right), np.fmin(bottom_left, bottom_right))
+        high = np.fmax(np.fmax(top_left, top_right), np.fmax(bottom_left, bottom_right))
+        heights = np.full(len(tx), np.nan)
+        needed = slice(None)
+        if minimum is not None:
+            minimum = np.broadcast_to(minimum, shape).reshape(-1)
+            needed = high > (minimum if inside.all() else minimum[inside])
+            tx, ty, col, row, low, high = tx[needed], ty[needed], col[needed], row[needed], low[needed], high[needed]
+            cells = sampler(row, col)
+
+        weights_x, weights_y = _cubic_weights(tx), _cubic_weights(ty)
+        cubic = 0.0
+        for i, row_offset in enumerate((-1, 0, 1, 2)):
+            line = 0.0
+            for j, col_offset in enumerate((-1, 0, 1, 2)):
+                line = line + weights_x[j] * cells(row_offset, col_offset)
+            cubic = cubic + weights_y[i] * line
+        heights[needed] = np.clip(cubic, low, high)
+
+    if inside.all():
+        return heights.reshape(shape)
+    out = np.full(len(inside), np.nan)
+    out[inside] = heights
+    return out.reshape(shape)
+
+
+# Whether the heights at the points (x, y) (1-D arrays) are interpolated from a cell whose centre is closer than
+# min_distance to the origin (ox, oy) of every point. A cell of the four closest ones weighs in unless the point is at
+# a fraction of 0 towards it, and the closest of them is found for columns and rows separately.
+def _near_cells(dsm, x, y, ox, oy, min_distance):
+    fx, fy = (x - dsm.x_min) / dsm.cell_size - 0.5, (dsm.y_max - y) / dsm.cell_size - 0.5
+    gaps = []
+    for f, o in ((fx, (ox - dsm.x_min) / dsm.cell_size - 0.5), (fy, (dsm.y_max - oy) / dsm.cell_size - 0.5)):
+        line = np.floor(f)
+        t = f - line
+        gaps.append(np.fmin(np.where(t < 1 - 1e-9, np.abs(line - o), np.inf),
+                            np.where(t > 1e-9, np.abs(line + 1 - o), np.inf)))
+    return np.hypot(*gaps) * dsm.cell_size < min_distance
+
+
+# The steepest corrected obstruction on every ray among the samples at distances dists (windows x rays x samples, or
+# broadcasting to it) along the rays with the directions ray_cos/ray_sin. Only samples steeper than best (the current
+# obstruction of every window) are interpolated with bicubic. The samples within the inner radius, or that depend on a
+# cell within it, are no obstructions but hide the samples behind them like any other sample: a sample only counts if
+# it is as steep as horizon (windows x rays) and, if the samples are ordered by distance, as every earlier one.
+# Returns the slope, the index of the sample and the corrected height of the steepest sample of every ray (windows x
+# rays), and the steepest slope of all samples and of the hiding samples within the inner radius of every ray.
+def _steepest(dsm, method, cent_x, cent_y, z_mean, ray_cos, ray_sin, dists, valid, best, inner_radius, horizon,
+              ordered=True):
+    correction = curvature_correction(dists)
+    minimum = None
+    if method == "bicubic":
+        minimum = z_mean + correction + np.maximum(best, 0)[:, None, None] * dists
+    x, y = cent_x + ray_cos * dists, cent_y + ray_sin * dists
+    heights = interpolate_heights(dsm, x, y, method, minimum)
+    heights -= correction
+    # The cells that weigh in a sample are less than two cells from it, so only the samples closer than that to the
+    # inner radius can depend on a cell within it
+    inner = np.broadcast_to(dists < inner_radius, heights.shape).copy()
+    if inner_radius > 0:
+        near = np.broadcast_to(dists < inner_radius + 2 * dsm.cell_size, heights.shape) & ~inner
+        if near.any():
+            x, y = np.broadcast_to(x, near.shape)[near], np.broadcast_to(y, near.shape)[near]
+            ox, oy = np.broadcast_to(cent_x, near.shape)[near], np.broadcast_to(cent_y, near.shape)[near]
+            inner[near] = _near_cells(dsm, x, y, ox, oy, inner_radius)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        seen = (heights - z_mean) / dists
+    seen[np.isnan(seen)] = -np.inf
+    earlier = horizon[:, :, None]
+    if ordered:
+        earlier = np.maximum(earlier, np.maximum.accumulate(np.concatenate(
+            [np.full(seen.shape[:2] + (1,), -np.inf), seen[:, :, :-1]], axis=2), axis=2))
+    slopes = np.where(valid & ~inner & (heights > z_mean) & (seen >= earlier), seen, -np.inf)
+    sample = np.argmax(slopes, axis=2)[:, :, None]
+    return np.take_along_axis(slopes, sample, 2)[:, :, 0], sample[:, :, 0], \
+        np.take_along_axis(np.broadcast_to(heights, slopes.shape), sample, 2)[:, :, 0], seen.max(axis=2), \
+        np.where(inner, seen, -np.inf).max(axis=2)
+
+
+# Find the highest obstruction angle of a batch of windows (arrays with the centroid and search directions of every
+# window) from the DSM heights interpolated along a fan of rays in the two search wedges, with the curvature and
+# refraction correction applied to the heights. The heights within the inner radius, or that depend on a DSM cell
+# within it, are no obstructions (as the other searches leave those cells out), but like all heights they hide the
+# lower ones behind them. The rays of all windows are marched together from one cell from the window (closer heights
+# depend on the cell of the window itself), STEP_BLOCK steps (of half a cell) at a time, and a window drops out when
+# even the highest DSM cell could not be steeper than its current obstruction or than the hiding samples of all its
+# rays any more, or at its outer radius (the farthest DSM corner if there is none).
+# The best sample of every ray is then refined between the samples before and after it, at the points where the ray
+# crosses a row or column of cell centres (where a bilinear surface bends) and at REFINE_SAMPLES points.
+# Returns the OA (0 without obstruction), Distance and grid_code (NaN without obstruction) of every window. Distance is
+# the horizontal distance to the obstruction point and grid_code its corrected height, so that OA is
+# atan((grid_code - Z_Mean) / Distance) like in the other searches.
+def batch_oa_interpolated(dsm, cent_x, cent_y, z_mean, dir_low, dir_high, inner_radius, outer_radius, tolerance,
+                          ray_count=RAY_COUNT, method="bilinear", step=None, dsm_max=None):
+    n_windows, n_rays = len(cent_x), 2 * ray_count
+    if dsm_max is None:
+        dsm_max = dsm.max_value()
+    step = step or dsm.cell_size / 2
+    cent_x, cent_y, z_mean = (np.asarray(a, dtype=np.float64)[:, None, None] for a in (cent_x, cent_y, z_mean))
+
+    # The ray directions are the NEAR_ANGLE search directions turned around (from the window to the obstruction).
+    # Rays outside -180..180 are left out since the wedge selection of the other searches would not match them.
+    spread = np.linspace(-tolerance, tolerance, ray_count)
+    near_angles = np.concatenate([np.asarray(dir_low)[:, None] + spread, np.asarray(dir_high)[:, None] + spread],
+                                 axis=1)
+    ray_valid = ((near_angles >= -180) & (near_angles <= 180))[:, :, None]
+    ray_angles = np.radians(near_angles + 180)[:, :, None]
+    ray_cos, ray_sin = np.cos(ray_angles), np.sin(ray_angles)
+
+    if outer_radius:
+        max_dist = np.full(n_windows, float(outer_radius))
+    else:
+        max_dist = np.max([np.hypot(cx - cent_x[:, 0, 0], cy - cent_y[:, 0, 0]) for cx in (dsm.x_min, dsm.x_max)
+                           for cy in (dsm.y_min, dsm.y_max)], axis=0)
+
+    # The steepest sample of every ray so far, and the steepest one of all samples and of the hiding samples
+    ray_slope = np.full((n_windows, n_rays), -np.inf)
+    ray_dist = np.full((n_windows, n_rays), np.nan)
+    ray_height = np.full((n_windows, n_rays), np.nan)
+    ray_horizon = np.full((n_windows, n_rays), -np.inf)
+    ray_inner = np.full((n_windows, n_rays), -np.inf)
+    active = dsm_max > z_mean[:, 0, 0]
+    start = float(dsm.cell_size)
+    while True:
+        # Early termination: no sample beyond start can be steeper than the highest DSM cell would be, and the rays
+        # that have passed a sample that steep are hidden beyond
+        best = ray_slope.max(axis=1)
+        limit = (dsm_max - z_mean[:, 0, 0]) / start
+        hidden = ((ray_horizon >= limit[:, None]) | ~ray_valid[:, :, 0]).all(axis=1)
+        active &= (start <= max_dist) & (best < limit) & ~hidden
+        windows = np.flatnonzero(active)
+        if not len(windows):
+            break
+        n_steps = int(np.clip(SAMPLE_BLOCK // (len(windows) * n_rays), 1, STEP_BLOCK))
+        dists = start + step * np.arange(n_steps)
+        start = dists[-1] + step
+
+        valid = ray_valid[windows] & (dists <= max_dist[windows, None, None])
+        slopes, sample, heights, seen, inner = _steepest(dsm, method, cent_x[windows], cent_y[windows],
+                                                         z_mean[windows], ray_cos[windows], ray_sin[windows], dists,
+                                                         valid, best[windows], inner_radius, ray_horizon[windows])
+        ray_horizon[windows] = np.maximum(ray_horizon[windows], seen)
+        ray_inner[windows] = np.maximum(ray_inner[windows], inner)
+        better = slopes > ray_slope[windows]
+        window_index, ray_index = np.nonzero(better)
+        window_index = windows[window_index]
+        ray_slope[window_index, ray_index] = slopes[better]
+        ray_dist[window_index, ray_index] = dists[sample[better]]
+        ray_height[window_index, ray_index] = heights[better]
+
+    # Refine the best sample of every ray of the windows with an obstruction, in blocks of windows that sample up to
+    # SAMPLE_BLOCK points together. The refined samples are not ordered, they only have to be as steep as the hiding
+    # samples of their ray.
+    found = np.flatnonzero((ray_slope > -np.inf).any(axis=1))
+    cs = dsm.cell_size
+    crossings = int(np.ceil(2 * step / cs)) + 1
+    block = max(1, SAMPLE_BLOCK // (n_rays * (REFINE_SAMPLES + 2 * crossings)))
+    for first in range(0, len(found), block):
+        windows = found[first:first + block]
+        d = ray_dist[windows][:, :, None]
+        cos, sin = ray_cos[windows], ray_sin[windows]
+        cx, cy = cent_x[windows], cent_y[windows]
+        candidates = [d + np.linspace(-step, step, REFINE_SAMPLES)]
+        for origin, direction in ((cx - dsm.x_min, cos), (cy - dsm.y_max, sin)):
+            # Distances at which the ray crosses the cell centre lines between d - step and d + step
+            with np.errstate(divide="ignore", invalid="ignore"):
+                low = np.minimum(origin + direction * (d - step), origin + direction * (d + step))
+                lines = (np.ceil(low / cs - 0.5) + np.arange(crossings)) * cs + cs / 2
+                candidates.append((lines - origin) / direction)
+        candidates = np.concatenate(candidates, axis=2)
+        with np.errstate(invalid="ignore"):
+            valid = np.isfinite(candidates) & (np.abs(candidates - d) <= step) & \
+                (candidates >= max(inner_radius, cs)) & (candidates <= max_dist[windows, None, None])
+        candidates = np.where(valid, candidates, max(inner_radius, cs))
+        slopes, sample, heights = _steepest(dsm, method, cx, cy, z_mean[windows], cos, sin, candidates, valid,
+                                            ray_slope[windows].max(axis=1), inner_radius, ray_inner[windows],
+                                            ordered=False)[:3]
+        better = slopes > ray_slope[windows]
+        window_index, ray_index = np.nonzero(better)
+        ray_slope[windows[window_index], ray_index] = slopes[better]
+        ray_dist[windows[window_index], ray_index] = candidates[window_index, ray_index, sample[better]]
+        ray_height[windows[window_index], ray_index] = heights[better]
+
+    # The steepest ray of every window
+    ray = np.argmax(ray_slope, axis=1)[:, None]
+    best_slope = np.take_along_axis(ray_slope, ray, 1)[:, 0]
+    found = best_slope > -np.inf
+    oa = np.zeros(n_windows)
+    oa[found] = np.degrees(np.arctan(best_slope[found]))
+    return oa, np.where(found, np.take_along_axis(ray_dist, ray, 1)[:, 0], np.nan), \
+        np.where(found, np.take_along_axis(ray_height, ray, 1)[:, 0], np.nan)
@@ -0,0 +1,12 @@
+import logging
+import sys
+
+
+# Report a progress message. Inside ArcGIS it goes to the geoprocessing messages, otherwise to the "OA_tool" logger.
+# arcpy is only used if it has been imported already, so reporting a message never loads it.
+def add_message(message):
+    arcpy = sys.modules.get("arcpy")
+    if arcpy is None:
+        logging.getLogger("OA_tool").info(message)
+        return
+    arcpy.AddMessage(message)
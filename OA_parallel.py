@@ -0,0 +1,53 @@
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from OA_log import add_message
+
+
+# Split n_windows windows into (at most) one contiguous chunk per worker. Returns a list of (start, stop) indices.
+def chunk_ranges(n_windows, workers):
+    workers = max(1, min(int(workers), n_windows))
+    bounds = [n_windows * i // workers for i in range(workers + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(workers) if bounds[i + 1] > bounds[i]]
+
+
+# A pool of worker processes. initializer(*initargs) is called once in every worker when it starts, e.g. to load the
+# data all chunks of a run need.
+def process_pool(workers, initializer=None, initargs=()):
+    # Inside ArcGIS Pro sys.executable is ArcGISPro.exe, the workers have to be started with its Python interpreter
+    if os.path.basename(sys.executable).lower() == "arcgispro.exe":
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, "pythonw.exe"))
+    return ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+
+
+def _timed_chunk(func, args):
+    start = time.perf_counter()
+    results = func(*args)
+    return results, time.perf_counter() - start
+
+
+# Run func(*args) for every args tuple in chunks in a process pool with the given number of workers. func has to
+# return a list (or another sequence, e.g. a ResultTable) with one item per window. The results are joined in chunk
+# order by combine (concatenated lists by default), so the result does not depend on which worker finishes first. The
+# time and number of windows of every chunk are reported. The chunks run in pool if one is given (which stays open for
+# the next call, e.g. the next batch of a run), otherwise in a pool of their own.
+def run_chunks(func, chunks, workers, combine=None, pool=None):
+    start = time.perf_counter()
+    chunkResultList = []
+    ownPool = process_pool(workers) if pool is None else None
+    try:
+        futures = [(ownPool or pool).submit(_timed_chunk, func, args) for args in chunks]
+        for chunk, future in enumerate(futures, start=1):
+            chunkResults, elapsed = future.result()
+            add_message("Worker {0}: {1} windows in {2:.1f} s".format(chunk, len(chunkResults), elapsed))
+            chunkResultList.append(chunkResults)
+    finally:
+        if ownPool is not None:
+            ownPool.shutdown()
+    results = combine(chunkResultList) if combine else [item for part in chunkResultList for item in part]
+    add_message("{0} workers finished {1} windows in {2:.1f} s".format(len(chunks), len(results),
+                                                                      time.perf_counter() - start))
+    return results
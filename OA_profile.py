@@ -0,0 +1,160 @@
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from OA_log import add_message
+
+
+# The highest peak RSS of this process (MB) before reset_peak_rss reset it
+_peak = {"before_reset": 0.0}
+
+
+# The peak resident set size of this process in MB, or None if it cannot be found
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max(peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10, _peak["before_reset"])
+
+
+# The current resident set size of this process in MB, or None if it cannot be found
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+# Reset the peak resident set size of this process to its current RSS, which Linux allows by writing 5 to
+# /proc/self/clear_refs. The peak before is kept for peak_rss_mb. Returns whether it was reset.
+def reset_peak_rss():
+    peak = high_water_rss_mb()
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    _peak["before_reset"] = max(_peak["before_reset"], peak or 0.0)
+    return True
+
+
+# The peak resident set size of this process since it started or since reset_peak_rss in MB (VmHWM in
+# /proc/self/status), or None if it cannot be found
+def high_water_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+# Records the wall time, memory and number of rows produced of every stage of every window. The memory of a stage is
+# the RSS of the process at its end, how much it grew during the stage and its peak RSS. On Linux the peak RSS is
+# reset when a stage begins, so it is the peak of the stage itself. Elsewhere the peak RSS of a process only ever goes
+# up, so the RSS at the end of the stage is used instead. Each stage is written as one JSON line to tracePath as soon as
+# it ends, so worker processes (which get a copy of the profiler) write to the same trace. Without a tracePath nothing
+# is recorded and begin/end cost next to nothing.
+class Profiler:
+
+    def __init__(self, tracePath=None):
+        self.tracePath = tracePath
+        self._stage = None
+        self._file = None
+        self._pid = None
+        if tracePath:
+            open(tracePath, "w").close()
+
+    # The open trace file is not copied to worker processes, every process opens the trace itself
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+    @property
+    def enabled(self):
+        return bool(self.tracePath)
+
+    def begin(self, stage, windowID=None):
+        if self.enabled:
+            self._stage = (stage, windowID, time.time(), time.perf_counter(), rss_mb(), reset_peak_rss())
+
+    # End the stage that was begun last. rows is the number of rows the stage produced, or a function returning it
+    # (which is only called when profiling, e.g. to avoid a GetCount call otherwise).
+    def end(self, rows=None):
+        if not self.enabled or self._stage is None:
+            return
+        stage, windowID, start, perf_start, rss_start, peak_reset = self._stage
+        wall = time.perf_counter() - perf_start
+        self._stage = None
+        rss = rss_mb()
+        peak = high_water_rss_mb() if peak_reset else None
+        event = {"stage": stage, "window": windowID, "start": start, "wall_s": wall, "rss_mb": rss,
+                 "rss_increase_mb": rss - rss_start if rss is not None and rss_start is not None else None,
+                 "peak_rss_mb": peak if peak is not None else rss,
+                 "rows": rows() if callable(rows) else rows, "pid": os.getpid()}
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.tracePath, "a", buffering=1)
+            self._pid = os.getpid()
+        self._file.write(json.dumps(event) + "\n")
+
+    @contextmanager
+    def stage(self, stage, windowID=None):
+        counts = {"rows": None}
+        self.begin(stage, windowID)
+        try:
+            yield counts
+        finally:
+            self.end(counts["rows"])
+
+    def events(self):
+        if self._file is not None:
+            self._file.flush()
+        if not self.enabled or not os.path.exists(self.tracePath):
+            return []
+        with open(self.tracePath) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    # Report a table with the number of calls, total/mean/max wall time, rows, the total and largest RSS increase of
+    # a call, the highest RSS at the end of a call and the highest peak RSS of a call of each stage
+    def summary(self):
+        stages = OrderedDict()
+        for event in self.events():
+            stats = stages.setdefault(event["stage"], {"calls": 0, "total": 0.0, "max": 0.0, "rows": 0,
+                                                       "increase": 0.0, "max_increase": 0.0, "rss": 0.0,
+                                                       "peak": 0.0})
+            stats["calls"] += 1
+            stats["total"] += event["wall_s"]
+            stats["max"] = max(stats["max"], event["wall_s"])
+            stats["rows"] += event["rows"] or 0
+            stats["increase"] += event["rss_increase_mb"] or 0.0
+            stats["max_increase"] = max(stats["max_increase"], event["rss_increase_mb"] or 0.0)
+            stats["rss"] = max(stats["rss"], event["rss_mb"] or 0.0)
+            stats["peak"] = max(stats["peak"], event.get("peak_rss_mb") or 0.0)
+        if not stages:
+            return
+
+        add_message("{0:<24}{1:>8}{2:>12}{3:>12}{4:>12}{5:>12}{6:>14}{7:>14}{8:>10}{9:>10}".format(
+            "Stage", "Calls", "Total s", "Mean ms", "Max ms", "Rows", "RSS +MB", "Max RSS +MB", "RSS MB", "Peak MB"))
+        for stage, stats in stages.items():
+            add_message("{0:<24}{1:>8}{2:>12.2f}{3:>12.2f}{4:>12.2f}{5:>12}{6:>14.1f}{7:>14.1f}{8:>10.1f}{9:>10.1f}"
+                        .format(stage, stats["calls"], stats["total"], 1000 * stats["total"] / stats["calls"],
+                                1000 * stats["max"], stats["rows"], stats["increase"], stats["max_increase"],
+                                stats["rss"], stats["peak"]))
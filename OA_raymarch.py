@@ -0,0 +1,101 @@
+import numpy as np
+
+from OA_geometry import in_search_wedge
+from OA_visibility import WindowSight
+
+
+# Number of rays spread evenly over each of the two search wedges, and the number of steps along the rays that are
+# sampled together before checking if the march can stop
+RAY_COUNT = 21
+STEP_BLOCK = 64
+
+
+# Find the highest obstruction angle for one window by sampling the DSM along a fan of rays inside the two search
+# wedges instead of looking at every cell of the DSM. The rays start at the window, and the march stops when even a
+# cell as high as the highest one in the DSM could not beat the current max angle any more, or at the outer radius
+# (the edge of the DSM if there is none).
+# Sampled cells are treated exactly like in window_oa: their centre has to be higher than the window, outside the
+# inner radius and within the search wedge, they have to be seen from the window, and OA, Distance and grid_code are
+# taken from the cell centre. A ray stops once it has crossed a cell (also one inside the inner radius, but not the
+# cell the window is in) that hides all of the DSM beyond. The result is the same as window_oa as long as the rays
+# are dense enough to hit the highest cell.
+# Returns (OA, Distance, grid_code). If there are no obstruction cells, OA is 0 and Distance/grid_code are None.
+def window_oa_raymarch(dsm, cent_x, cent_y, z_mean, dir_low, dir_high, inner_radius, outer_radius, tolerance,
+                       ray_count=RAY_COUNT, step=None, dsm_max=None):
+    if dsm_max is None:
+        dsm_max = dsm.max_value()
+    if not dsm_max > z_mean:
+        return 0.0, None, None
+    step = step or dsm.cell_size / 2
+
+    # The ray directions are the NEAR_ANGLE search directions turned around (from the window to the obstruction).
+    # Rays outside -180..180 are dropped since the wedge selection would not match any cell in them.
+    near_angles = np.concatenate([np.linspace(d - tolerance, d + tolerance, ray_count) for d in (dir_low, dir_high)])
+    near_angles = near_angles[(near_angles >= -180) & (near_angles <= 180)]
+    ray_angles = np.radians(near_angles + 180)
+    ray_cos, ray_sin = np.cos(ray_angles)[:, None], np.sin(ray_angles)[:, None]
+
+    # Without an outer radius the rays run until the farthest corner of the DSM
+    max_dist = outer_radius or max(np.hypot(cx - cent_x, cy - cent_y) for cx in (dsm.x_min, dsm.x_max)
+                                   for cy in (dsm.y_min, dsm.y_max))
+
+    # The cells the rays hit that can be obstructions are kept as candidates (slope (grid_code - Z_Mean) / Distance,
+    # which orders the same way as the angle, Distance, grid_code and cell centre), and they are checked for sight
+    # like in window_oa once no cell further away could be steeper. horizon is the steepest cell of every ray so far,
+    # whether it can be an obstruction or not.
+    sight = WindowSight(dsm, cent_x, cent_y, z_mean, inner_radius)
+    candidates = np.empty((5, 0))
+    horizon = np.full((len(near_angles), 1), -np.inf)
+    start = step
+    while True:
+        # Early termination: no cell beyond this distance can have a steeper slope than the highest DSM cell would,
+        # and the rest of a ray is hidden once it has crossed a cell that steep
+        limit = (dsm_max - z_mean) / start if start <= max_dist else -np.inf
+        live = horizon[:, 0] < limit
+        if not live.any():
+            limit = -np.inf
+        check = candidates[0] >= limit
+        if check.any():
+            i = sight.steepest_visible(candidates[0, check], candidates[3, check], candidates[4, check])
+            if i is not None:
+                slope, distance, height = candidates[:3, check][:, i]
+                return float(np.degrees(np.arctan(slope))), float(distance), float(height)
+            candidates = candidates[:, ~check]
+        if limit == -np.inf:
+            break
+        ray_cos, ray_sin, horizon = ray_cos[live], ray_sin[live], horizon[live]
+
+        dists = start + step * np.arange(STEP_BLOCK)
+        dists = dists[dists <= max_dist]
+        start = dists[-1] + step
+
+        # Samples of the rays (rays x steps)
+        cols = np.floor((cent_x + ray_cos * dists - dsm.x_min) / dsm.cell_size).astype(np.int64)
+        rows = np.floor((dsm.y_max - (cent_y + ray_sin * dists)) / dsm.cell_size).astype(np.int64)
+        inside = (cols >= 0) & (cols < dsm.n_cols) & (rows >= 0) & (rows < dsm.n_rows)
+        if not inside.any():
+            continue
+
+        heights = np.full(cols.shape, np.nan)
+        heights[inside] = dsm.sample(rows[inside], cols[inside])
+        dx = cent_x - dsm.col_x(cols)
+        dy = cent_y - dsm.row_y(rows)
+        cell_dist = np.hypot(dx, dy)
+        with np.errstate(invalid="ignore"):
+            slopes = (heights - z_mean) / cell_dist
+            slopes[np.isnan(slopes)] = -np.inf
+            own = (rows == sight.own_row) & (cols == sight.own_col)
+            horizon = np.maximum(horizon, np.where(own, -np.inf, slopes).max(axis=1, keepdims=True))
+            mask = inside & (heights > z_mean) & (cell_dist >= inner_radius)
+            if outer_radius:
+                mask &= cell_dist <= outer_radius
+            mask &= in_search_wedge(np.degrees(np.arctan2(dy, dx)), dir_low, dir_high, tolerance)
+        if not mask.any():
+            continue
+
+        # A cell is sampled several times along a ray, and by neighbouring rays
+        _, first = np.unique(rows[mask] * dsm.n_cols + cols[mask], return_index=True)
+        candidates = np.concatenate([candidates, np.stack([a[mask][first] for a in (
+            slopes, cell_dist, heights, cent_x - dx, cent_y - dy)])], axis=1)
+
+    return 0.0, None, None
@@ -0,0 +1,167 @@
+import csv
+import json
+import os
+
+import numpy as np
+
+
+# The columns of the output point layer, in the same order and with the same names as the arcpy backend produces them
+RESULT_FIELDS = ["w_id", "cent_long_x", "cent_lat_y", "Z_Mean", "OA", "Distance", "grid_code", "Search_dir_low",
+                 "Search_dir_high"]
+
+# Columns that have no value for a window without obstruction cells. They hold NaN in a ResultTable, and are left
+# empty (NULL) in the output.
+OPTIONAL_FIELDS = ("Distance", "grid_code")
+
+# The w_id is a LONG field in the output, all other columns are DOUBLE fields
+RESULT_DTYPE = np.dtype([(RESULT_FIELDS[0], "<i4")] + [(name, "<f8") for name in RESULT_FIELDS[1:]])
+
+
+# The dtype of a ResultTable. With horizon_sectors the table also holds the horizon of every window (see
+# OA_horizon.window_horizon): its facing direction and the angle and distance of every sector.
+def result_dtype(horizon_sectors=None):
+    if not horizon_sectors:
+        return RESULT_DTYPE
+    return np.dtype(RESULT_DTYPE.descr + [("facing", "<f8"), ("angles", "<f4", (horizon_sectors,)),
+                                          ("distances", "<f4", (horizon_sectors,))])
+
+
+# The results of a batch of windows as one structured NumPy array with a row per window and the fixed RESULT_DTYPE
+# columns. The table is allocated once for all windows of a batch and the calculation writes into its columns in
+# place, instead of building a row (or a feature class) per window. It is written to the output in one go.
+class ResultTable:
+    __slots__ = ("array",)
+
+    def __init__(self, size=0, horizon_sectors=None, array=None):
+        if array is None:
+            array = np.zeros(size, dtype=result_dtype(horizon_sectors))
+            for name in OPTIONAL_FIELDS:
+                array[name] = np.nan
+            if horizon_sectors:
+                array["distances"] = np.nan
+        self.array = array
+
+    # A table from result rows (tuples in RESULT_FIELDS order, followed by the horizon with horizon_sectors), with
+    # None for the missing values
+    @classmethod
+    def from_rows(cls, rows, horizon_sectors=None):
+        rows = list(rows)
+        table = cls(len(rows), horizon_sectors)
+        for i, row in enumerate(rows):
+            table.array[i] = tuple(np.nan if value is None else value for value in row)
+        return table
+
+    @classmethod
+    def concatenate(cls, tables, horizon_sectors=None):
+        arrays = [table.array for table in tables if len(table)]
+        if not arrays:
+            return cls(0, horizon_sectors)
+        return cls(array=np.concatenate(arrays))
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        return ResultTable(array=self.array[index])
+
+    @property
+    def horizon_sectors(self):
+        return self.array.dtype["angles"].shape[0] if "angles" in self.array.dtype.names else None
+
+    def sorted(self):
+        return ResultTable(array=self.array[np.argsort(self.array["w_id"], kind="stable")])
+
+    # The rows of the table as tuples, like from_rows takes them
+    def rows(self):
+        optional = [RESULT_FIELDS.index(name) for name in OPTIONAL_FIELDS]
+        horizon = self.horizon_sectors is not None
+        for record in self.array:
+            row = [int(record["w_id"])] + [float(record[name]) for name in RESULT_FIELDS[1:]]
+            for i in optional:
+                if np.isnan(row[i]):
+                    row[i] = None
+            if horizon:
+                row += [float(record["facing"]), record["angles"].copy(), record["distances"].copy()]
+            yield tuple(row)
+
+    # The RESULT_FIELDS values of every row as lists of Python values, with "" for the missing values
+    def _csv_rows(self):
+        columns = self.array[RESULT_FIELDS].tolist()
+        return [["" if value != value else value for value in row] for row in columns]
+
+    def write_csv_rows(self, writer):
+        writer.writerows(self._csv_rows())
+
+    # Write the table to a CSV file if outputPath ends with .csv, a GeoParquet file if it ends with .parquet, and
+    # otherwise to a point feature class (at the window centres) with the spatial reference spatial_ref
+    def write(self, outputPath, spatial_ref=None):
+        ext = os.path.splitext(str(outputPath))[1].lower()
+        if ext == ".csv":
+            self.write_csv(outputPath)
+        elif ext == ".parquet":
+            self.write_parquet(outputPath)
+        else:
+            self.write_featureclass(outputPath, spatial_ref)
+
+    def write_csv(self, outputPath):
+        with open(outputPath, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(RESULT_FIELDS)
+            self.write_csv_rows(writer)
+
+    # The table as a pyarrow table with a WKB point (x, y, z) column "geometry" at the window centres and the
+    # GeoParquet metadata. The coordinate system is not known here, so it is given as null (unknown).
+    def to_arrow(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("Writing a GeoParquet output requires the pyarrow package")
+
+        # ISO WKB Point Z: byte order, geometry type 1001 and the three coordinates, 29 bytes per point
+        wkb = np.zeros(len(self), dtype=np.dtype([("order", "u1"), ("type", "<u4"), ("xyz", "<f8", (3,))]))
+        wkb["order"] = 1
+        wkb["type"] = 1001
+        wkb["xyz"] = np.column_stack([self.array["cent_long_x"], self.array["cent_lat_y"], self.array["Z_Mean"]])
+        offsets = np.arange(len(self) + 1, dtype=np.int32) * wkb.dtype.itemsize
+        geometry = pa.Array.from_buffers(pa.binary(), len(self), [None, pa.py_buffer(offsets),
+                                                                   pa.py_buffer(wkb.tobytes())])
+
+        columns = [pa.array(np.ascontiguousarray(self.array[name]), from_pandas=name in OPTIONAL_FIELDS)
+                   for name in RESULT_FIELDS]
+        table = pa.table(columns + [geometry], names=RESULT_FIELDS + ["geometry"])
+        geo = {"version": "1.0.0", "primary_column": "geometry",
+               "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Point Z"], "crs": None}}}
+        return table.replace_schema_metadata({b"geo": json.dumps(geo).encode()})
+
+    def write_parquet(self, outputPath):
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), outputPath)
+
+    # Write the table to a point feature class with one NumPyArrayToFeatureClass call. With append=True the rows are
+    # added to the existing feature class instead, through a feature class in the memory workspace.
+    def write_featureclass(self, outputPath, spatial_ref=None, append=False):
+        try:
+            import arcpy
+        except ImportError:
+            raise ImportError("Writing a feature class requires arcpy, use a .csv output path instead")
+
+        array = np.zeros(len(self), dtype=RESULT_DTYPE.descr + [("SHAPE_XYZ", "<f8", (3,))])
+        for name in RESULT_FIELDS:
+            array[name] = self.array[name]
+        array["SHAPE_XYZ"] = np.column_stack([self.array["cent_long_x"], self.array["cent_lat_y"],
+                                              self.array["Z_Mean"]])
+        target = r"memory\oa_result_batch" if append else outputPath
+        if arcpy.Exists(target):
+            arcpy.management.Delete(target)
+        arcpy.da.NumPyArrayToFeatureClass(array, target, ["SHAPE_XYZ"], spatial_ref)
+
+        # A NumPy array has no NULL values, the optional columns of windows without obstruction (NaN) are set to NULL
+        # afterwards. Windows with OA 0 that do have a Distance and grid_code (as from the arcpy backend) keep them.
+        with arcpy.da.UpdateCursor(target, list(OPTIONAL_FIELDS), where_clause="OA = 0") as cursor:
+            for row in cursor:
+                if any(value is not None and value != value for value in row):
+                    cursor.updateRow([None if value is None or value != value else value for value in row])
+        if append:
+            arcpy.management.Append(inputs=target, target=outputPath, schema_type="NO_TEST")
+            arcpy.management.Delete(target)
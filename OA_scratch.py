@@ -0,0 +1,31 @@
+import os
+
+
+# The workspace the intermediate datasets of a window are written to. workspace is "memory" (the in-memory workspace),
+# a geodatabase path, or None for the scratch geodatabase of the environment. Every dataset named through name() is
+# remembered, and clear() deletes them once the result of the window has been extracted, so the scratch workspace does
+# not grow with the number of windows.
+class ScratchWorkspace:
+
+    def __init__(self, workspace="memory"):
+        import arcpy
+
+        self.workspace = workspace or arcpy.env.scratchGDB
+        self.datasets = []
+
+    # The path of a new intermediate dataset
+    def name(self, baseName):
+        if self.workspace == "memory":
+            path = "memory\\{0}".format(baseName)
+        else:
+            path = os.path.join(self.workspace, baseName)
+        self.datasets.append(path)
+        return path
+
+    def clear(self):
+        import arcpy
+
+        for dataset in reversed(self.datasets):
+            if arcpy.Exists(dataset):
+                arcpy.management.Delete(dataset)
+        self.datasets = []
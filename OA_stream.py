@@ -0,0 +1,258 @@
+import csv
+import json
+import os
+
+from OA_cache import DSMFingerprints, ResultCache, cache_path, sidecar_path
+from OA_dsm import load_dsm
+from OA_engine import (INNER_RADIUS, SEARCH_TOLERANCE, calculate_batch, create_results_featureclass,
+                       obstruction_index, read_windows, windows_pool, windows_spatial_reference)
+from OA_horizon import HorizonStore, horizon_path, sweep_sectors
+from OA_log import add_message
+from OA_profile import Profiler
+from OA_raymarch import RAY_COUNT
+from OA_results import RESULT_FIELDS, ResultTable
+
+
+# Number of windows that are read, calculated and written to the output together in a streaming run
+BATCH_SIZE = 1000
+
+
+# Read the windows in chunks of chunk_size, skipping the first `start` windows (the ones an interrupted run has already
+# written). Yields (window_ids, window_vertices) lists, the w_id being the position of the window in the input.
+def read_window_chunks(windows, chunk_size=BATCH_SIZE, start=0):
+    window_ids, window_vertices = [], []
+    for w_id, vertices in enumerate(read_windows(windows), start=1):
+        if w_id <= start:
+            continue
+        window_ids.append(w_id)
+        window_vertices.append(vertices)
+        if len(window_ids) == chunk_size:
+            yield window_ids, window_vertices
+            window_ids, window_vertices = [], []
+    if window_ids:
+        yield window_ids, window_vertices
+
+
+# The progress of a streaming run, stored as a small JSON file next to the output: the w_id of the last window that
+# has been written to the output, the state of the output writer and the settings of the run. The file is replaced
+# atomically, so it always describes a complete batch.
+class Checkpoint:
+
+    def __init__(self, outputPath, settings):
+        self.path = sidecar_path(outputPath, ".oacheckpoint.json")
+        self.settings = settings
+
+    # The saved state, or None if there is none or it was saved by a run with other settings
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get("settings") != self.settings:
+            add_message("The checkpoint {0} is from a run with other settings, starting from the first window".format(
+                self.path))
+            return None
+        return state
+
+    def save(self, w_id, **writerState):
+        state = dict(writerState, w_id=w_id, settings=self.settings)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# Appends result rows to a CSV output. When a run is resumed the file is cut back to the size it had at the last
+# checkpoint, which drops the rows of a batch that was only partly written.
+class CSVResultWriter:
+
+    def __init__(self, outputPath, offset=None):
+        if offset is None:
+            self.file = open(outputPath, "w", newline="")
+            csv.writer(self.file).writerow(RESULT_FIELDS)
+        else:
+            os.truncate(outputPath, offset)
+            self.file = open(outputPath, "a", newline="")
+        self.writer = csv.writer(self.file)
+
+    def append(self, results):
+        results.write_csv_rows(self.writer)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def state(self):
+        return {"offset": os.fstat(self.file.fileno()).st_size}
+
+    def close(self):
+        self.file.close()
+
+
+# Appends result rows to a point feature class output, with one bulk write per batch. When a run is resumed the rows
+# after the last checkpoint are deleted.
+class FeatureClassResultWriter:
+
+    def __init__(self, outputPath, spatial_ref, resumeAfter=None):
+        import arcpy
+
+        self.outputPath = outputPath
+        if resumeAfter is None:
+            create_results_featureclass(outputPath, spatial_ref)
+        else:
+            with arcpy.da.UpdateCursor(outputPath, ["w_id"], where_clause="w_id > {0}".format(int(resumeAfter))) \
+                    as cursor:
+                for _ in cursor:
+                    cursor.deleteRow()
+
+    def append(self, results):
+        results.write_featureclass(self.outputPath, append=True)
+
+    def state(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+# Appends result rows to a GeoParquet output, one row group per batch. A Parquet file cannot be cut back to an earlier
+# row group, so a run with a Parquet output always starts from the first window.
+class ParquetResultWriter:
+
+    def __init__(self, outputPath):
+        self.outputPath = outputPath
+        self.writer = None
+
+    def append(self, results):
+        table = results.to_arrow()
+        if self.writer is None:
+            import pyarrow.parquet as pq
+
+            self.writer = pq.ParquetWriter(self.outputPath, table.schema)
+        self.writer.write_table(table)
+
+    def state(self):
+        return {}
+
+    def close(self):
+        if self.writer is None:
+            ResultTable().write_parquet(self.outputPath)
+        else:
+            self.writer.close()
+
+
+# The output of a run, written in batches. ResultTables (or lists of result rows) are added in w_id order and written
+# to the output every batch_size rows, after which a Checkpoint is saved, so memory use does not grow with the number
+# of windows and an interrupted run can continue after the last written window (last_w_id). Without a batch_size all
+# rows are kept and written in one go when the output is closed, and no checkpoint is saved. With a horizon_step the
+# tables hold the horizon of every window, which is written to a HorizonStore next to the output.
+class BatchOutput:
+
+    def __init__(self, outputPath, settings, batch_size=None, spatial_ref=None, resume=True, profiler=None,
+                 horizon_step=None):
+        self.batch_size = batch_size
+        self.profiler = profiler or Profiler()
+        self.horizon_sectors = sweep_sectors(horizon_step) if horizon_step else None
+        self.checkpoint = Checkpoint(outputPath, settings)
+        ext = os.path.splitext(str(outputPath))[1].lower()
+        state = self.checkpoint.load() if batch_size and resume and ext != ".parquet" else None
+        self.last_w_id = state["w_id"] if state else 0
+        self.tables = []
+        self.n_rows = 0
+
+        if ext == ".csv":
+            self.writer = CSVResultWriter(outputPath, state["offset"] if state else None)
+        elif ext == ".parquet":
+            self.writer = ParquetResultWriter(outputPath)
+        else:
+            try:
+                import arcpy
+            except ImportError:
+                raise ImportError("Writing a feature class requires arcpy, use a .csv output path instead")
+            self.writer = FeatureClassResultWriter(outputPath, spatial_ref, self.last_w_id if state else None)
+        self.horizons = None
+        if horizon_step:
+            self.horizons = HorizonStore(horizon_path(outputPath), horizon_step, keep=state is not None)
+        if self.last_w_id:
+            add_message("Resuming after window {0}".format(self.last_w_id))
+
+    def add(self, results):
+        if not isinstance(results, ResultTable):
+            results = ResultTable.from_rows(results, self.horizon_sectors)
+        self.tables.append(results)
+        self.n_rows += len(results)
+        while self.batch_size and self.n_rows >= self.batch_size:
+            self.flush(self.batch_size)
+
+    def flush(self, n_rows=None):
+        if not self.n_rows:
+            return
+        pending = ResultTable.concatenate(self.tables, self.horizon_sectors)
+        batch = pending[:n_rows] if n_rows else pending
+        with self.profiler.stage("write") as stage:
+            self.writer.append(batch)
+            if self.horizons:
+                self.horizons.put(batch)
+            stage["rows"] = len(batch)
+        self.last_w_id = int(batch.array["w_id"][-1])
+        if self.batch_size:
+            self.checkpoint.save(self.last_w_id, **self.writer.state())
+        self.tables = [pending[len(batch):]]
+        self.n_rows = len(pending) - len(batch)
+
+    # Write the remaining rows. The run is complete, so the checkpoint is removed and the next run starts over.
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.horizons:
+            self.horizons.close()
+        self.checkpoint.remove()
+
+
+# OAcalc_numpy as a streaming run: the windows are read batch_size at a time, calculated and written to the output
+# before the next batch is read, so memory use stays flat for any number of windows. After every batch a checkpoint is
+# saved next to the output, and with resume=True a run with the same settings continues after the last window written
+# by an interrupted run. With workers the same pool of worker processes calculates all batches, and every worker loads
+# the DSM (and builds the index) once. Returns the number of windows in the output.
+def OAcalc_stream(windows, DSM, outputPath, inner_radius=INNER_RADIUS, outer_radius=None,
+                  tolerance=SEARCH_TOLERANCE, search="cells", ray_count=RAY_COUNT, workers=1, tile_size=None,
+                  cache=False, profile=None, batch_size=BATCH_SIZE, resume=True, horizon_step=None):
+    profiler = Profiler(profile)
+    # Worker processes open the DSM themselves, so it is only opened here if it is needed in this process
+    dsm = DSM if workers > 1 and not cache else load_dsm(DSM, tile_size)
+
+    settings = {"windows": windows if isinstance(windows, str) else None, "DSM": DSM if isinstance(DSM, str) else None,
+                "inner_radius": inner_radius, "outer_radius": outer_radius, "tolerance": tolerance, "search": search,
+                "ray_count": ray_count, "tile_size": tile_size, "horizon_step": horizon_step}
+    output = BatchOutput(outputPath, settings, batch_size, windows_spatial_reference(windows), resume, profiler,
+                         horizon_step)
+    resultCache = ResultCache(cache_path(outputPath)) if cache else None
+    fingerprints = DSMFingerprints(dsm) if cache else None
+
+    # The index of the first batch is kept for the next batches, and only built again for a batch with a lower window
+    index = None
+    resumed = output.last_w_id > 0
+    pool = windows_pool(DSM, workers, tile_size) if workers > 1 else None
+    try:
+        for window_ids, window_vertices in read_window_chunks(windows, batch_size, output.last_w_id):
+            if search == "index" and workers == 1:
+                index = obstruction_index(dsm, window_vertices, index, profiler)
+            output.add(calculate_batch(window_vertices, window_ids, dsm if workers == 1 else DSM, inner_radius,
+                                       outer_radius, tolerance, search, ray_count, workers, tile_size, resultCache,
+                                       fingerprints, index, profiler, horizon_step, pool))
+            add_message("{0} windows calculated, {1} written".format(window_ids[-1], output.last_w_id))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if cache:
+        # A resumed run has not looked up the windows written before the checkpoint, so their results are kept
+        if not resumed:
+            add_message("Result cache: {0} results no longer used removed".format(resultCache.prune()))
+        resultCache.close()
+    output.close()
+    profiler.summary()
+    return output.last_w_id
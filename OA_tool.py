@@ -1,393 +1,655 @@
-import arcpy
-from sys import argv
-from arcpy.sa import *
-
-
-def OAcalc(windows, DSM, outputPath):
+import argparse
+import logging
+import os
+import sys
+
+import OA_engine
+import OA_parallel
+import OA_stream
+from OA_profile import Profiler
+from OA_scratch import ScratchWorkspace
+from OA_validate import validate
+
+# The backends of OAcalc
+BACKENDS = ("arcpy", "numpy")
+
+
+# A parameter of OAcalc converted with convert, or default if it is not given. The toolbox passes a parameter that is
+# left empty as "" or "#", so 0 can still be given as a value.
+def toolParameter(value, convert, default=None):
+    if value is None or (isinstance(value, str) and value.strip() in ("", "#")):
+        return default
+    return convert(value)
+
+
+def OAcalc(windows, DSM, outputPath, backend="arcpy", search="cells", workers=1, scratchWorkspace="memory",
+           tileSize=None, outerRadius=None, cache=False, profile=None, batchSize=None, horizonStep=None,
+           innerRadius=None, tolerance=None):
+
+    # The NumPy backend reads the DSM into memory once and does the whole calculation without geoprocessing tools.
+    # search="raymarch" only samples the DSM along rays inside the search wedges (NumPy backend only).
+    # search="bilinear" or "bicubic" interpolates the DSM heights along the rays, with the earth curvature and
+    # refraction correction (NumPy backend only).
+    # workers > 1 processes the windows in that many worker processes.
+    # scratchWorkspace is where the intermediate datasets of each window are written: "memory" (default), a
+    # geodatabase path, or "scratchGDB" for the scratch geodatabase of the environment.
+    # tileSize reads the DSM in tiles of that many cells (NumPy backend only), so it does not have to fit in memory.
+    # Every window then only reads the tiles within outerRadius (500 m if there is none).
+    # cache=True keeps the results in a SQLite file next to the output and only recalculates the windows whose
+    # vertices or surrounding DSM tiles have changed since the last run (NumPy backend only).
+    # profile is the path of a JSON lines trace with the time, memory growth and rows of every stage of every window.
+    # A summary table of the stages is reported at the end of the run.
+    # batchSize writes the results to the output every batchSize windows and saves a checkpoint next to it. If the run
+    # is interrupted, the next run with the same inputs continues after the last window that was written.
+    # horizonStep also sweeps the horizon of every window over its 180 degree field of view in sectors of that many
+    # degrees, and stores the angles, distances and sky view factor in a file next to the output (NumPy backend only).
+    # innerRadius and tolerance are the inner radius of the viewshed (16 m) and the +- angle (5 degrees) around the
+    # search directions in which obstructions are looked for.
+    # arcpy is only imported for the arcpy backend, or by the NumPy backend when it reads or writes a feature class.
+    backend = toolParameter(backend, str, "arcpy")
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {0}, use one of {1}".format(backend, ", ".join(BACKENDS)))
+    search = toolParameter(search, str, "cells")
+    # The rest of the tool (and ScratchWorkspace) takes "" for the scratch geodatabase of the environment
+    scratchWorkspace = toolParameter(scratchWorkspace, lambda value: "" if value == "scratchGDB" else value, "memory")
+    profile = toolParameter(profile, str)
+    workers = toolParameter(workers, int, 1)
+    batchSize = toolParameter(batchSize, int) or None
+    innerRadius = toolParameter(innerRadius, float, OA_engine.INNER_RADIUS)
+    outerRadius = toolParameter(outerRadius, float)
+    tolerance = toolParameter(tolerance, float, OA_engine.SEARCH_TOLERANCE)
+    if backend == "numpy":
+        settings = dict(inner_radius=innerRadius, outer_radius=outerRadius, tolerance=tolerance, search=search,
+                        workers=workers,
+                        tile_size=toolParameter(tileSize, int), cache=str(cache).lower() in ("true", "1"),
+                        profile=profile, horizon_step=toolParameter(horizonStep, float))
+        if batchSize:
+            OA_stream.OAcalc_stream(windows, DSM, outputPath, batch_size=batchSize, **settings)
+        else:
+            OA_engine.OAcalc_numpy(windows, DSM, outputPath, **settings)
+        return
+
+    import arcpy
 
     arcpy.env.overwriteOutput = True
+    profiler = Profiler(profile)
 
     ### Save the coordinate system of the window data in a variable. It will be used in multiple tools later on.
     spatial_ref = arcpy.Describe(windows).spatialReference
 
-    # Loop through each window in the input data
-    wFields = ['OBJECTID', 'SHAPE@']  # The fields of the input windows that will be used
-    with arcpy.da.SearchCursor(windows, wFields) as cursor:
+    # The result row of each window is collected in the output, which writes the rows to the output point feature
+    # class every batchSize windows (or all at once after the last window without a batchSize). The points are at
+    # the window centres, for visualization and to access the table.
+    searchArea = {"innerRadius": innerRadius, "outerRadius": outerRadius, "tolerance": tolerance}
+    windowOutputData = OA_stream.BatchOutput(outputPath, dict(searchArea, backend="arcpy", windows=windows, DSM=DSM),
+                                             batchSize, spatial_ref, profiler=profiler)
+    firstID = windowOutputData.last_w_id + 1  # Windows before this one were written by an interrupted run
+
+    if workers > 1:
+        for windowRows in OAcalc_parallel(windows, DSM, workers, scratchWorkspace, profiler, firstID, batchSize,
+                                          searchArea):
+            windowOutputData.add(windowRows)
+    else:
+        scratch = ScratchWorkspace(scratchWorkspace)
+
+        # Loop through each window in the input data
+        wFields = ['OBJECTID', 'SHAPE@']  # The fields of the input windows that will be used
+        with arcpy.da.SearchCursor(windows, wFields) as cursor:
+
+            windowID = 1  # The ID given to each window - Value increases by one each loop
+
+            for row in cursor:
+                if windowID >= firstID:
+                    windowOutputData.add([OAwindow(row[1], windowID, DSM, spatial_ref, scratch, profiler,
+                                                   **searchArea)])
+                windowID += 1  # Increment the window ID, so the next window will have another ID value.
+
+    arcpy.AddMessage("Writing the results to the output...")
+    windowOutputData.close()
+    profiler.summary()
+
+
+# The number of rows of a dataset or layer
+def rowCount(data):
+    import arcpy
+
+    return int(arcpy.management.GetCount(data)[0])
+
+
+# Calculate the obstruction angle of one window (the multipatch geometry windowShape). The intermediate datasets are
+# written to the ScratchWorkspace scratch. Returns the result row of the window, with the values in
+# OA_engine.RESULT_FIELDS order. The time, memory and rows of each group are recorded by the Profiler profiler.
+# Obstructions are looked for between innerRadius and outerRadius (no limit if None) from the window, within
+# +- tolerance degrees of the search directions.
+def OAwindow(windowShape, windowID, DSM, spatial_ref, scratch, profiler, innerRadius=OA_engine.INNER_RADIUS,
+             outerRadius=None, tolerance=OA_engine.SEARCH_TOLERANCE):
+    import arcpy
+    import arcpy.sa
+
+    ### Find centroid point of Window ###
+    arcpy.AddMessage("Calculating window {0}".format(windowID))
+    profiler.begin("centroid", windowID)
+
+    # Process: Feature Vertices To Points (Feature Vertices To Points) (management)
+    # Add points to each vertex of the input window
+    windows_FVtP = arcpy.management.FeatureVerticesToPoints(in_features=windowShape,
+                                                            out_feature_class=scratch.name("windows_FVtP"),
+                                                            point_location="ALL")
+
+    # Process: Add Field (2) (Add Field) (management)
+    # Add a field for the window ID (w_id)
+    windows_add_wID = arcpy.management.AddField(in_table=windows_FVtP, field_name="w_id", field_type="SHORT",
+                                                field_precision=None, field_scale=None, field_length=None,
+                                                field_alias="w_id", field_is_nullable="NULLABLE",
+                                                field_is_required="NON_REQUIRED", field_domain="")[0]
+
+    # Process: Calculate Field (7) (Calculate Field) (management)
+    # Add the variable windowID to the window field w_id
+    windows_calc_wID = \
+        arcpy.management.CalculateField(in_table=windows_add_wID, field="w_id", expression=f"int({windowID})",
+                                        expression_type="PYTHON3", code_block="", field_type="TEXT")[0]
+
+    # Process: Points To Line (Points To Line) (management)
+    # "Fill" the window by drawing lines from each vertex point. This will be used to find the centroid coord
+    windows_p_to_lines = arcpy.management.PointsToLine(Input_Features=windows_calc_wID,
+                                                       Output_Feature_Class=scratch.name("windows_p_to_lines"),
+                                                       Line_Field="w_id", Sort_Field="", Close_Line="NO_CLOSE")
+
+    # Process: Add Z Information (2) (Add Z Information) (3d)
+    # Add a field to the data with the mean Z height (this is the same height the window has at its centre)
+    windows_p_to_lines_zInfo = \
+        arcpy.ddd.AddZInformation(in_feature_class=windows_p_to_lines, out_property=["Z_MEAN"],
+                                  noise_filtering="")[
+            0]
+
+    # Process: Add Fields (multiple) (2) (Add Fields (multiple)) (management)
+    # Add two new fields where the coordinate of the centre point of the window will be stored
+    windows_p_to_lines_addFields = arcpy.management.AddFields(in_table=windows_p_to_lines_zInfo,
+                                                              field_description=[
+                                                                  ["cent_long_x", "DOUBLE", "", "", "", ""],
+                                                                  ["cent_lat_y", "DOUBLE", "", "", "", ""]])[0]
+
+    # Process: Calculate Geometry Attributes (Calculate Geometry Attributes) (management)
+    # Calculate the centre coordinate in X and Y direction, then add it to the new fields from the previous step
+    with arcpy.EnvManager(
+            outputCoordinateSystem=spatial_ref):
+        windows_centroid_coord = \
+            arcpy.management.CalculateGeometryAttributes(in_features=windows_p_to_lines_addFields,
+                                                         geometry_property=[["cent_long_x", "CENTROID_X"],
+                                                                            ["cent_lat_y", "CENTROID_Y"]],
+                                                         length_unit="", area_unit="",
+                                                         coordinate_system=spatial_ref,
+                                                         coordinate_format="SAME_AS_INPUT")[0]
+
+    # Process: XY Table To Point (XY Table To Point) (management)
+    # Create points at the window centre location
+    windows_centroid_points = arcpy.management.XYTableToPoint(in_table=windows_centroid_coord,
+                                                              out_feature_class=scratch.name(
+                                                                  "windows_centroid_points"),
+                                                              x_field="cent_long_x", y_field="cent_lat_y",
+                                                              z_field="Z_Mean",
+                                                              coordinate_system=spatial_ref)
+    profiler.end(rows=lambda: rowCount(windows_centroid_points))
+    ### ----------- end of group ----------- ###
+
+    ### Find obstruction points and calculate the obstructio angle ###
+    arcpy.AddMessage("Finding the obstruction points and calculating the obstruction angle...")
+    profiler.begin("obstruction extraction", windowID)
+    # Process: Viewshed 2 (Viewshed 2) (3d)
+    # Create a raster displaying what can be seen from the window centre
+    # Changed property: inner_radius: Only look for cells further than 4 meters away from the window
+    Output_above_ground_level_raster_2_ = ""
+    Output_observer_region_relationship_table = ""
+    viewshed = arcpy.ddd.Viewshed2(in_raster=DSM, in_observer_features=windows_centroid_points,
+                                   out_raster=scratch.name("viewshed"),
+                                   out_agl_raster=Output_above_ground_level_raster_2_,
+                                   analysis_type="FREQUENCY", vertical_error="0 Meters",
+                                   out_observer_region_relationship_table=Output_observer_region_relationship_table,
+                                   refractivity_coefficient=0.13, surface_offset="0 Meters",
+                                   observer_elevation="Z_Mean", observer_offset="0 Meters",
+                                   inner_radius="{0} Meters".format(innerRadius), inner_radius_is_3d="GROUND",
+                                   outer_radius="{0} Meters".format(outerRadius) if outerRadius else "",
+                                   outer_radius_is_3d="GROUND", horizontal_start_angle=0,
+                                   horizontal_end_angle=360, vertical_upper_angle=90, vertical_lower_angle=-90,
+                                   analysis_method="ALL_SIGHTLINES")
+
+    # Process: Select Layer By Attribute (2) (Select Layer By Attribute) (management)
+    # Only select the cells that can be seen (value = 1)
+    viewshed_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=viewshed,
+                                                              selection_type="NEW_SELECTION",
+                                                              where_clause="Value > 0", invert_where_clause="")
+
+    # Find field value of window height (to use in raster calculator)
+    field_z = ['Z_Mean']
+    windowHeight = 0
+    with arcpy.da.SearchCursor(windows_centroid_points, field_z) as cursor2:
+        for r in cursor2:
+            windowHeight = r[0]
+            break
+
+    # The extract by mask and extract by attributes tools in the next lines are used to first find the DSM
+    # cells within the viewshed and then only select the ones with higher values than the window Process:
+    # Extract by Mask (Extract by Mask) (sa)
+    # The Spatial Analyst rasters are saved in the scratch workspace, so they are deleted with the other datasets
+    find_high_elev_cells = arcpy.sa.ExtractByMask(in_raster=DSM, in_mask_data=viewshed_select)
+    find_high_elev_cells.save(scratch.name("find_high_elev_cells"))
+    # Process: Extract by Attributes (Extract by Attributes) (sa)
+    find_high_elev_cells2 = arcpy.sa.ExtractByAttributes(in_raster=find_high_elev_cells,
+                                                         where_clause="Value > {}".format(windowHeight))
+    find_high_elev_cells2.save(scratch.name("find_high_elev_cells2"))
+    # Process: Raster to Point (Raster to Point) (conversion)
+    with arcpy.EnvManager(outputMFlag="Disabled", outputZFlag="Disabled"):
+        high_elev_points = arcpy.conversion.RasterToPoint(in_raster=find_high_elev_cells2,
+                                                          out_point_features=scratch.name("high_elev_points"),
+                                                          raster_field="VALUE")
+
+    # Process: Add XY Coordinates (Add XY Coordinates) (management)
+    # Add new XY coordinates to the window centres
+    with arcpy.EnvManager(
+            outputCoordinateSystem=spatial_ref):
+        windows_centroid_points_newZ_coords = arcpy.management.AddXY(in_features=windows_centroid_points)[0]
+
+    # Process: Spatial Join (2) (Spatial Join) (analysis)
+    # Join the table of the high elevation points (from the viewshed) and the window midpoints.
+    highPoints_windows_join = arcpy.analysis.SpatialJoin(target_features=high_elev_points,
+                                                         join_features=windows_centroid_points_newZ_coords,
+                                                         out_feature_class=scratch.name("highPoints_windows_join"),
+                                                         join_operation="JOIN_ONE_TO_ONE", join_type="KEEP_ALL",
+                                                         match_option="CLOSEST", search_radius="",
+                                                         distance_field_name="Distance")
+
+    # Process: Add Field (4) (Add Field) (management)
+    # Adding a field where the obstruction angle (OA) value will be added
+    highPointsAddField = \
+        arcpy.management.AddField(in_table=highPoints_windows_join, field_name="OA", field_type="DOUBLE",
+                                  field_precision=None, field_scale=None, field_length=None, field_alias="OA",
+                                  field_is_nullable="NULLABLE", field_is_required="NON_REQUIRED",
+                                  field_domain="")[
+            0]
+    profiler.end(rows=lambda: rowCount(highPointsAddField))
+
+    ### ----------- end of group ----------- ###
+
+    ## Find search Direction (perpendicular to window) ###
+    # Here the window vertices are used to find the direction the window is "looking"
+    arcpy.AddMessage("Finding search Direction (perpendicular to window)...")
+    profiler.begin("search direction", windowID)
+
+    # Process: Add Z Information (3) (Add Z Information) (3d)
+    # Add Z information to the vertices
+    windows_zInfo = \
+        arcpy.ddd.AddZInformation(in_feature_class=windows_calc_wID, out_property=["Z"], noise_filtering="")[0]
+
+    # Process: Select Layer By Attribute (3) (Select Layer By Attribute) (management)
+    # Select the vertices that are greater than the mean height of the vertices. The point of this is to only
+    # select vertices at the same height, before the angle between these points are then calculated later
+    windows_zInfo_field = ['Z']
+    windows_zInfo_mean = 0
+    rowCounter = 0
+    with arcpy.da.SearchCursor(windows_zInfo, windows_zInfo_field) as cursor3:
+        for r3 in cursor3:
+            windows_zInfo_mean += int(r3[0])
+            rowCounter += 1
+    windows_zInfo_mean = windows_zInfo_mean / rowCounter
+    windows_zInfo_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windows_zInfo,
+                                                                   selection_type="NEW_SELECTION",
+                                                                   where_clause="Z > {}".format(
+                                                                       windows_zInfo_mean),
+                                                                   invert_where_clause="")
+
+    # Process: Copy Features (Copy Features) (management)
+    windowVerticesMaxZ = arcpy.management.CopyFeatures(in_features=windows_zInfo_select,
+                                                       out_feature_class=scratch.name("windowVerticesMaxZ"),
+                                                       config_keyword="",
+                                                       spatial_grid_1=None, spatial_grid_2=None,
+                                                       spatial_grid_3=None)
+
+    # Process: Select Layer By Attribute (4) (Select Layer By Attribute) (management)
+    # In case there are more than two vertices of the highest Z value -> select only two of them.
+    windowVerticesMaxZ_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windowVerticesMaxZ,
+                                                                        selection_type="NEW_SELECTION",
+                                                                        where_clause="OBJECTID = 1 Or "
+                                                                                     "OBJECTID = 2",
+                                                                        invert_where_clause="")
+
+    # Process: Copy Features (2) (Copy Features) (management)
+    windowVerticesMaxZ_twoP = arcpy.management.CopyFeatures(in_features=windowVerticesMaxZ_select,
+                                                            out_feature_class=scratch.name("windowVerticesMaxZ_twoP"),
+                                                            config_keyword="", spatial_grid_1=None,
+                                                            spatial_grid_2=None, spatial_grid_3=None)
+
+    # Process: Near 3D (Near 3D) (3d)
+    # Calculate angle between the two vertices
+    windowAngle = arcpy.ddd.Near3D(in_features=windowVerticesMaxZ_twoP, near_features=[windowVerticesMaxZ_twoP],
+                                   search_radius="", location="NO_LOCATION", angle="ANGLE", delta="NO_DELTA")[0]
+
+    # Process: Add Field (Add Field) (management)
+    # Add a field for the search direction values (degrees)
+    windowSearchDir = \
+        arcpy.management.AddField(in_table=windowAngle, field_name="Search_Direction",
+                                  field_type="DOUBLE", field_precision=None, field_scale=None,
+                                  field_length=None,
+                                  field_alias="Search_Direction", field_is_nullable="NULLABLE",
+                                  field_is_required="NON_REQUIRED", field_domain="")[0]
+
+    # Process: Calculate Field (5) (Calculate Field) (management)
+    # Change the angle-value of the direction between the two vertices to the same as default in ArcGIS Pro -
+    # North is -90 degrees, east is +- 180 degrees, south is 90, west is 0.
+    windowSearchDir2 = \
+        arcpy.management.CalculateField(in_table=windowSearchDir, field="Search_Direction",
+                                        expression="Opposite(!NEAR_ANG_H!)", expression_type="PYTHON3",
+                                        code_block="""def Opposite(NEAR_ANG_H):
+        if (NEAR_ANG_H <= 0):
+            return NEAR_ANG_H + 90
+        elif (NEAR_ANG_H >= 90):
+            return -180 + NEAR_ANG_H -90
+        elif (NEAR_ANG_H > 0):
+            return NEAR_ANG_H + 90
+    """, field_type="TEXT")[0]
+
+    # Process: Select Layer By Attribute (6) (Select Layer By Attribute) (management)
+    # Select only one of the window vertices
+    windowSearchDir2_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windowSearchDir2,
+                                                                      selection_type="NEW_SELECTION",
+                                                                      where_clause="OBJECTID = 1",
+                                                                      invert_where_clause="")
+
+    # Process: Select Layer By Attribute (7) (Select Layer By Attribute) (management)
+    # Select only one of the window vertices
+    windowSearchDir2_select2 = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windowSearchDir2,
+                                                                       selection_type="NEW_SELECTION",
+                                                                       where_clause="OBJECTID = 2",
+                                                                       invert_where_clause="")
+
+    # Process: Copy Features (3) (Copy Features) (management)
+    windowSearchDir2_select_copy = arcpy.management.CopyFeatures(in_features=windowSearchDir2_select,
+                                                                 out_feature_class=scratch.name(
+                                                                     "windowSearchDir2_select_copy"),
+                                                                 config_keyword="", spatial_grid_1=None,
+                                                                 spatial_grid_2=None, spatial_grid_3=None)
+
+    # Process: Copy Features (4) (Copy Features) (management)
+    windowSearchDir2_select2_copy = arcpy.management.CopyFeatures(in_features=windowSearchDir2_select2,
+                                                                  out_feature_class=scratch.name(
+                                                                      "windowSearchDir2_select2_copy"),
+                                                                  config_keyword="", spatial_grid_1=None,
+                                                                  spatial_grid_2=None, spatial_grid_3=None)
+
+    # Process: Alter Field (3) (Alter Field) (management)
+    # In this and the next process I am changing the search direction field to search direction "high" and "low"
+    # These fields will have new values that will be used in the search direction calculation
+    windowSearchDir2_select_copy_alter = \
+        arcpy.management.AlterField(in_table=windowSearchDir2_select_copy, field="Search_Direction",
+                                    new_field_name="Search_dir_low", new_field_alias="Search_dir_low",
+                                    field_type="", field_length=8, clear_field_alias="DO_NOT_CLEAR")[0]
+
+    # Process: Alter Field (4) (Alter Field) (management)
+    windowSearchDir2_select2_copy_alter = \
+        arcpy.management.AlterField(in_table=windowSearchDir2_select2_copy, field="Search_Direction",
+                                    new_field_name="Search_dir_high", new_field_alias="Search_dir_high",
+                                    field_type="", field_length=8, clear_field_alias="DO_NOT_CLEAR")[0]
+    profiler.end(rows=lambda: rowCount(windowVerticesMaxZ_twoP))
+
+    # ### ----------- end of group ----------- ###
+
+    ### Find obstruction angle points within the search direction (parallel to window) ###
+    profiler.begin("wedge selection", windowID)
+    # Process: Near (Near) (analysis)
+    # Run the near tool (angle) from all the obstruction points to the window midpoints
+    windowToObstructionAngle = arcpy.analysis.Near(in_features=highPointsAddField,
+                                                   near_features=[windows_centroid_points],
+                                                   search_radius="", location="NO_LOCATION", angle="ANGLE",
+                                                   method="PLANAR", field_names=[["NEAR_ANGLE", "NEAR_ANGLE"]])[
+        0]
+
+    # Process: Join Field (Join Field) (management)
+    # Join the obstruciton points (with an angle to the window midpoint) with the table of one of the window
+    # vertices (search direction low)
+    angleJoinField = arcpy.management.JoinField(in_data=windowToObstructionAngle, in_field="w_id",
+                                                join_table=windowSearchDir2_select_copy_alter,
+                                                join_field="w_id", fields=["Search_dir_low"])[0]
+
+    # Process: Join Field (2) (Join Field) (management)
+    # Same as the one above, just search direction high
+    angleJoinField2 = arcpy.management.JoinField(in_data=angleJoinField, in_field="w_id",
+                                                 join_table=windowSearchDir2_select2_copy_alter,
+                                                 join_field="w_id", fields=["Search_dir_high"])[0]
+
+    # Process: Select Layer By Attribute (5) (Select Layer By Attribute) (management)
+    # Select the obstruction points that are within the search direction of the window. These are points that
+    # have "opposite" angles of the window. In addition there is a +- 5 degree "buffer" added, to include
+    # obstruction points that are almost perpendicular to the window. As an example, if the two window vertices
+    # (corners) have the nagle of 90 and -90 degrees between each other (north and south), then this process
+    # will look for obstruction points between 0 (+- 5 degrees) and 180 (+- 5 degrees).
+    perpendicular_points = arcpy.management.SelectLayerByAttribute(in_layer_or_view=angleJoinField2,
+                                                                   selection_type="NEW_SELECTION",
+                                                                   where_clause="(NEAR_ANGLE >= ("
+                                                                                "Search_dir_low - {0}) And "
+                                                                                "NEAR_ANGLE <= ("
+                                                                                "Search_dir_low + {0})) Or ("
+                                                                                "NEAR_ANGLE >= ("
+                                                                                "Search_dir_high - {0}) And ("
+                                                                                "NEAR_ANGLE <= "
+                                                                                "Search_dir_high + {0}))".format(
+                                                                                    tolerance),
+                                                                   invert_where_clause="NON_INVERT")
+
+    # Process: Copy Features (6) (Copy Features) (management)
+    perpendicular_points_copy = arcpy.management.CopyFeatures(in_features=perpendicular_points,
+                                                              out_feature_class=scratch.name(
+                                                                  "perpendicular_points_copy"),
+                                                              config_keyword="", spatial_grid_1=None,
+                                                              spatial_grid_2=None, spatial_grid_3=None)
+    profiler.end(rows=lambda: rowCount(perpendicular_points_copy))
+
+    # Process: Calculate Field (4) (Calculate Field) (management)
+    profiler.begin("OA calc", windowID)
+    # Calculating the OA for the window
+    # grid_code = Height of the obstruction point
+    # Z_mean = The height of the window midpoint
+    # Distance = The distance from the window midpoint to the obstruction point in 2D (meaning height
+    # differences are not included)
+    # highPoints_all_values =
+    OA_calc = arcpy.management.CalculateField(in_table=perpendicular_points_copy, field="OA",
+                                              expression="math.degrees(math.atan(("
+                                                         "!grid_code!-!Z_Mean!)/(!Distance!)))",
+                                              expression_type="PYTHON3", code_block="",
+                                              field_type="TEXT")[0]
+
+    # Process: Select Layer By Attribute (Select Layer By Attribute) (management)
+    # Only select the obstruction point with the highest value
+    windows_OA_field = ['OA']
+    OAValues = []
+    with arcpy.da.SearchCursor(OA_calc, windows_OA_field) as cursor4:
+        for r4 in cursor4:
+            OAValues.append(float(r4[0]))
+
+    # In case there are no obstruction points - take the window midpoint and set the OA value to 0
+    if len(OAValues) == 0:
+        NoOutputSelect = arcpy.management.SelectLayerByAttribute(in_layer_or_view=angleJoinField2,
+                                                                 selection_type="NEW_SELECTION",
+                                                                 where_clause="OBJECTID = 1",
+                                                                 invert_where_clause="")
+
+        NoOutputCopy = arcpy.management.CopyFeatures(in_features=NoOutputSelect,
+                                                     out_feature_class=scratch.name("NoOutputCopy"),
+                                                     config_keyword="", spatial_grid_1=None,
+                                                     spatial_grid_2=None, spatial_grid_3=None)
+
+        NoOAOutput = arcpy.management.CalculateField(in_table=NoOutputCopy,
+                                                     field="OA", expression="0",
+                                                     expression_type="PYTHON3",
+                                                     code_block="", field_type="TEXT")[0]
+
+        windowOutput = NoOAOutput
+
+    # If there are obstruction points, set it to the highest value (max)
+    else:
+        maxOAValue = max(OAValues)
+
+        perpendicular_points_select = arcpy.management.SelectLayerByAttribute(
+            in_layer_or_view=perpendicular_points_copy,
+            selection_type="NEW_SELECTION",
+            where_clause="OA = {}".format(maxOAValue), invert_where_clause="")
+
+        # Process: Copy Features (5) (Copy Features) (management)
+        perpendicular_points_copy2 = arcpy.management.CopyFeatures(in_features=perpendicular_points_select,
+                                                                   out_feature_class=scratch.name(
+                                                                       "perpendicular_points_copy2"),
+                                                                   config_keyword="", spatial_grid_1=None,
+                                                                   spatial_grid_2=None, spatial_grid_3=None)
+        # ### ----------- end of group ----------- ###
+
+        # The layer including the max obstruction point of the window
+        windowOutput = perpendicular_points_copy2
+
+    # Extract the result row of the window. If there were no higher DSM cells at all, the row is made from the window
+    # centroid and search directions with an OA of 0.
+    windowRow = None
+    with arcpy.da.SearchCursor(windowOutput, OA_engine.RESULT_FIELDS[1:]) as cursor5:
+        for r5 in cursor5:
+            windowRow = (windowID,) + tuple(r5)
+            break
+    if windowRow is None:
+        with arcpy.da.SearchCursor(windows_centroid_points, ["cent_long_x", "cent_lat_y", "Z_Mean"]) as cursor6:
+            centroid = next(cursor6)
+        with arcpy.da.SearchCursor(windowSearchDir2_select_copy_alter, ["Search_dir_low"]) as cursor7:
+            searchDirLow = next(cursor7)[0]
+        with arcpy.da.SearchCursor(windowSearchDir2_select2_copy_alter, ["Search_dir_high"]) as cursor8:
+            searchDirHigh = next(cursor8)[0]
+        windowRow = (windowID,) + tuple(centroid) + (0.0, None, None, searchDirLow, searchDirHigh)
+    profiler.end(rows=1)
+
+    # The intermediate datasets of the window are not needed any more once the result row has been extracted
+    scratch.clear()
+    return windowRow
+
+
+# Split the windows from windowID firstID on into batches of batchSize windows (one batch without a batchSize), and
+# every batch into one chunk per worker, and calculate the chunks in a process pool. Each worker writes to its own
+# scratch workspace: the memory workspace of its process, or a geodatabase of its own next to the scratchWorkspace
+# geodatabase (in the scratch folder of the environment for ""), which is deleted after the run. The same pool of
+# worker processes calculates all batches, so arcpy is only imported once per worker. Yields the window rows of every
+# batch in windowID order, so the output is the same as after a serial run. searchArea holds the innerRadius,
+# outerRadius and tolerance keyword arguments of OAwindow.
+def OAcalc_parallel(windows, DSM, workers, scratchWorkspace="memory", profiler=None, firstID=1, batchSize=None,
+                    searchArea=None):
+    import arcpy
+
+    with arcpy.da.SearchCursor(windows, ['OBJECTID']) as cursor:
+        objectIDs = [row[0] for row in cursor]
+
+    # The memory workspace belongs to the worker process, a geodatabase gets one copy per worker
+    workerScratches = [scratchWorkspace] * workers
+    if scratchWorkspace != "memory":
+        if scratchWorkspace:
+            folder, baseName = os.path.split(os.path.splitext(scratchWorkspace)[0])
+        else:
+            folder, baseName = arcpy.env.scratchFolder, "oa"
+        workerScratches = [os.path.join(folder, "{0}_worker{1}.gdb".format(baseName, chunk))
+                           for chunk in range(1, workers + 1)]
+
+    batchSize = batchSize or len(objectIDs)
+    with OA_parallel.process_pool(workers, OAworkerInit) as pool:
+        for batchStart in range(firstID - 1, len(objectIDs), batchSize):
+            batchIDs = objectIDs[batchStart:batchStart + batchSize]
+            chunks = []
+            for chunk, (start, stop) in enumerate(OA_parallel.chunk_ranges(len(batchIDs), workers), start=1):
+                jobs = [(batchStart + start + i + 1, objectID) for i, objectID in enumerate(batchIDs[start:stop])]
+                chunks.append((windows, DSM, jobs, workerScratches[chunk - 1], profiler or Profiler(),
+                               searchArea or {}))
+
+            # The chunks of a batch all finish before the next batch starts, so no two workers use the same
+            # scratch geodatabase at the same time
+            windowResults = OA_parallel.run_chunks(OAworker, chunks, workers, pool=pool)
+            yield sorted(windowResults, key=lambda windowRow: windowRow[0])
+
+    for workerScratch in workerScratches:
+        if workerScratch != "memory" and arcpy.Exists(workerScratch):
+            arcpy.management.Delete(workerScratch)
+
+
+# Runs once in every worker process of OAcalc_parallel when it starts
+def OAworkerInit():
+    import arcpy
+
+    arcpy.env.overwriteOutput = True
+
 
-        windowID = 1  # The ID given to each window - Value increases by one each loop
-        windowOutputData = []  # A list that will store the results of each window, they will then be merged once all
-        # windows have been visited
+# Worker process of OAcalc_parallel. jobs is a list of (windowID, OBJECTID) pairs. Returns the result rows of the
+# windows. The stages are written to the same trace as the main process through the copy of its profiler.
+def OAworker(windows, DSM, jobs, scratchWorkspace, profiler, searchArea):
+    import arcpy
 
+    arcpy.env.overwriteOutput = True
+    if scratchWorkspace != "memory":
+        if not arcpy.Exists(scratchWorkspace):
+            arcpy.management.CreateFileGDB(out_folder_path=os.path.dirname(scratchWorkspace),
+                                           out_name=os.path.basename(scratchWorkspace))
+        arcpy.env.scratchWorkspace = scratchWorkspace
+        arcpy.env.workspace = scratchWorkspace
+    scratch = ScratchWorkspace(scratchWorkspace)
+
+    spatial_ref = arcpy.Describe(windows).spatialReference
+    objectIDs = [objectID for windowID, objectID in jobs]
+    windowShapes = {}
+    with arcpy.da.SearchCursor(windows, ['OBJECTID', 'SHAPE@'],
+                               where_clause="OBJECTID IN ({0})".format(",".join(str(o) for o in objectIDs))) as cursor:
         for row in cursor:
+            windowShapes[row[0]] = row[1]
+
+    return [OAwindow(windowShapes[objectID], windowID, DSM, spatial_ref, scratch, profiler, **searchArea)
+            for windowID, objectID in jobs]
+
+
+# Command line entry point: python -m OA_tool windows DSM output [options]. The toolbox script passes its parameters
+# as positional values in the order of the OAcalc parameters (none of them starting with "-"), which are handed to
+# OAcalc as they are.
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) > 3 and not any(arg.startswith("-") for arg in argv):
+        OAcalc(*argv)
+        return 0
+
+    parser = argparse.ArgumentParser(prog="OA_tool", description="Calculate the obstruction angle of windows")
+    parser.add_argument("windows", help="Multipatch feature class, or a CSV (w_id, x, y, z) or GeoJSON vertex file")
+    parser.add_argument("DSM", help="Digital surface model: a raster, ESRI ASCII grid (.asc) or float grid (.flt)")
+    parser.add_argument("output", nargs="?",
+                        help="Output point feature class, or a .csv or .parquet (GeoParquet) file (not needed with "
+                             "--validate)")
+    parser.add_argument("--backend", choices=BACKENDS, default="arcpy")
+    parser.add_argument("--search", choices=OA_engine.SEARCH_METHODS, default="cells",
+                        help="How the NumPy backend searches the DSM")
+    parser.add_argument("--inner-radius", type=float, default=OA_engine.INNER_RADIUS)
+    parser.add_argument("--outer-radius", type=float, default=None)
+    parser.add_argument("--tolerance", type=float, default=OA_engine.SEARCH_TOLERANCE,
+                        help="+- degrees around the search directions")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--tile-size", type=int, default=None, help="Read the DSM in tiles of this many cells")
+    parser.add_argument("--scratch", default="memory",
+                        help='Scratch workspace of the arcpy backend: "memory", a geodatabase or "scratchGDB"')
+    parser.add_argument("--cache", action="store_true", help="Only recalculate changed windows")
+    parser.add_argument("--profile", default=None, help="Path of a JSON lines trace of the stages")
+    parser.add_argument("--batch-size", type=int, default=None, help="Write the output every this many windows")
+    parser.add_argument("--horizon-step", type=float, default=None,
+                        help="Also sweep the horizon in sectors of this many degrees")
+    parser.add_argument("--validate", action="store_true",
+                        help="Only check the inputs (coordinate systems, window vertices, DSM extent)")
+    args = parser.parse_args(argv)
+    if not args.validate and args.output is None:
+        parser.error("the following arguments are required: output")
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.validate:
+        errors, warnings = validate(args.windows, args.DSM, args.outer_radius)
+        return 1 if errors else 0
+
+    OAcalc(args.windows, args.DSM, args.output, backend=args.backend, search=args.search, workers=args.workers,
+           scratchWorkspace=args.scratch, tileSize=args.tile_size, outerRadius=args.outer_radius, cache=args.cache,
+           profile=args.profile, batchSize=args.batch_size, horizonStep=args.horizon_step,
+           innerRadius=args.inner_radius, tolerance=args.tolerance)
+    return 0
+
 
-            ### Find centroid point of Window ###
-            arcpy.AddMessage("Calculating window {0}".format(windowID))
-
-            # Process: Feature Vertices To Points (Feature Vertices To Points) (management)
-            # Add points to each vertex of the input window
-            windows_FVtP = arcpy.management.FeatureVerticesToPoints(in_features=row[1], point_location="ALL")
-
-            # Process: Add Field (2) (Add Field) (management)
-            # Add a field for the window ID (w_id)
-            windows_add_wID = arcpy.management.AddField(in_table=windows_FVtP, field_name="w_id", field_type="SHORT",
-                                                        field_precision=None, field_scale=None, field_length=None,
-                                                        field_alias="w_id", field_is_nullable="NULLABLE",
-                                                        field_is_required="NON_REQUIRED", field_domain="")[0]
-
-            # Process: Calculate Field (7) (Calculate Field) (management)
-            # Add the variable windowID to the window field w_id
-            windows_calc_wID = \
-                arcpy.management.CalculateField(in_table=windows_add_wID, field="w_id", expression=f"int({windowID})",
-                                                expression_type="PYTHON3", code_block="", field_type="TEXT")[0]
-
-            # Process: Points To Line (Points To Line) (management)
-            # "Fill" the window by drawing lines from each vertex point. This will be used to find the centroid coord
-            windows_p_to_lines = arcpy.management.PointsToLine(Input_Features=windows_calc_wID, Line_Field="w_id",
-                                                               Sort_Field="", Close_Line="NO_CLOSE")
-
-            # Process: Add Z Information (2) (Add Z Information) (3d)
-            # Add a field to the data with the mean Z height (this is the same height the window has at its centre)
-            windows_p_to_lines_zInfo = \
-                arcpy.ddd.AddZInformation(in_feature_class=windows_p_to_lines, out_property=["Z_MEAN"],
-                                          noise_filtering="")[
-                    0]
-
-            # Process: Add Fields (multiple) (2) (Add Fields (multiple)) (management)
-            # Add two new fields where the coordinate of the centre point of the window will be stored
-            windows_p_to_lines_addFields = arcpy.management.AddFields(in_table=windows_p_to_lines_zInfo,
-                                                                      field_description=[
-                                                                          ["cent_long_x", "DOUBLE", "", "", "", ""],
-                                                                          ["cent_lat_y", "DOUBLE", "", "", "", ""]])[0]
-
-            # Process: Calculate Geometry Attributes (Calculate Geometry Attributes) (management)
-            # Calculate the centre coordinate in X and Y direction, then add it to the new fields from the previous step
-            with arcpy.EnvManager(
-                    outputCoordinateSystem=spatial_ref):
-                windows_centroid_coord = \
-                    arcpy.management.CalculateGeometryAttributes(in_features=windows_p_to_lines_addFields,
-                                                                 geometry_property=[["cent_long_x", "CENTROID_X"],
-                                                                                    ["cent_lat_y", "CENTROID_Y"]],
-                                                                 length_unit="", area_unit="",
-                                                                 coordinate_system=spatial_ref,
-                                                                 coordinate_format="SAME_AS_INPUT")[0]
-
-            # Process: XY Table To Point (XY Table To Point) (management)
-            # Create points at the window centre location
-            windows_centroid_points = arcpy.management.XYTableToPoint(in_table=windows_centroid_coord,
-                                                                      x_field="cent_long_x", y_field="cent_lat_y",
-                                                                      z_field="Z_Mean",
-                                                                      coordinate_system=spatial_ref)
-            ### ----------- end of group ----------- ###
-
-            ### Find obstruction points and calculate the obstructio angle ###
-            arcpy.AddMessage("Finding the obstruction points and calculating the obstruction angle...")
-            # Process: Viewshed 2 (Viewshed 2) (3d)
-            # Create a raster displaying what can be seen from the window centre
-            # Changed property: inner_radius: Only look for cells further than 4 meters away from the window
-            Output_above_ground_level_raster_2_ = ""
-            Output_observer_region_relationship_table = ""
-            viewshed = arcpy.ddd.Viewshed2(in_raster=DSM, in_observer_features=windows_centroid_points,
-                                           out_agl_raster=Output_above_ground_level_raster_2_,
-                                           analysis_type="FREQUENCY", vertical_error="0 Meters",
-                                           out_observer_region_relationship_table=Output_observer_region_relationship_table,
-                                           refractivity_coefficient=0.13, surface_offset="0 Meters",
-                                           observer_elevation="Z_Mean", observer_offset="0 Meters",
-                                           inner_radius="16 Meters", inner_radius_is_3d="GROUND", outer_radius="",
-                                           outer_radius_is_3d="GROUND", horizontal_start_angle=0,
-                                           horizontal_end_angle=360, vertical_upper_angle=90, vertical_lower_angle=-90,
-                                           analysis_method="ALL_SIGHTLINES")
-
-            # Process: Select Layer By Attribute (2) (Select Layer By Attribute) (management)
-            # Only select the cells that can be seen (value = 1)
-            viewshed_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=viewshed,
-                                                                      selection_type="NEW_SELECTION",
-                                                                      where_clause="Value > 0", invert_where_clause="")
-
-            # Find field value of window height (to use in raster calculator)
-            field_z = ['Z_Mean']
-            windowHeight = 0
-            with arcpy.da.SearchCursor(windows_centroid_points, field_z) as cursor2:
-                for r in cursor2:
-                    windowHeight = r[0]
-                    break
-
-            # The extract by mask and extract by attributes tools in the next lines are used to first find the DSM
-            # cells within the viewshed and then only select the ones with higher values than the window Process:
-            # Extract by Mask (Extract by Mask) (sa)
-            find_high_elev_cells = arcpy.sa.ExtractByMask(in_raster=DSM, in_mask_data=viewshed_select)
-            # Process: Extract by Attributes (Extract by Attributes) (sa)
-            find_high_elev_cells2 = arcpy.sa.ExtractByAttributes(in_raster=find_high_elev_cells,
-                                                                 where_clause="Value > {}".format(windowHeight))
-            # Process: Raster to Point (Raster to Point) (conversion)
-            with arcpy.EnvManager(outputMFlag="Disabled", outputZFlag="Disabled"):
-                high_elev_points = arcpy.conversion.RasterToPoint(in_raster=find_high_elev_cells2, raster_field="VALUE")
-
-            # Process: Add XY Coordinates (Add XY Coordinates) (management)
-            # Add new XY coordinates to the window centres
-            with arcpy.EnvManager(
-                    outputCoordinateSystem=spatial_ref):
-                windows_centroid_points_newZ_coords = arcpy.management.AddXY(in_features=windows_centroid_points)[0]
-
-            # Process: Spatial Join (2) (Spatial Join) (analysis)
-            # Join the table of the high elevation points (from the viewshed) and the window midpoints.
-            highPoints_windows_join = arcpy.analysis.SpatialJoin(target_features=high_elev_points,
-                                                                 join_features=windows_centroid_points_newZ_coords,
-                                                                 join_operation="JOIN_ONE_TO_ONE", join_type="KEEP_ALL",
-                                                                 match_option="CLOSEST", search_radius="",
-                                                                 distance_field_name="Distance")
-
-            # Process: Add Field (4) (Add Field) (management)
-            # Adding a field where the obstruction angle (OA) value will be added
-            highPointsAddField = \
-                arcpy.management.AddField(in_table=highPoints_windows_join, field_name="OA", field_type="DOUBLE",
-                                          field_precision=None, field_scale=None, field_length=None, field_alias="OA",
-                                          field_is_nullable="NULLABLE", field_is_required="NON_REQUIRED",
-                                          field_domain="")[
-                    0]
-
-            ### ----------- end of group ----------- ###
-
-            ## Find search Direction (perpendicular to window) ###
-            # Here the window vertices are used to find the direction the window is "looking"
-            arcpy.AddMessage("Finding search Direction (perpendicular to window)...")
-
-            # Process: Add Z Information (3) (Add Z Information) (3d)
-            # Add Z information to the vertices
-            windows_zInfo = \
-                arcpy.ddd.AddZInformation(in_feature_class=windows_calc_wID, out_property=["Z"], noise_filtering="")[0]
-
-            # Process: Select Layer By Attribute (3) (Select Layer By Attribute) (management)
-            # Select the vertices that are greater than the mean height of the vertices. The point of this is to only
-            # select vertices at the same height, before the angle between these points are then calculated later
-            windows_zInfo_field = ['Z']
-            windows_zInfo_mean = 0
-            rowCounter = 0
-            with arcpy.da.SearchCursor(windows_zInfo, windows_zInfo_field) as cursor3:
-                for r3 in cursor3:
-                    windows_zInfo_mean += int(r3[0])
-                    rowCounter += 1
-            windows_zInfo_mean = windows_zInfo_mean / rowCounter
-            windows_zInfo_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windows_zInfo,
-                                                                           selection_type="NEW_SELECTION",
-                                                                           where_clause="Z > {}".format(
-                                                                               windows_zInfo_mean),
-                                                                           invert_where_clause="")
-
-            # Process: Copy Features (Copy Features) (management)
-            windowVerticesMaxZ = arcpy.management.CopyFeatures(in_features=windows_zInfo_select, config_keyword="",
-                                                               spatial_grid_1=None, spatial_grid_2=None,
-                                                               spatial_grid_3=None)
-
-            # Process: Select Layer By Attribute (4) (Select Layer By Attribute) (management)
-            # In case there are more than two vertices of the highest Z value -> select only two of them.
-            windowVerticesMaxZ_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windowVerticesMaxZ,
-                                                                                selection_type="NEW_SELECTION",
-                                                                                where_clause="OBJECTID = 1 Or "
-                                                                                             "OBJECTID = 2",
-                                                                                invert_where_clause="")
-
-            # Process: Copy Features (2) (Copy Features) (management)
-            windowVerticesMaxZ_twoP = arcpy.management.CopyFeatures(in_features=windowVerticesMaxZ_select,
-                                                                    config_keyword="", spatial_grid_1=None,
-                                                                    spatial_grid_2=None, spatial_grid_3=None)
-
-            # Process: Near 3D (Near 3D) (3d)
-            # Calculate angle between the two vertices
-            windowAngle = arcpy.ddd.Near3D(in_features=windowVerticesMaxZ_twoP, near_features=[windowVerticesMaxZ_twoP],
-                                           search_radius="", location="NO_LOCATION", angle="ANGLE", delta="NO_DELTA")[0]
-
-            # Process: Add Field (Add Field) (management)
-            # Add a field for the search direction values (degrees)
-            windowSearchDir = \
-                arcpy.management.AddField(in_table=windowAngle, field_name="Search_Direction",
-                                          field_type="DOUBLE", field_precision=None, field_scale=None,
-                                          field_length=None,
-                                          field_alias="Search_Direction", field_is_nullable="NULLABLE",
-                                          field_is_required="NON_REQUIRED", field_domain="")[0]
-
-            # Process: Calculate Field (5) (Calculate Field) (management)
-            # Change the angle-value of the direction between the two vertices to the same as default in ArcGIS Pro -
-            # North is -90 degrees, east is +- 180 degrees, south is 90, west is 0.
-            windowSearchDir2 = \
-                arcpy.management.CalculateField(in_table=windowSearchDir, field="Search_Direction",
-                                                expression="Opposite(!NEAR_ANG_H!)", expression_type="PYTHON3",
-                                                code_block="""def Opposite(NEAR_ANG_H):
-                if (NEAR_ANG_H <= 0):
-                    return NEAR_ANG_H + 90
-                elif (NEAR_ANG_H >= 90):
-                    return -180 + NEAR_ANG_H -90
-                elif (NEAR_ANG_H > 0):
-                    return NEAR_ANG_H + 90
-            """, field_type="TEXT")[0]
-
-            # Process: Select Layer By Attribute (6) (Select Layer By Attribute) (management)
-            # Select only one of the window vertices
-            windowSearchDir2_select = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windowSearchDir2,
-                                                                              selection_type="NEW_SELECTION",
-                                                                              where_clause="OBJECTID = 1",
-                                                                              invert_where_clause="")
-
-            # Process: Select Layer By Attribute (7) (Select Layer By Attribute) (management)
-            # Select only one of the window vertices
-            windowSearchDir2_select2 = arcpy.management.SelectLayerByAttribute(in_layer_or_view=windowSearchDir2,
-                                                                               selection_type="NEW_SELECTION",
-                                                                               where_clause="OBJECTID = 2",
-                                                                               invert_where_clause="")
-
-            # Process: Copy Features (3) (Copy Features) (management)
-            windowSearchDir2_select_copy = arcpy.management.CopyFeatures(in_features=windowSearchDir2_select,
-                                                                         config_keyword="", spatial_grid_1=None,
-                                                                         spatial_grid_2=None, spatial_grid_3=None)
-
-            # Process: Copy Features (4) (Copy Features) (management)
-            windowSearchDir2_select2_copy = arcpy.management.CopyFeatures(in_features=windowSearchDir2_select2,
-                                                                          config_keyword="", spatial_grid_1=None,
-                                                                          spatial_grid_2=None, spatial_grid_3=None)
-
-            # Process: Alter Field (3) (Alter Field) (management)
-            # In this and the next process I am changing the search direction field to search direction "high" and "low"
-            # These fields will have new values that will be used in the search direction calculation
-            windowSearchDir2_select_copy_alter = \
-                arcpy.management.AlterField(in_table=windowSearchDir2_select_copy, field="Search_Direction",
-                                            new_field_name="Search_dir_low", new_field_alias="Search_dir_low",
-                                            field_type="", field_length=8, clear_field_alias="DO_NOT_CLEAR")[0]
-
-            # Process: Alter Field (4) (Alter Field) (management)
-            windowSearchDir2_select2_copy_alter = \
-                arcpy.management.AlterField(in_table=windowSearchDir2_select2_copy, field="Search_Direction",
-                                            new_field_name="Search_dir_high", new_field_alias="Search_dir_high",
-                                            field_type="", field_length=8, clear_field_alias="DO_NOT_CLEAR")[0]
-
-            # ### ----------- end of group ----------- ###
-
-            ### Find obstruction angle points within the search direction (parallel to window) ###
-            # Process: Near (Near) (analysis)
-            # Run the near tool (angle) from all the obstruction points to the window midpoints
-            windowToObstructionAngle = arcpy.analysis.Near(in_features=highPointsAddField,
-                                                           near_features=[windows_centroid_points],
-                                                           search_radius="", location="NO_LOCATION", angle="ANGLE",
-                                                           method="PLANAR", field_names=[["NEAR_ANGLE", "NEAR_ANGLE"]])[
-                0]
-
-            # Process: Join Field (Join Field) (management)
-            # Join the obstruciton points (with an angle to the window midpoint) with the table of one of the window
-            # vertices (search direction low)
-            angleJoinField = arcpy.management.JoinField(in_data=windowToObstructionAngle, in_field="w_id",
-                                                        join_table=windowSearchDir2_select_copy_alter,
-                                                        join_field="w_id", fields=["Search_dir_low"])[0]
-
-            # Process: Join Field (2) (Join Field) (management)
-            # Same as the one above, just search direction high
-            angleJoinField2 = arcpy.management.JoinField(in_data=angleJoinField, in_field="w_id",
-                                                         join_table=windowSearchDir2_select2_copy_alter,
-                                                         join_field="w_id", fields=["Search_dir_high"])[0]
-
-            # Process: Select Layer By Attribute (5) (Select Layer By Attribute) (management)
-            # Select the obstruction points that are within the search direction of the window. These are points that
-            # have "opposite" angles of the window. In addition there is a +- 5 degree "buffer" added, to include
-            # obstruction points that are almost perpendicular to the window. As an example, if the two window vertices
-            # (corners) have the nagle of 90 and -90 degrees between each other (north and south), then this process
-            # will look for obstruction points between 0 (+- 5 degrees) and 180 (+- 5 degrees).
-            perpendicular_points = arcpy.management.SelectLayerByAttribute(in_layer_or_view=angleJoinField2,
-                                                                           selection_type="NEW_SELECTION",
-                                                                           where_clause="(NEAR_ANGLE >= ("
-                                                                                        "Search_dir_low - 5) And "
-                                                                                        "NEAR_ANGLE <= ("
-                                                                                        "Search_dir_low + 5)) Or ("
-                                                                                        "NEAR_ANGLE >= ("
-                                                                                        "Search_dir_high - 5) And ("
-                                                                                        "NEAR_ANGLE <= "
-                                                                                        "Search_dir_high + 5))",
-                                                                           invert_where_clause="NON_INVERT")
-
-            # Process: Copy Features (6) (Copy Features) (management)
-            perpendicular_points_copy = arcpy.management.CopyFeatures(in_features=perpendicular_points,
-                                                                      config_keyword="", spatial_grid_1=None,
-                                                                      spatial_grid_2=None, spatial_grid_3=None)
-
-            # Process: Calculate Field (4) (Calculate Field) (management)
-            # Calculating the OA for the window
-            # grid_code = Height of the obstruction point
-            # Z_mean = The height of the window midpoint
-            # Distance = The distance from the window midpoint to the obstruction point in 2D (meaning height
-            # differences are not included)
-            # highPoints_all_values =
-            OA_calc = arcpy.management.CalculateField(in_table=perpendicular_points_copy, field="OA",
-                                                      expression="math.degrees(math.atan(("
-                                                                 "!grid_code!-!Z_Mean!)/(!Distance!)))",
-                                                      expression_type="PYTHON3", code_block="",
-                                                      field_type="TEXT")[0]
-
-            # Process: Select Layer By Attribute (Select Layer By Attribute) (management)
-            # Only select the obstruction point with the highest value
-            windows_OA_field = ['OA']
-            OAValues = []
-            with arcpy.da.SearchCursor(OA_calc, windows_OA_field) as cursor4:
-                for r4 in cursor4:
-                    OAValues.append(float(r4[0]))
-
-            # In case there are no obstruction points - take the window midpoint and set the OA value to 0
-            if len(OAValues) == 0:
-                NoOutputSelect = arcpy.management.SelectLayerByAttribute(in_layer_or_view=angleJoinField2,
-                                                                         selection_type="NEW_SELECTION",
-                                                                         where_clause="OBJECTID = 1",
-                                                                         invert_where_clause="")
-
-                NoOutputCopy = arcpy.management.CopyFeatures(in_features=NoOutputSelect,
-                                                             config_keyword="", spatial_grid_1=None,
-                                                             spatial_grid_2=None, spatial_grid_3=None)
-
-                NoOAOutput = arcpy.management.CalculateField(in_table=NoOutputCopy,
-                                                             field="OA", expression="0",
-                                                             expression_type="PYTHON3",
-                                                             code_block="", field_type="TEXT")[0]
-
-                windowOutputData.append(NoOAOutput)
-
-            # If there are obstruction points, set it to the highest value (max)
-            else:
-                maxOAValue = max(OAValues)
-
-                perpendicular_points_select = arcpy.management.SelectLayerByAttribute(
-                    in_layer_or_view=perpendicular_points_copy,
-                    selection_type="NEW_SELECTION",
-                    where_clause="OA = {}".format(maxOAValue), invert_where_clause="")
-
-                # Process: Copy Features (5) (Copy Features) (management)
-                perpendicular_points_copy2 = arcpy.management.CopyFeatures(in_features=perpendicular_points_select,
-                                                                           config_keyword="", spatial_grid_1=None,
-                                                                           spatial_grid_2=None, spatial_grid_3=None)
-                # ### ----------- end of group ----------- ###
-
-                # Add the layer including the max obstruction point of a window to a list
-                windowOutputData.append(perpendicular_points_copy2)
-
-            windowID += 1  # Increment the window ID, so the next window will have another ID value.
-
-    arcpy.AddMessage("Merging data before returning results...")
-    # Process: Merge (Merge) (management)
-    # Merge all the windows in the list, after all input windows have been visited.
-    mergedWindowData = arcpy.management.Merge(inputs=windowOutputData, add_source="NO_SOURCE_INFO")
-
-    # Process: Delete Field (Delete Field) (management)
-    # delete unnecessary fields
-    mergedWindowData2 = arcpy.management.DeleteField(in_table=mergedWindowData,
-                                                     drop_field=["Join_Count", "pointid", "POINT_X", "POINT_Y",
-                                                                 "POINT_Z", "NEAR_ANGLE", "NEAR_FID", "NEAR_DIST"])[0]
-
-    # Process: XY Table To Point (3) (XY Table To Point) (management)
-    # Output point at the location of each window, for visualization and to access the table.
-    outputWindowPoints = arcpy.management.XYTableToPoint(in_table=mergedWindowData2, out_feature_class=outputPath,
-                                                         x_field="cent_long_x", y_field="cent_lat_y", z_field="Z_Mean",
-                                                         coordinate_system=spatial_ref)
-
-
-# Inputs from the user
-windows = arcpy.GetParameterAsText(0)
-DSM = arcpy.GetParameterAsText(1)
-outputPath = arcpy.GetParameterAsText(2)
-
-# argv creates a a list of strings representing the arguments. argv[0] is the file name, we do not need this, so we
-# start from [1].
 if __name__ == '__main__':
-    OAcalc(*argv[1:])
+    sys.exit(main())
@@ -0,0 +1,174 @@
+import os
+import re
+import sys
+import time
+
+import numpy as np
+
+from OA_dsm import read_dsm_extent
+from OA_engine import read_windows
+from OA_geometry import batch_window_geometry, pack_windows
+from OA_log import add_message
+
+
+# Inputs that are read without arcpy, their coordinate system is taken from a .prj file next to them (or from the
+# "crs" member of a GeoJSON file)
+FILE_INPUTS = (".csv", ".asc", ".txt", ".flt", ".geojson", ".json", ".geojsonl", ".geojsons")
+
+# Number of w_ids listed in a message about a group of windows
+MAX_LISTED = 10
+
+
+# A coordinate system as its EPSG code (None if it has none) and its name, so that one known by its code and one
+# known by its name only (e.g. from an ESRI .prj file, which has no AUTHORITY) can still be compared
+class CoordinateSystem:
+
+    def __init__(self, code=None, name=None):
+        self.code = int(code) if code else None
+        self.name = name or None
+
+    # True or False if both have an EPSG code or a name to compare, None otherwise. Names are compared without case
+    # and punctuation.
+    def same_as(self, other):
+        if self.code and other.code:
+            return self.code == other.code
+        if self.name and other.name:
+            return _simple_name(self.name) == _simple_name(other.name)
+        return None
+
+    def __str__(self):
+        return "EPSG:{0}".format(self.code) if self.code else str(self.name)
+
+
+def _simple_name(name):
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+
+# A WKT coordinate system: the EPSG code of its outermost definition (WKT1 AUTHORITY or WKT2 ID) and its name. Without
+# a code in the WKT it is looked up with pyproj, or with arcpy if that has already been imported.
+def wkt_coordinate_system(wkt):
+    wkt = wkt.strip()
+    name = re.match(r'\w+\["([^"]*)"', wkt)
+    name = name.group(1) if name else None
+    code = re.search(r'(?:AUTHORITY|ID)\["EPSG",\s*"?(\d+)"?\]\]$', wkt)
+    if code:
+        return CoordinateSystem(int(code.group(1)), name)
+    try:
+        import pyproj
+    except ImportError:
+        pass
+    else:
+        try:
+            return CoordinateSystem(pyproj.CRS.from_wkt(wkt).to_epsg(), name)
+        except pyproj.exceptions.CRSError:
+            return CoordinateSystem(None, name)
+    if "arcpy" in sys.modules:
+        spatial_ref = sys.modules["arcpy"].SpatialReference()
+        spatial_ref.loadFromString(wkt)
+        return CoordinateSystem(spatial_ref.factoryCode, name)
+    return CoordinateSystem(None, name)
+
+
+# The CoordinateSystem of a window input or DSM. None if it is not known, e.g. for a CSV file without a .prj file.
+def coordinate_system(path):
+    if not isinstance(path, str):
+        return None
+    base, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if ext in FILE_INPUTS:
+        if ext.startswith((".geojson", ".json")):
+            with open(path) as f:
+                head = f.read(65536)
+            name = re.search(r'"crs"\s*:\s*\{.*?"name"\s*:\s*"([^"]+)"', head, re.S)
+            if name:
+                code = re.search(r"EPSG:+(\d+)$", name.group(1))
+                return CoordinateSystem(int(code.group(1)) if code else None, None if code else name.group(1))
+        if os.path.exists(base + ".prj"):
+            with open(base + ".prj") as f:
+                return wkt_coordinate_system(f.read())
+        return None
+
+    if ext in (".tif", ".tiff"):
+        try:
+            import rasterio
+        except ImportError:
+            pass
+        else:
+            with rasterio.open(path) as src:
+                if src.crs is None:
+                    return None
+                crs = wkt_coordinate_system(src.crs.to_wkt())
+                return CoordinateSystem(src.crs.to_epsg() or crs.code, crs.name)
+
+    try:
+        import arcpy
+    except ImportError:
+        return None
+    spatial_ref = arcpy.Describe(path).spatialReference
+    if spatial_ref is None or spatial_ref.name == "Unknown":
+        return None
+    return CoordinateSystem(spatial_ref.factoryCode, spatial_ref.name)
+
+
+def _listed(w_ids):
+    listed = ", ".join(str(int(w_id)) for w_id in w_ids[:MAX_LISTED])
+    return listed + (", ..." if len(w_ids) > MAX_LISTED else "")
+
+
+# Check the inputs of a run without calculating anything: the windows and the DSM have the same coordinate system,
+# every window has enough vertices to find its centroid and search directions, and every window lies within the DSM
+# (and its search area too, if there is an outer radius). Only the DSM header is read, not its cell values.
+# Returns the lists of errors and warnings, which are also reported.
+def validate(windows, DSM, outer_radius=None):
+    start = time.perf_counter()
+    errors, warnings = [], []
+
+    windows_crs, dsm_crs = coordinate_system(windows), coordinate_system(DSM)
+    if windows_crs is None or dsm_crs is None:
+        unknown = [name for name, crs in (("windows", windows_crs), ("DSM", dsm_crs)) if crs is None]
+        warnings.append("The coordinate system is not known for the {0}, it could not be checked".format(
+            " and the ".join(unknown)))
+    elif windows_crs.same_as(dsm_crs) is None:
+        warnings.append("The coordinate systems of the windows ({0}) and the DSM ({1}) could not be compared".format(
+            windows_crs, dsm_crs))
+    elif not windows_crs.same_as(dsm_crs):
+        errors.append("The windows ({0}) and the DSM ({1}) have different coordinate systems".format(windows_crs,
+                                                                                                    dsm_crs))
+
+    window_vertices = list(read_windows(windows))
+    counts = np.array([len(vertices) for vertices in window_vertices], dtype=np.int64)
+    geometry = None
+    if not len(counts):
+        errors.append("There are no windows")
+    elif np.any(counts < 2):
+        errors.append("Windows with fewer than two vertices (w_id {0})".format(
+            _listed(np.flatnonzero(counts < 2) + 1)))
+    else:
+        if np.any(counts < 3):
+            warnings.append("Windows with only two vertices (w_id {0})".format(_listed(np.flatnonzero(counts < 3) + 1)))
+        try:
+            geometry = batch_window_geometry(*pack_windows(window_vertices))
+        except ValueError as e:
+            errors.append(str(e))
+
+    if geometry is not None:
+        x_min, y_min, x_max, y_max, cell_size = read_dsm_extent(DSM)
+        x, y = geometry.cent_x, geometry.cent_y
+        inside = (x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)
+        if not inside.all():
+            errors.append("{0} windows are outside the DSM extent (w_id {1})".format(
+                int(np.count_nonzero(~inside)), _listed(np.flatnonzero(~inside) + 1)))
+        if outer_radius:
+            partial = inside & ((x - outer_radius < x_min) | (x + outer_radius > x_max) |
+                                (y - outer_radius < y_min) | (y + outer_radius > y_max))
+            if partial.any():
+                warnings.append("The search area of {0} windows extends beyond the DSM (w_id {1})".format(
+                    int(np.count_nonzero(partial)), _listed(np.flatnonzero(partial) + 1)))
+
+    for warning in warnings:
+        add_message("Warning: " + warning)
+    for error in errors:
+        add_message("Error: " + error)
+    add_message("Checked {0} windows in {1:.2f} s: {2} errors, {3} warnings".format(
+        len(counts), time.perf_counter() - start, len(errors), len(warnings)))
+    return errors, warnings
@@ -0,0 +1,127 @@
+import numpy as np
+
+
+# Largest number of line of sight samples (lines x steps) that are looked up together, which bounds the memory use
+SIGHT_BLOCK = 2 ** 20
+
+# Number of obstruction cells whose line of sight is checked first, from the steepest down. Every time none of a group
+# can be seen, the next group is four times as large.
+FIRST_SIGHT_GROUP = 64
+
+# Width (degrees) of the direction bins of the near horizon of a WindowSight
+NEAR_BIN = 0.1
+
+
+# The row and column of the DSM cell that holds the point (x, y)
+def cell_of(dsm, x, y):
+    return int(np.floor((dsm.y_max - y) / dsm.cell_size)), int(np.floor((x - dsm.x_min) / dsm.cell_size))
+
+
+# What can be seen from a window centre (cent_x, cent_y, z_mean). As in Viewshed2 every DSM cell hides the cells
+# behind it that are not as steep, also the cells inside the inner radius (above all the window's own building) that
+# cannot be obstructions themselves. Slopes are (height - z_mean) / distance to the cell centre, like for the
+# obstruction cells, and the cell the window is in does not hide anything.
+# The cells within near_distance hide most of the cells that are hidden, so their horizon is kept in NEAR_BIN bins of
+# NEAR_ANGLE: the steepest slope of the cells that every line of sight in the bin crosses close to their centre (a
+# quarter cell), so that it is sampled by the line. This rules most hidden cells out without following their lines.
+class WindowSight:
+
+    def __init__(self, dsm, cent_x, cent_y, z_mean, near_distance):
+        self.dsm = dsm
+        self.cent_x, self.cent_y, self.z_mean = cent_x, cent_y, z_mean
+        self.own_row, self.own_col = cell_of(dsm, cent_x, cent_y)
+        self.near_horizon = np.full(int(round(360 / NEAR_BIN)), -np.inf)
+
+        # Only the cells at least a cell closer than near_distance, so that they are crossed before any cell beyond it,
+        # and not the cell of the window
+        if near_distance < 1.5 * dsm.cell_size:
+            return
+        values, dx, dy = dsm.around(cent_x, cent_y, near_distance)
+        dx, dy = np.broadcast_to(dx, values.shape), np.broadcast_to(dy, values.shape)
+        distance = np.hypot(dx, dy)
+        with np.errstate(invalid="ignore"):
+            near = (values > z_mean) & (distance <= near_distance - dsm.cell_size) & \
+                ((np.abs(dx) > dsm.cell_size / 2) | (np.abs(dy) > dsm.cell_size / 2))
+        if not near.any():
+            return
+        slopes = (values[near] - z_mean) / distance[near]
+        angle = np.degrees(np.arctan2(dy[near], dx[near]))
+        half = np.degrees(np.arcsin(np.minimum(1, dsm.cell_size / 4 / distance[near])))
+        # The bins that lie within the angles of every cell, those beyond -180..180 are left out
+        low = np.maximum(np.ceil((angle - half + 180) / NEAR_BIN), 0).astype(np.int64)
+        high = np.minimum(np.floor((angle + half + 180) / NEAR_BIN), len(self.near_horizon)).astype(np.int64)
+        widths = np.maximum(high - low, 0)
+        if not widths.sum():
+            return
+        first = np.repeat(low - np.cumsum(widths) + widths, widths)
+        np.maximum.at(self.near_horizon, first + np.arange(widths.sum()), np.repeat(slopes, widths))
+
+    # The lowest near horizon between the NEAR_ANGLEs low and high (arrays), -inf where they reach beyond -180..180.
+    # A cell within those angles and at least near_distance away is hidden if it is not as steep as that.
+    def near_horizon_between(self, low, high):
+        n_bins = len(self.near_horizon)
+        first = np.floor((np.asarray(low) + 180) / NEAR_BIN).astype(np.int64)
+        last = np.floor((np.asarray(high) + 180) / NEAR_BIN).astype(np.int64)
+        inside = (first >= 0) & (last < n_bins) & (first <= last)
+        out = np.full(first.shape, -np.inf)
+        if inside.any():
+            # Every range is reduced on its own, the reductions from the end of one range to the start of the next
+            # are dropped
+            bounds = np.stack([first[inside], last[inside] + 1], axis=1).ravel()
+            horizon = np.r_[self.near_horizon, -np.inf]
+            out[inside] = np.minimum.reduceat(horizon, bounds)[::2]
+        return out
+
+    # The steepest slope of the cells that the lines of sight to the cell centres (x, y) (1-D arrays) cross before
+    # they get there. The lines are sampled every half cell, and the cell at the end is left out. Returns -inf for
+    # lines that cross no cell.
+    def blocking(self, x, y):
+        dsm = self.dsm
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        out = np.full(len(x), -np.inf)
+        step = dsm.cell_size / 2
+        dx, dy = x - self.cent_x, y - self.cent_y
+        dist = np.hypot(dx, dy)
+        n_steps = int(np.ceil(dist.max() / step)) if len(x) else 0
+        if n_steps < 2:
+            return out
+        end_row = np.floor((dsm.y_max - y) / dsm.cell_size)[:, None]
+        end_col = np.floor((x - dsm.x_min) / dsm.cell_size)[:, None]
+        ux, uy = (dx / np.maximum(dist, 1e-12))[:, None], (dy / np.maximum(dist, 1e-12))[:, None]
+        s = step * np.arange(1, n_steps)
+
+        block = max(1, SIGHT_BLOCK // len(s))
+        for start in range(0, len(x), block):
+            part = slice(start, start + block)
+            cols = np.floor((self.cent_x + ux[part] * s - dsm.x_min) / dsm.cell_size)
+            rows = np.floor((dsm.y_max - (self.cent_y + uy[part] * s)) / dsm.cell_size)
+            on_line = (s < dist[part, None]) & (cols >= 0) & (cols < dsm.n_cols) & (rows >= 0) & \
+                (rows < dsm.n_rows) & ~((rows == self.own_row) & (cols == self.own_col)) & \
+                ~((rows == end_row[part]) & (cols == end_col[part]))
+            if not on_line.any():
+                continue
+            rows, cols = rows[on_line].astype(np.int64), cols[on_line].astype(np.int64)
+            slopes = np.full(on_line.shape, -np.inf)
+            with np.errstate(invalid="ignore"):
+                crossed = (dsm.sample(rows, cols) - self.z_mean) / np.hypot(dsm.col_x(cols) - self.cent_x,
+                                                                           dsm.row_y(rows) - self.cent_y)
+            slopes[on_line] = np.where(np.isnan(crossed), -np.inf, crossed)
+            out[part] = slopes.max(axis=1)
+        return out
+
+    # The index of the steepest of the obstruction cells (their slopes and cell centres x, y, all at least
+    # near_distance from the window) that can be seen, None if all of them are hidden. The cells below the near horizon
+    # are left out, the others are checked from the steepest down in groups.
+    def steepest_visible(self, slopes, x, y):
+        near_angle = np.degrees(np.arctan2(self.cent_y - y, self.cent_x - x))
+        bins = np.clip(np.floor((near_angle + 180) / NEAR_BIN).astype(np.int64), 0, len(self.near_horizon) - 1)
+        order = np.flatnonzero(slopes >= self.near_horizon[bins])
+        order = order[np.argsort(-slopes[order], kind="stable")]
+        start, size = 0, FIRST_SIGHT_GROUP
+        while start < len(order):
+            group = order[start:start + size]
+            start, size = start + size, size * 4
+            visible = slopes[group] >= self.blocking(x[group], y[group])
+            if visible.any():
+                return int(group[np.argmax(visible)])
+        return None